@@ -4,10 +4,11 @@ Created by Jaehyeon Park
 There are codes to calculate the amount of electrons for each components
 """
 
+import numpy as np
 import pandas as pd
 from collections import defaultdict
 import re
-from formula_utils import parse_molecular_formula
+from formula_tokenizer import parse_molecular_formula
 
 def initialize_amount_columns(data):
     """Initialize amount columns in the dataframe"""
@@ -51,32 +52,88 @@ def calculate_core_amount(particle_vol, core_vol, total_doping_ratio=0):
     """Calculate core amount"""
     return float(((1 - total_doping_ratio) * particle_vol) / core_vol)
 
-def calculate_amounts(data):
-    """Calculate amounts for all components"""
-    for idx, row in data.iterrows():
-        particle_vol = row['Particle Volume (nm^3)']
-        particle_sa = row['Particle Surface Area (nm^2)']
-        
-        # Calculate coating amount
-        data.loc[idx, 'Amounts of Coating'] = calculate_coating_amount(
-            particle_sa, row['Coating Volume (nm^3)'])
-        
-        # Calculate shell amount
-        data.loc[idx, 'Amounts of Shell'] = calculate_shell_amount(
-            particle_sa, row['Shell Volume (nm^3)'])
-        
+def calculate_doping_amount_columns(particle_vol, doping_ratio, doping_vol, errors='raise'):
+    """
+    Doping amounts and total doping ratios of many doped particles at once.
+
+    Rows sharing a (Doping Rate(%), Doping Volume) pair are computed together with NumPy,
+    the amounts come back as the same strings calculate_doping_amounts makes.
+    errors='collect' returns the rows whose rate cannot be used as a third array of error dicts (None where fine).
+    """
+    doping_amount = np.empty(len(particle_vol), dtype=object)
+    total_doping_ratio = np.zeros(len(particle_vol))
+    failures = np.full(len(particle_vol), None, dtype=object)
+    groups = pd.DataFrame({'rate': doping_ratio, 'vol': doping_vol}).groupby(['rate', 'vol'], sort=False, dropna=False).indices
+    for (rate, vol), idx in groups.items():
+        try:
+            calculate_doping_group(doping_amount, total_doping_ratio, idx, particle_vol[idx], rate, vol)
+        except (ValueError, TypeError, AttributeError) as e:
+            if errors != 'collect':
+                raise
+            doping_amount[idx] = 0
+            total_doping_ratio[idx] = np.nan
+            failures[idx] = [{'code': 'invalid_doping_rate', 'component': 'Doping',
+                              'message': f"Doping rate error: {rate} ({type(e).__name__}: {e})"}] * len(idx)
+    if errors == 'collect':
+        return doping_amount, total_doping_ratio, failures
+    return doping_amount, total_doping_ratio
+
+def calculate_doping_group(doping_amount, total_doping_ratio, idx, group_vol, rate, vol):
+    """Fill the rows idx of one (Doping Rate(%), Doping Volume) group"""
+    if '/' in rate:
+        # Multiple dopings
+        doping_vols = [float(x) for x in vol.split('/')]
+        doping_ratios = [(float(x) / 100) for x in rate.split('/')]
+        amounts = [(ratio * group_vol) / volume for ratio, volume in zip(doping_ratios, doping_vols)]
+        doping_amount[idx] = ['/'.join(f"{float(x)}" for x in row) for row in zip(*amounts)]
+        total_doping_ratio[idx] = sum(doping_ratios)
+    else:
+        # Single doping
+        doping_ratios = float(rate) / 100
+        doping_amount[idx] = [str(x) for x in (doping_ratios * group_vol) / float(vol)]
+        total_doping_ratio[idx] = doping_ratios
+
+def calculate_amounts(data, errors='raise'):
+    """
+    Calculate amounts for all components, whole columns at a time
+
+    errors='collect' skips the rows that already have an 'Error' and records unusable doping rates there instead of raising.
+    """
+    data = initialize_amount_columns(data)
+    particle_vol = data['Particle Volume (nm^3)'].to_numpy(dtype=float)
+    particle_sa = data['Particle Surface Area (nm^2)'].to_numpy(dtype=float)
+    coating_vol = data['Coating Volume (nm^3)'].to_numpy(dtype=float)
+    shell_vol = data['Shell Volume (nm^3)'].to_numpy(dtype=float)
+    core_vol = data['Core Volume (nm^3)'].to_numpy(dtype=float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Calculate coating and shell amounts, 0 without the component
+        data['Amounts of Coating'] = np.where(coating_vol != 0, particle_sa / coating_vol, 0.0)
+        data['Amounts of Shell'] = np.where(shell_vol != 0, particle_sa / shell_vol, 0.0)
+
         # Calculate doping and core amounts
-        if row['Doping'] != '' and row['Doping Rate(%)'] != '':
-            doping_amount, total_doping_ratio = calculate_doping_amounts(
-                particle_vol, row['Doping Rate(%)'], row['Doping Volume (nm^3)'])
-            data.loc[idx, 'Amounts of Doping'] = doping_amount
-            data.loc[idx, 'Amounts of Core'] = calculate_core_amount(
-                particle_vol, row['Core Volume (nm^3)'], total_doping_ratio)
-        else:
-            data.loc[idx, 'Amounts of Core'] = calculate_core_amount(
-                particle_vol, row['Core Volume (nm^3)'])
-            data.loc[idx, 'Amounts of Doping'] = 0
-            
+        doped = ((data['Doping'] != '') & (data['Doping Rate(%)'] != '')).to_numpy()
+        if errors == 'collect' and 'Error' in data:
+            doped = doped & data['Error'].isna().to_numpy()
+        doping_amount = np.zeros(len(data), dtype=object)
+        total_doping_ratio = np.zeros(len(data))
+        if doped.any():
+            columns = calculate_doping_amount_columns(
+                particle_vol[doped],
+                data['Doping Rate(%)'].to_numpy()[doped],
+                data['Doping Volume (nm^3)'].to_numpy()[doped],
+                errors)
+            doping_amount[doped], total_doping_ratio[doped] = columns[:2]
+            if errors == 'collect':
+                if 'Error' not in data:
+                    data['Error'] = None
+                failures = np.full(len(data), None, dtype=object)
+                failures[doped] = columns[2]
+                failed = pd.Series(failures, index=data.index).notna()
+                data.loc[failed, 'Error'] = pd.Series(failures, index=data.index)[failed]
+        data['Amounts of Doping'] = doping_amount
+        data['Amounts of Core'] = ((1 - total_doping_ratio) * particle_vol) / core_vol
+
     return data
 
 def get_component_amounts(formula, amount):
@@ -0,0 +1,76 @@
+"""
+Applicability Domain
+
+Checks whether log SDEC FPs lie in the domain of the training set, the SDEC columns of data/x_train.csv.
+Both indexes are built once, a whole batch is then scored with a few array operations.
+
+kNN distance - mean Euclidean distance to the k nearest training fingerprints (KD-tree),
+               inside when it is not above the given quantile of the same distance within the training set
+leverage     - h = x (X^T X)^-1 x^T with an intercept column, inside when h <= 3 p / n (Williams plot warning leverage)
+
+ApplicabilityDomain.from_training_data().evaluate(fingerprints) -> DataFrame with kNN distance, Leverage and the flags.
+
+Created by Jaehyeon Park
+"""
+import numpy as np
+import pandas as pd
+
+from resources import load_table
+
+training_file = 'data/x_train.csv'
+
+
+class ApplicabilityDomain:
+    """
+    kNN distance and leverage domain of a set of training fingerprints.
+
+    Repeated fingerprints (one particle measured on several cells) are kept once.
+    k - neighbours averaged for the distance, distance_quantile - share of the training set inside the kNN domain,
+    leverage_factor - 3 for the usual h* = 3 p / n.
+    """
+    def __init__(self, fingerprints, k=5, distance_quantile=0.95, leverage_factor=3.0):
+        from scipy.spatial import cKDTree
+        train = np.unique(np.asarray(fingerprints, dtype=float), axis=0)
+        self.columns = list(fingerprints.columns) if hasattr(fingerprints, 'columns') else None
+        self.k = min(k, len(train) - 1)
+        self.tree = cKDTree(train)
+
+        # training distances leave every point out of its own neighbours
+        distances, _ = self.tree.query(train, k=self.k + 1)
+        self.distance_threshold = float(np.quantile(distances[:, 1:].mean(axis=1), distance_quantile))
+
+        design = np.hstack([np.ones((len(train), 1)), train])
+        # constant orbitals (7s) make X^T X singular, the pseudo inverse gives the same leverages
+        self.hat_core = np.linalg.pinv(design.T @ design)
+        self.leverage_threshold = leverage_factor * design.shape[1] / len(train)
+
+    @classmethod
+    def from_training_data(cls, orbitals=None, **kwargs):
+        """Domain of the SDEC part of data/x_train.csv, orbitals are the columns to keep (default every non cell column)"""
+        x_train = load_table(training_file)
+        if orbitals is None:
+            orbitals = [col for col in x_train.columns if not col.startswith(('Cell-', 'Unnamed'))]
+        return cls(x_train[list(orbitals)], **kwargs)
+
+    def knn_distance(self, fingerprints):
+        """Mean distance of every fingerprint to its k nearest training fingerprints"""
+        distances, _ = self.tree.query(fingerprints, k=self.k)
+        return distances.reshape(len(fingerprints), -1).mean(axis=1)
+
+    def leverage(self, fingerprints):
+        """Leverage of every fingerprint against the training design matrix"""
+        design = np.hstack([np.ones((len(fingerprints), 1)), fingerprints])
+        return np.einsum('ij,jk,ik->i', design, self.hat_core, design)
+
+    def evaluate(self, fingerprints):
+        """kNN distance, Leverage and their In domain flags, one row per fingerprint"""
+        if self.columns is not None and hasattr(fingerprints, 'columns'):
+            fingerprints = fingerprints[self.columns]
+        fingerprints = np.asarray(fingerprints, dtype=float).reshape(-1, self.tree.m)
+        distance = self.knn_distance(fingerprints)
+        leverage = self.leverage(fingerprints)
+        in_knn = distance <= self.distance_threshold
+        in_leverage = leverage <= self.leverage_threshold
+        return pd.DataFrame({'kNN distance': distance, 'Leverage': leverage,
+                             'In kNN domain': in_knn, 'In leverage domain': in_leverage,
+                             'In domain': in_knn & in_leverage})
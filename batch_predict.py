@@ -0,0 +1,162 @@
+"""
+Batch prediction from a file
+
+Reads a CSV or Parquet table of nanoparticles (Core, Shell, Doping, Doping Rate(%), Coating, Diameter(nm))
+in chunks of --chunk-size rows, scores each chunk with one batched Predictor call and appends the
+predictions to the output CSV or Parquet before reading the next chunk, so memory stays bounded
+by the chunk size and not by the size of the input.
+
+python batch_predict.py particles.csv predictions.csv --chunk-size 5000
+python batch_predict.py particles.parquet predictions.parquet --errors collect
+python batch_predict.py particles.csv predictions.npy                 # N x 110 float32 matrix, see matrix_output
+
+The output has the layout of predict_batch: one row per (Particle, Cell-identification),
+Particle is the row number in the input file. --layout matrix (implied by .npy) writes one
+float32 row per particle instead, with the cell and tissue names once in a .meta.json file. Parquet needs pyarrow.
+
+Created by Jaehyeon Park
+"""
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+
+from prediction import Predictor, model_folder, particle_columns
+from matrix_output import MatrixWriter
+
+text_columns = ['Core', 'Shell', 'Doping', 'Doping Rate(%)', 'Coating']
+
+
+def is_parquet(path):
+    return path.lower().endswith(('.parquet', '.pq'))
+
+
+def read_chunks(path, chunk_size):
+    """Yield DataFrames of at most chunk_size input rows, indexed by their row number in the file"""
+    if is_parquet(path):
+        import pyarrow.parquet as pq
+        start = 0
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            chunk = batch.to_pandas()
+            chunk.index = pd.RangeIndex(start, start + len(chunk))
+            start += len(chunk)
+            yield chunk
+    else:
+        # formulas and rates such as '1/2' stay text, only the diameter is parsed later
+        yield from pd.read_csv(path, chunksize=chunk_size, dtype={col: str for col in text_columns})
+
+
+def count_rows(path):
+    """Number of nanoparticles in the input, read without keeping the file in memory"""
+    if is_parquet(path):
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    return sum(len(chunk) for chunk in pd.read_csv(path, usecols=[0], chunksize=100000))
+
+
+def check_columns(chunk, path):
+    """Add the optional columns missing from the input, Core and Diameter(nm) are required"""
+    ## WARNING MESSAGE
+    missing = [col for col in ['Core', 'Diameter(nm)'] if col not in chunk]
+    if missing:
+        print(f"Input error: {path} has no {', '.join(missing)} column")
+        sys.exit(1)
+    for col in particle_columns:
+        if col not in chunk:
+            chunk[col] = ''
+    return chunk
+
+
+class PredictionWriter:
+    """Append prediction chunks to a CSV or Parquet file, the file is replaced when the writer opens"""
+    def __init__(self, path):
+        self.path = path
+        self.parquet = is_parquet(path)
+        self.writer = None
+        self.rows = 0
+        if os.path.exists(path):
+            os.remove(path)
+
+    def write(self, result):
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if 'Error' in result:
+                result = result.assign(Error=result['Error'].map(lambda error: None if error is None else error['message']))
+            table = pa.Table.from_pandas(result, preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema)
+            self.writer.write_table(table)
+        else:
+            if 'Error' in result:
+                result = result.assign(Error=result['Error'].map(lambda error: '' if error is None else error['message']))
+            result.to_csv(self.path, mode='a', header=self.rows == 0, index=False)
+        self.rows += len(result)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def predict_file(input_path, output_path, predictor, chunk_size=1000, errors='exit', verbose=True, layout='long',
+                 cells=None, tissues=None):
+    """Score input_path chunk by chunk into output_path, returns the number of particles read"""
+    if layout == 'matrix':
+        writer = MatrixWriter(output_path, count_rows(input_path), predictor.cell_metadata(cells, tissues))
+    else:
+        writer = PredictionWriter(output_path)
+    particles = 0
+    start = time.perf_counter()
+    try:
+        for chunk in read_chunks(input_path, chunk_size):
+            chunk = check_columns(chunk, input_path)
+            if layout != 'matrix':
+                writer.write(predictor.predict_batch(chunk, errors=errors, cells=cells, tissues=tissues))
+            elif errors == 'collect':
+                prediction, chunk_errors = predictor.predict_with_errors(chunk, cells, tissues)
+                writer.write(prediction, chunk.index, chunk_errors)
+            else:
+                writer.write(predictor.predict_matrix(chunk, cells, tissues), chunk.index)
+            particles += len(chunk)
+            if verbose:
+                elapsed = time.perf_counter() - start
+                print(f"{particles} particles scored, {particles / elapsed:.1f} particles/s")
+    finally:
+        writer.close()
+    return particles
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NanoToxRadar batch prediction from a CSV or Parquet file')
+    parser.add_argument('input', help='CSV or Parquet table of nanoparticles')
+    parser.add_argument('output', help='CSV or Parquet file for the predictions')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='nanoparticles scored per batch')
+    parser.add_argument('--errors', choices=['exit', 'collect'], default='exit',
+                        help='stop at the first bad nanoparticle, or write its error and keep going')
+    parser.add_argument('--layout', choices=['long', 'matrix'], default=None,
+                        help='one row per (particle, cell), or one float32 row per particle; .npy outputs are always matrix')
+    parser.add_argument('--cells', nargs='+', default=None, help='score only these cell lines, e.g. A549 HepG2')
+    parser.add_argument('--tissues', nargs='+', default=None, help='score only the cells of these tissues, e.g. lung')
+    parser.add_argument('--n-jobs', type=int, default=1, help='processes computing component volumes, -1 for every CPU')
+    parser.add_argument('--model-folder', default=model_folder)
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args()
+
+    layout = args.layout or ('matrix' if args.output.lower().endswith('.npy') else 'long')
+    predictor = Predictor(args.model_folder, n_jobs=args.n_jobs)
+    ## WARNING MESSAGE
+    try:
+        predictor.cells.select(args.cells, args.tissues)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    particles = predict_file(args.input, args.output, predictor, args.chunk_size, args.errors, not args.quiet, layout,
+                             args.cells, args.tissues)
+    print(f"predictions of {particles} particles have been saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
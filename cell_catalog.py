@@ -0,0 +1,108 @@
+"""
+Cell Catalog
+
+The 110 cell types of the model indexed once at load time: cell id -> tissue, one-hot column and design row.
+
+CellCatalog.select(cells=, tissues=) - columns of predict_matrix for a subset of cell lines and / or tissues,
+names are matched without case and surrounding spaces, e.g. select(cells=['A549', 'HepG2']) or select(tissues=['lung']).
+
+Created by Jaehyeon Park
+"""
+import numpy as np
+import pandas as pd
+
+from resources import load_table
+
+tissue_prefix = 'Cell-tissue-organ-origin_'
+
+
+def cell_tissue_table(cell_info):
+    """Pair every cell identification column with its tissue column"""
+    cell_id = [col for col in cell_info.columns if 'Cell-identification' in col]
+    cell_tissue = [col for col in cell_info.columns if 'Cell-tissue' in col]
+
+    # every row of cell_info marks exactly one cell and one tissue with 1
+    id_flags = cell_info[cell_id].to_numpy() == 1
+    tissue_flags = cell_info[cell_tissue].to_numpy() == 1
+    if not ((id_flags.sum(axis=1) == 1).all() and (tissue_flags.sum(axis=1) == 1).all()):
+        raise ValueError("every row of the cell table needs exactly one Cell-identification and one Cell-tissue")
+    return pd.DataFrame({'Cell-identification': np.array(cell_id)[id_flags.argmax(axis=1)],
+                         'Cell-tissue': np.array(cell_tissue)[tissue_flags.argmax(axis=1)]})
+
+
+def name_key(name):
+    return str(name).strip().lower()
+
+
+class CellCatalog:
+    """
+    Cell types of the model in the order of the rows of cell_type, the one-hot design rows.
+
+    cell_id - Cell-identification column names, cells - their short names ('A549'),
+    tissues - lower case tissue of every cell, nest_order - (tissue, cell_id, column) in the order of the cell table
+    """
+    def __init__(self, cell_type, cell_info):
+        self.cell_type = cell_type
+        self.cell_info = cell_info
+        self.cell_table = cell_tissue_table(cell_info)
+
+        # cell_type rows follow the order of the Cell-identification columns
+        self.cell_id = [col for col in cell_info.columns if 'Cell-identification' in col][:len(cell_type)]
+        self.cells = [cell.split('_')[-1] for cell in self.cell_id]
+        tissue = self.cell_table.set_index('Cell-identification')['Cell-tissue']
+        self.cell_tissue = [tissue[cell].replace(tissue_prefix, '') for cell in self.cell_id]
+        self.tissues = [cell_tissue.lower() for cell_tissue in self.cell_tissue]
+
+        self.column = {cell: i for i, cell in enumerate(self.cell_id)}
+        self.nest_order = [(cell_tissue.replace(tissue_prefix, ''), cell_id, self.column[cell_id])
+                           for cell_id, cell_tissue in zip(self.cell_table['Cell-identification'], self.cell_table['Cell-tissue'])
+                           if cell_id in self.column]
+
+        self.columns_by_cell = {}
+        for i, (cell_id, cell) in enumerate(zip(self.cell_id, self.cells)):
+            self.columns_by_cell.setdefault(name_key(cell), i)
+            self.columns_by_cell.setdefault(name_key(cell_id), i)
+        self.columns_by_tissue = {}
+        for i, cell_tissue in enumerate(self.tissues):
+            self.columns_by_tissue.setdefault(name_key(cell_tissue), []).append(i)
+
+    @classmethod
+    def from_csv(cls):
+        return cls(load_table('cell_type_test_data.csv'), load_table('cell_all_info_test.csv'))
+
+    def __len__(self):
+        return len(self.cell_id)
+
+    def select(self, cells=None, tissues=None):
+        """
+        Columns of the requested cells, in catalog order.
+
+        cells and tissues are names or lists of names, a cell is kept when it is listed in cells or its tissue in tissues.
+        Without both every column is returned. Unknown names raise ValueError.
+        """
+        if cells is None and tissues is None:
+            return np.arange(len(self))
+        cells = [cells] if isinstance(cells, str) else list(cells or [])
+        tissues = [tissues] if isinstance(tissues, str) else list(tissues or [])
+
+        ## WARNING MESSAGE
+        unknown = [cell for cell in cells if name_key(cell) not in self.columns_by_cell]
+        unknown += [cell_tissue for cell_tissue in tissues if name_key(cell_tissue) not in self.columns_by_tissue]
+        if unknown:
+            raise ValueError(f"Unknown cell or tissue: {', '.join(map(str, unknown))}")
+
+        selected = {self.columns_by_cell[name_key(cell)] for cell in cells}
+        for cell_tissue in tissues:
+            selected.update(self.columns_by_tissue[name_key(cell_tissue)])
+        return np.array(sorted(selected), dtype=int)
+
+    def design_rows(self, selection=None):
+        """One-hot cell type rows of the selected columns, ready for build_design_matrix"""
+        if selection is None:
+            return self.cell_type
+        return self.cell_type.iloc[selection].reset_index(drop=True)
+
+    def metadata(self, selection=None):
+        """Short cell names and tissues of the selected columns"""
+        selection = np.arange(len(self)) if selection is None else selection
+        return {'cells': [self.cells[i] for i in selection], 'tissues': [self.tissues[i] for i in selection]}
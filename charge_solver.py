@@ -0,0 +1,305 @@
+"""
+Charge Solver
+
+solve_charge_balance - find the oxidation states of a component without enumerating every charge combination.
+
+The volume calculator used to build itertools.product(*(combinations_with_replacement(...))) over every metal,
+which grows exponentially with the stoichiometry. The same choice is reached here with dynamic programming:
+for every metal a table of (atoms left, partial charge) -> lowest stability score,
+and across metals a table of partial charge -> lowest score of the remaining metals.
+
+The rules are the ones of the enumeration:
+1. combinations whose charge balances exactly are used first, otherwise the ones within +-2
+2. among them the lowest calculate_stability score wins
+3. ties go to the combination that came first in the enumeration order
+
+tests/test_charge_solver.py checks the solver against the enumeration on the formulas of the bundled volume lists.
+
+Created by Jaehyeon Park
+"""
+import statistics
+from fractions import Fraction
+from functools import lru_cache
+from itertools import product, combinations_with_replacement, islice
+from math import comb, lcm, prod
+
+from radii_collection import effective_ionic_radii
+from formula_utils import get_possible_charges, calculate_stability
+from formula_tokenizer import element_counts
+import instrumentation
+
+# Upper bound of equally scored combinations compared by their float score
+MAX_TIED_COMBINATIONS = 10000
+
+
+@lru_cache(maxsize=None)
+def possible_charges(element):
+    """Charges of an element in the effective ionic radii table, in table order"""
+    return tuple(get_possible_charges(element, effective_ionic_radii))
+
+
+def _suffix_tables(charges, n, costs):
+    """
+    tables[i][r] = {partial charge: lowest cost} of r atoms taking charges i.. of the list.
+    Atoms are placed in list order, like combinations_with_replacement does.
+    """
+    k = len(charges)
+    tables = [None] * (k + 1)
+    tables[k] = [{0: 0}] + [{} for _ in range(n)]
+    for i in range(k - 1, -1, -1):
+        table = [dict(tables[i + 1][0])]
+        for r in range(1, n + 1):
+            merged = dict(tables[i + 1][r])
+            for t, cost in table[r - 1].items():
+                t_new = t + charges[i]
+                cost_new = cost + costs[i]
+                if cost_new < merged.get(t_new, cost_new + 1):
+                    merged[t_new] = cost_new
+            table.append(merged)
+        tables[i] = table
+    return tables
+
+
+class _Metal:
+    """One element of the component with its charge list, atom count and DP tables"""
+    def __init__(self, element, count, charges, costs):
+        self.element = element
+        self.n = int(count)
+        self.charges = charges
+        self.costs = costs
+        self.tables = _suffix_tables(charges, self.n, costs)
+
+    def options(self, first=None):
+        """{total charge of this metal: lowest cost}, optionally with a forced first (lowest) charge index"""
+        if first is None:
+            return self.tables[0][self.n]
+        if self.n == 0:
+            return {}
+        return {self.charges[first] + t: self.costs[first] + cost
+                for t, cost in self.tables[first][self.n - 1].items()}
+
+    def completions(self, target, acc, rest, first=None):
+        """
+        Charges of this metal, in enumeration order, for which acc + own cost + rest(own total)
+        can still reach target, rest(total) is None when infeasible. Yields (charges, total, cost so far).
+        """
+        counts = [0] * len(self.charges)
+        start, r, t = 0, self.n, 0
+        if first is not None:
+            start, r, t = first, self.n - 1, self.charges[first]
+            counts[first] = 1
+            acc += self.costs[first]
+        yield from self._completions(start, r, t, acc, counts, target, rest)
+
+    def _completions(self, i, r, t, acc, counts, target, rest):
+        if i == len(self.charges):
+            if r == 0:
+                yield tuple(charge for charge, c in zip(self.charges, counts) for _ in range(c)), t, acc
+            return
+        # more atoms on the lower charges first is the combinations_with_replacement order
+        for c in range(r, -1, -1):
+            t_new = t + c * self.charges[i]
+            acc_new = acc + c * self.costs[i]
+            best = None
+            for t_rest, cost in self.tables[i + 1][r - c].items():
+                rest_cost = rest(t_new + t_rest)
+                if rest_cost is not None and (best is None or cost + rest_cost < best):
+                    best = cost + rest_cost
+            if best is not None and acc_new + best == target:
+                counts[i] += c
+                yield from self._completions(i + 1, r - c, t_new, acc_new, counts, target, rest)
+                counts[i] -= c
+
+
+def _accepted_totals(totals, anion_charge):
+    """Exact charge balance first, otherwise everything within +-2"""
+    exact = {total for total in totals if total + anion_charge == 0}
+    if exact:
+        return exact
+    return {total for total in totals if abs(total + anion_charge) <= 2}
+
+
+def _reachable(metals, firsts):
+    """Partial charge sets before every metal, firsts is a forced first index per metal or None"""
+    partial = [{0}]
+    for metal, first in zip(metals, firsts):
+        options = metal.options(first)
+        partial.append({s + t for s in partial[-1] for t in options})
+    return partial
+
+
+def _optimal_combinations(metals, accepted, firsts):
+    """Every lowest cost combination with its total in accepted, in enumeration order"""
+    partial = _reachable(metals, firsts)
+    remaining = [None] * (len(metals) + 1)
+    remaining[-1] = {s: 0 for s in partial[-1] if s in accepted}
+    for m in range(len(metals) - 1, -1, -1):
+        table = {}
+        for s in partial[m]:
+            for t, cost in metals[m].options(firsts[m]).items():
+                rest = remaining[m + 1].get(s + t)
+                if rest is not None and cost + rest < table.get(s, cost + rest + 1):
+                    table[s] = cost + rest
+        remaining[m] = table
+    if 0 not in remaining[0]:
+        return
+    optimum = remaining[0][0]
+
+    def combine(m, s, acc, combo):
+        if m == len(metals):
+            yield tuple(combo)
+            return
+        rest = lambda total: remaining[m + 1].get(s + total)
+        for charges, t, acc_metal in metals[m].completions(optimum, acc, rest, firsts[m]):
+            yield from combine(m + 1, s + t, acc_metal, combo + [charges])
+
+    yield from combine(0, 0, 0, [])
+
+
+def _integer_costs(metals, total_required_charge):
+    """
+    Integer per atom costs proportional to count * |charge - ideal charge per atom| of calculate_stability,
+    so scores compare exactly.
+    """
+    counts = {elem: Fraction(count) for elem, count in metals.items()}
+    ideal = Fraction(total_required_charge) / sum(counts.values())
+    scale = ideal.denominator * lcm(*(count.denominator for count in counts.values()))
+    return {elem: [int(count * scale * abs(charge - ideal)) for charge in possible_charges(elem)]
+            for elem, count in counts.items()}
+
+
+def enumeration_size(metals):
+    """Number of combinations the enumeration builds for metals"""
+    return prod(comb(int(count) + len(possible_charges(elem)) - 1, int(count)) for elem, count in metals.items())
+
+
+def _record(metals, enumerated, kept):
+    if instrumentation.enabled:
+        instrumentation.charge_combinations(enumeration_size(metals), enumerated, kept)
+
+
+def solve_charge_balance(metals, anion_charge=0, total_required_charge=0, key='stability'):
+    """
+    Oxidation states of every atom of metals ({element: count}) balancing anion_charge.
+
+    key='stability' picks the lowest calculate_stability score like the enumeration did,
+    with a single element only its first charge is scored (calculate_stability_single).
+    key='first_charge' picks by the balance and spread of the first charge of each element.
+
+    Returns a tuple with one tuple of charges per element in the order of metals,
+    or None when no combination is within +-2 of the balance.
+    """
+    if not metals or not any(int(count) for count in metals.values()):
+        # fractional counts below 1 leave no whole atom to charge
+        return None
+    zero_costs = {elem: [0] * len(possible_charges(elem)) for elem in metals}
+    single = key == 'stability' and len(metals) == 1
+
+    if key == 'stability' and not single:
+        costs = _integer_costs(metals, total_required_charge)
+    else:
+        costs = zero_costs
+    solver_metals = [_Metal(elem, count, possible_charges(elem), costs[elem]) for elem, count in metals.items()]
+    accepted = _accepted_totals(_reachable(solver_metals, [None] * len(solver_metals))[-1], anion_charge)
+    if not accepted:
+        _record(metals, 0, 0)
+        return None
+
+    if key == 'stability' and not single:
+        # scores equal in exact arithmetic can differ in the last bit of the float score,
+        # so ties are settled by calculate_stability itself like the enumeration did
+        optimal = list(islice(_optimal_combinations(solver_metals, accepted, [None] * len(solver_metals)),
+                              MAX_TIED_COMBINATIONS))
+        _record(metals, len(optimal), len(optimal))
+        return min(optimal, key=lambda x: calculate_stability(x, metals, total_required_charge))
+
+    if single:
+        # calculate_stability_single only scores the first (lowest index) charge
+        metal = solver_metals[0]
+        scored = sorted((calculate_stability((charge,), metals, total_required_charge), i)
+                        for i, charge in enumerate(metal.charges))
+        for tried, (_, first) in enumerate(scored, 1):
+            if any(total in accepted for total in metal.options(first)):
+                _record(metals, tried, 1)
+                return next(_optimal_combinations(solver_metals, accepted, [first]))
+        _record(metals, len(scored), 0)
+        return None
+
+    if key == 'first_charge':
+        if any(metal.n == 0 for metal in solver_metals):
+            return None
+        best_key, combos, tried = None, [], 0
+        for firsts in product(*(range(len(metal.charges)) for metal in solver_metals)):
+            if not accepted & _reachable(solver_metals, list(firsts))[-1]:
+                continue
+            tried += 1
+            first_charges = [metal.charges[first] for metal, first in zip(solver_metals, firsts)]
+            first_key = (abs(round(sum(metals[elem] * charge for elem, charge in zip(metals, first_charges)), 2)),
+                         statistics.stdev(first_charges) if len(set(first_charges)) > 1 else 0)
+            if best_key is None or first_key < best_key:
+                best_key, combos = first_key, []
+            if first_key == best_key:
+                combos.append(next(_optimal_combinations(solver_metals, accepted, list(firsts))))
+        _record(metals, tried, len(combos))
+        if not combos:
+            return None
+        return min(combos, key=lambda combo: [[metal.charges.index(charge) for charge in charges]
+                                              for metal, charges in zip(solver_metals, combo)])
+
+    raise ValueError(f"Unknown key: {key}")
+
+
+"""
+Reference enumeration, kept to check the solver
+"""
+def enumerate_charge_balance(metals, anion_charge=0, total_required_charge=0, key='stability'):
+    """The itertools enumeration the volume calculator used, same arguments and result as solve_charge_balance"""
+    charge_combinations = product(*(combinations_with_replacement(possible_charges(metal), int(metals[metal]))
+                                    for metal in metals))
+    exact_combinations = []
+    approx_combinations = []
+    for combo in charge_combinations:
+        total_charge = sum(sum(metal_combo) for metal_combo in combo)
+        if total_charge + anion_charge == 0:
+            exact_combinations.append(combo)
+        elif abs(total_charge + anion_charge) <= 2:
+            approx_combinations.append(combo)
+    valid_combinations = exact_combinations or approx_combinations
+    if not valid_combinations:
+        return None
+
+    if key == 'first_charge':
+        return min(valid_combinations, key=lambda x:
+                   (abs(round(sum(metals[elem] * charge[0] for elem, charge in zip(metals.keys(), x)), 2)),
+                    statistics.stdev([charge[0] for charge in x]) if len(set(charge[0] for charge in x)) > 1 else 0))
+    if len(metals) == 1:
+        return (min((combo[0] for combo in valid_combinations),
+                    key=lambda x: calculate_stability(x, metals, total_required_charge)),)
+    return min(valid_combinations, key=lambda x: calculate_stability(x, metals, total_required_charge))
+
+
+def _bundled_formulas():
+    """Every formula of the bundled volume lists, multi component entries split on '/'"""
+    from resources import load_table
+    formulas = set()
+    for file_name, column in [('core_volume_list.csv', 'Core'), ('shell_volume_list.csv', 'Shell'),
+                              ('doping_volume_list.csv', 'Doping'), ('coating_volume_list.csv', 'mf')]:
+        for entry in load_table(file_name)[column].dropna():
+            formulas.update(sub.strip() for sub in str(entry).split('/') if sub.strip())
+    return sorted(formulas)
+
+
+def _balance_problems(formula):
+    """The (metals, anion_charge, total_required_charge, key) problems the volume calculator solves for formula"""
+    composition = dict(element_counts(formula))
+    if any(not count.is_integer() for count in composition.values()):
+        return []
+    if 'O' in composition:
+        oxygen_charge = -2 * composition['O']
+        metals = {elem: int(count) for elem, count in composition.items() if elem != 'O'}
+        return [(metals, oxygen_charge, abs(oxygen_charge), 'stability')] if metals else []
+    if len(composition) >= 2:
+        return [(composition, 0, 0, 'stability'),
+                ({elem: int(count) for elem, count in composition.items()}, 0, 0, 'first_charge')]
+    return []
+
@@ -5,9 +5,29 @@ must_x_fold: the data is included mandatorily in training dataset
 
 This cross validation worked with only training datasets
 
+train_params
+learning_rate, batch_size, epochs - as before
+trainer     - 'loader' trains through a DataLoader over a TensorDataset (default),
+              'index' shuffles indexes over the preallocated fold tensors and gathers every batch into a reused buffer
+patience    - stop a fold when the stopping loss has not improved for patience epochs and restore the best weights
+              (default None, every epoch is trained)
+validation_fraction - with patience, share of the training indexes of the fold held out for the stopping loss (default 0.1),
+              the validation fold stays unseen until the metrics are computed
+min_delta   - improvement of the stopping loss that resets patience (default 0)
+bf16        - bfloat16 autocast of the forward pass on CPU (default False)
+compile     - torch.compile the model (default False)
+num_threads - intra-op threads of every fold, default every CPU divided by n_jobs
+seed        - torch seed of the fold is seed + fold number, so parallel and serial runs train the same models
+
+n_jobs: folds trained concurrently in a process pool (CPU only), each with num_threads intra-op threads.
+splits: precomputed (train indexes, validation indexes) of every fold, e.g. shared by the trials of hyperparameter_search.
+
 Created by Lukas Park (Jaehyeon Park)
 """
 
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -21,15 +41,174 @@ from sklearn.metrics import (mean_absolute_error,
                              root_mean_squared_error,
                              r2_score)
 
-def modified_dl_cross_validation(model_class, 
-                              model_params, 
-                              x_train, y_train, 
+from traditional_machine_learning_cross_validation import resolve_n_jobs
+
+# tensors shared with the fold workers, set once per process
+_fold_data = {}
+
+
+def loader_batches(x, y, batch_size, generator=None):
+    """Training batches of a DataLoader over a TensorDataset"""
+    loader = torch.utils.data.DataLoader(
+        torch.utils.data.TensorDataset(x, y),
+        batch_size=batch_size,
+        shuffle=True,
+        generator=generator
+    )
+    yield from loader
+
+
+def index_batches(x, y, batch_size, buffers, generator=None):
+    """Training batches gathered by a shuffled index into the preallocated buffers (x buffer, y buffer)"""
+    order = torch.randperm(len(x), generator=generator).to(x.device)
+    buffer_x, buffer_y = buffers
+    for start in range(0, len(x), batch_size):
+        idx = order[start:start + batch_size]
+        batch_x = buffer_x[:len(idx)]
+        batch_y = buffer_y[:len(idx)]
+        torch.index_select(x, 0, idx, out=batch_x)
+        torch.index_select(y, 0, idx, out=batch_y)
+        yield batch_x, batch_y
+
+
+def predict(model, x, batch_size, bf16=False):
+    """Predictions of model for x in batches, in eval mode"""
+    model.eval()
+    predictions = []
+    with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=bf16):
+        for start in range(0, len(x), batch_size):
+            predictions.append(model(x[start:start + batch_size]).float().cpu())
+    return torch.cat(predictions)
+
+
+def train_fold(model_class, model_params, x_fold_train, y_fold_train, x_fold_val, y_fold_val,
+               train_params, device=None, fold_number=1, x_fold_stop=None, y_fold_stop=None):
+    """
+    Train one fold, returns (validation predictions, best epoch or None).
+
+    With patience the loss on (x_fold_stop, y_fold_stop) is tracked every epoch
+    and the weights of the epoch with the lowest loss are restored.
+    """
+    seed = train_params.get('seed')
+    generator = None
+    if seed is not None:
+        torch.manual_seed(seed + fold_number)
+        generator = torch.Generator().manual_seed(seed + fold_number)
+
+    model = model_class(**model_params).to(device)
+    optimizer = optim.Adam(model.parameters(), lr=train_params['learning_rate'])
+    criterion = nn.MSELoss()
+
+    batch_size = train_params['batch_size']
+    trainer = train_params.get('trainer', 'loader')
+    patience = train_params.get('patience')
+    min_delta = train_params.get('min_delta', 0.0)
+    bf16 = train_params.get('bf16', False)
+    # the compiled module shares its parameters with model, the checkpoints are taken from model
+    forward = torch.compile(model) if train_params.get('compile', False) else model
+
+    if trainer == 'index':
+        buffers = (torch.empty((batch_size,) + x_fold_train.shape[1:], dtype=x_fold_train.dtype, device=x_fold_train.device),
+                   torch.empty((batch_size,) + y_fold_train.shape[1:], dtype=y_fold_train.dtype, device=y_fold_train.device))
+    elif trainer != 'loader':
+        ## WARNING MESSAGE
+        raise ValueError(f"Unknown trainer: {trainer}, use 'loader' or 'index'")
+    if patience is not None and x_fold_stop is None:
+        ## WARNING MESSAGE
+        raise ValueError("patience needs a stopping set apart from the validation fold (x_fold_stop, y_fold_stop)")
+
+    best_loss, best_state, best_epoch, bad_epochs = None, None, None, 0
+
+    # Training
+    for epoch in range(train_params['epochs']):
+        if trainer == 'index':
+            batches = index_batches(x_fold_train, y_fold_train, batch_size, buffers, generator)
+        else:
+            batches = loader_batches(x_fold_train, y_fold_train, batch_size, generator)
+        forward.train()
+        for batch_x, batch_y in batches:
+            optimizer.zero_grad()
+            with torch.autocast('cpu', dtype=torch.bfloat16, enabled=bf16):
+                outputs = forward(batch_x)
+            loss = criterion(outputs.float(), batch_y)
+            loss.backward()
+            optimizer.step()
+
+        if (epoch + 1) % 100 == 0:
+            print(f"    Epoch {epoch + 1}/{train_params['epochs']}")
+
+        # EARLY STOPPING
+        if patience is not None:
+            stop_loss = criterion(predict(forward, x_fold_stop, batch_size, bf16), y_fold_stop.float().cpu()).item()
+            if best_loss is None or stop_loss < best_loss - min_delta:
+                best_loss, best_epoch, bad_epochs = stop_loss, epoch + 1, 0
+                best_state = {name: value.detach().clone() for name, value in model.state_dict().items()}
+            else:
+                bad_epochs += 1
+                if bad_epochs >= patience:
+                    print(f"    Early stopping at epoch {epoch + 1}, best epoch {best_epoch}")
+                    break
+
+    if best_state is not None:
+        model.load_state_dict(best_state)
+    return predict(forward, x_fold_val, batch_size, bf16).numpy(), best_epoch
+
+
+def _set_fold_data(model_class, model_params, x, y, must_x, must_y, train_params, device, num_threads):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    _fold_data.update(model_class=model_class, model_params=model_params, x=x, y=y, must_x=must_x, must_y=must_y,
+                      train_params=train_params, device=device)
+
+
+def stopping_split(train_idx, fraction, seed):
+    """(training indexes, stopping indexes) of a fold, a seeded random fraction of train_idx is held out"""
+    train_idx = np.asarray(train_idx)
+    n_stop = min(max(1, int(round(len(train_idx) * fraction))), len(train_idx) - 1)
+    order = np.random.default_rng(seed).permutation(len(train_idx))
+    return np.sort(train_idx[order[n_stop:]]), np.sort(train_idx[order[:n_stop]])
+
+
+def fit_fold(task):
+    """Validation predictions, targets and best epoch of one fold, task is (fold number, train indexes, validation indexes)"""
+    fold_number, train_idx, val_idx = task
+    data = _fold_data
+    train_params = data['train_params']
+    x_fold_stop = y_fold_stop = None
+    if train_params.get('patience') is not None:
+        # early stopping on the validation fold would bias its metrics, the stopping set comes from the training part
+        seed = train_params.get('seed')
+        train_idx, stop_idx = stopping_split(train_idx, train_params.get('validation_fraction', 0.1),
+                                             (123 if seed is None else seed) + fold_number)
+        stop_idx = torch.as_tensor(stop_idx, device=data['x'].device)
+        x_fold_stop = data['x'][stop_idx]
+        y_fold_stop = data['y'][stop_idx]
+    train_idx = torch.as_tensor(train_idx, device=data['x'].device)
+    val_idx = torch.as_tensor(val_idx, device=data['x'].device)
+
+    # one training tensor per fold, the batches are taken from it
+    x_fold_train = torch.cat([data['x'][train_idx], data['must_x']])
+    y_fold_train = torch.cat([data['y'][train_idx], data['must_y']])
+    x_fold_val = data['x'][val_idx]
+    y_fold_val = data['y'][val_idx]
+
+    val_pred, best_epoch = train_fold(data['model_class'], data['model_params'], x_fold_train, y_fold_train,
+                                      x_fold_val, y_fold_val, train_params, data['device'], fold_number,
+                                      x_fold_stop, y_fold_stop)
+    return val_pred, y_fold_val.cpu().numpy(), best_epoch
+
+
+def modified_dl_cross_validation(model_class,
+                              model_params,
+                              x_train, y_train,
                               must_x_fold,
-                              must_y_fold, 
-                              train_params, 
-                              fold=3, 
-                              device=None):
-    
+                              must_y_fold,
+                              train_params,
+                              fold=3,
+                              device=None,
+                              n_jobs=1,
+                              splits=None):
+
     cv_results = {
         'Fold': [],
         'CV_MSE': [],
@@ -38,7 +217,9 @@ def modified_dl_cross_validation(model_class,
         'CV_MAPE': [],
         'CV_MAE':[]
     }
-    
+    if train_params.get('patience') is not None:
+        cv_results['Best_Epoch'] = []
+
     final_results = {
         'CV_MSE_mean': None,
         'CV_MSE_std': None,
@@ -51,102 +232,74 @@ def modified_dl_cross_validation(model_class,
         'CV_MAE_mean': None,
         'CV_MAE_std': None
     }
-    
-    
+
+
     # Convert data to PyTorch tensors
     x_train_tensor = torch.FloatTensor(x_train.astype(float).values).to(device)
     y_train_tensor = torch.FloatTensor(y_train.values).to(device)
     must_x_tensor = torch.FloatTensor(must_x_fold.astype(float).values).to(device)
     must_y_tensor = torch.FloatTensor(must_y_fold.values).to(device)
-    
-    kf = KFold(n_splits=fold, shuffle=True, random_state=123)
-    
+
+    if splits is None:
+        splits = KFold(n_splits=fold, shuffle=True, random_state=123).split(x_train)
+    tasks = [(fold_idx + 1, train_idx, val_idx) for fold_idx, (train_idx, val_idx) in enumerate(splits)]
+
     fold_metrics = {
         'mse': [], 'rmse': [], 'r2': [], 'mape': [], 'mae': []
     }
-    
-    for fold_idx, (train_idx, val_idx) in enumerate(kf.split(x_train)):
-        print(f"Processing Fold {fold_idx + 1}/{fold}")
-        
-        model = model_class(**model_params).to(device)
-        optimizer = optim.Adam(model.parameters(), lr=train_params['learning_rate'])
-        criterion = nn.MSELoss()
-        
-        x_fold_train = x_train_tensor[train_idx]
-        y_fold_train = y_train_tensor[train_idx]
-        x_fold_val = x_train_tensor[val_idx]
-        y_fold_val = y_train_tensor[val_idx]
-        
-        x_fold_train = torch.cat([x_fold_train, must_x_tensor])
-        y_fold_train = torch.cat([y_fold_train, must_y_tensor])
-        
-        train_dataset = torch.utils.data.TensorDataset(x_fold_train, y_fold_train)
-        train_loader = torch.utils.data.DataLoader(
-            train_dataset,
-            batch_size=train_params['batch_size'],
-            shuffle=True
-        )
-        
-        val_dataset = torch.utils.data.TensorDataset(x_fold_val, y_fold_val)
-        val_loader = torch.utils.data.DataLoader(
-            val_dataset,
-            batch_size=train_params['batch_size'],
-            shuffle=False
-        )
-        
-        # Training
-        for epoch in range(train_params['epochs']):
-            model.train()
-            for batch_x, batch_y in train_loader:
-                optimizer.zero_grad()
-                outputs = model(batch_x)
-                loss = criterion(outputs, batch_y)
-                loss.backward()
-                optimizer.step()
-            
-            if (epoch + 1) % 100 == 0:
-                print(f"    Epoch {epoch + 1}/{train_params['epochs']}")
-        
-        # Calculate metrics
-        model.eval()
-        val_predictions = []
-        val_targets = []
-
-        with torch.no_grad():
-            for batch_x, batch_y in val_loader:
-                batch_pred = model(batch_x)
-                val_predictions.append(batch_pred.cpu())
-                val_targets.append(batch_y.cpu())
-            
-            val_pred = torch.cat(val_predictions).numpy()
-            y_fold_val_np = torch.cat(val_targets).numpy()
-            
-            mse = mean_squared_error(y_fold_val_np, val_pred)
-            rmse = np.sqrt(mse)
-            r2 = r2_score(y_fold_val_np, val_pred)
-            mape = mean_absolute_percentage_error(y_fold_val_np, val_pred)
-            mae = mean_absolute_error(y_fold_val_np, val_pred)
-            
-            fold_metrics['mse'].append(mse)
-            fold_metrics['rmse'].append(rmse)
-            fold_metrics['r2'].append(r2)
-            fold_metrics['mape'].append(mape)
-            fold_metrics['mae'].append(mae)
-            
-            cv_results['Fold'].append(fold_idx + 1)
-            cv_results['CV_MSE'].append(mse)
-            cv_results['CV_RMSE'].append(rmse)
-            cv_results['CV_R2'].append(r2)
-            cv_results['CV_MAPE'].append(mape)
-            cv_results['CV_MAE'].append(mae)
-    
+
+    n_jobs = min(resolve_n_jobs(n_jobs), len(tasks))
+    num_threads = train_params.get('num_threads') or (max(1, (os.cpu_count() or 1) // n_jobs) if n_jobs > 1 else None)
+    fold_data = (model_class, model_params, x_train_tensor, y_train_tensor, must_x_tensor, must_y_tensor,
+                 train_params, device)
+
+    if n_jobs == 1:
+        previous_threads = torch.get_num_threads()
+        _set_fold_data(*fold_data, num_threads)
+        try:
+            results = []
+            for task in tasks:
+                print(f"Processing Fold {task[0]}/{fold}")
+                results.append(fit_fold(task))
+        finally:
+            _fold_data.clear()
+            torch.set_num_threads(previous_threads)
+    else:
+        print(f"Processing {fold} folds on {n_jobs} processes with {num_threads} threads each")
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_set_fold_data,
+                                 initargs=fold_data + (num_threads,)) as executor:
+            results = list(executor.map(fit_fold, tasks))
+
+    # Calculate metrics
+    for (fold_number, _, _), (val_pred, y_fold_val_np, best_epoch) in zip(tasks, results):
+        mse = mean_squared_error(y_fold_val_np, val_pred)
+        rmse = np.sqrt(mse)
+        r2 = r2_score(y_fold_val_np, val_pred)
+        mape = mean_absolute_percentage_error(y_fold_val_np, val_pred)
+        mae = mean_absolute_error(y_fold_val_np, val_pred)
+
+        fold_metrics['mse'].append(mse)
+        fold_metrics['rmse'].append(rmse)
+        fold_metrics['r2'].append(r2)
+        fold_metrics['mape'].append(mape)
+        fold_metrics['mae'].append(mae)
+
+        cv_results['Fold'].append(fold_number)
+        cv_results['CV_MSE'].append(mse)
+        cv_results['CV_RMSE'].append(rmse)
+        cv_results['CV_R2'].append(r2)
+        cv_results['CV_MAPE'].append(mape)
+        cv_results['CV_MAE'].append(mae)
+        if 'Best_Epoch' in cv_results:
+            cv_results['Best_Epoch'].append(best_epoch)
+
     # Calculate final cross-validation results
     for metric in ['MSE', 'RMSE', 'R2', 'MAPE', 'MAE']:
         metric_lower = metric.lower()
         final_results[f'CV_{metric}_mean'] = np.mean(fold_metrics[metric_lower])
         final_results[f'CV_{metric}_std'] = np.std(fold_metrics[metric_lower])
-    
+
     cv_results_df = pd.DataFrame(cv_results)
     final_results_df = pd.DataFrame([final_results])
-    
-    return cv_results_df, final_results_df
\ No newline at end of file
+
+    return cv_results_df, final_results_df
@@ -0,0 +1,338 @@
+"""
+Hyperparameter search with successive halving on top of the must-include cross validation
+
+Every trial is one model type (objective) with sampled parameters, scored by modified_cross_validation or
+modified_dl_cross_validation at a budget (CatBoost iterations, XGBoost n_estimators, MLP epochs ...).
+Rung by rung the budget grows by eta and only the best 1/eta of the trials go on, so poor settings are pruned
+after a cheap run. The trials of a rung run in a process pool.
+
+The fold splits and the training matrices are prepared once and shared by every trial,
+every finished evaluation is appended to a JSON lines log, a search started again with the same log skips them.
+The log key covers the objective (model class, fixed parameters, seed, budget_param), the sampled parameters,
+the budget, fold, n_repeats and a sha256 of the training data, so a changed setup is evaluated again.
+Objectives without a budget_param are evaluated once and their record goes on to the later rungs.
+
+objectives = {'catboost': SklearnObjective(CatBoostRegressor, {'verbose': 0, 'random_seed': 0}, budget_param='iterations'),
+              'xgboost': SklearnObjective(XGBRegressor, {'random_state': 0}, budget_param='n_estimators'),
+              'mlp': TorchObjective(tox_mlp, {'input_size': 130}, {'learning_rate': 1e-3, 'batch_size': 256},
+                                    budget_param='epochs')}
+spaces = {'catboost': {'depth': [4, 6, 8], 'learning_rate': ('log', 0.01, 0.3)},
+          'xgboost': {'max_depth': (3, 10), 'learning_rate': ('log', 0.01, 0.3)},
+          'mlp': {'dropout': (0.0, 0.5), 'learning_rate': ('log', 1e-4, 1e-2)}}
+search = HyperparameterSearch(objectives, spaces, x_train, y_train, must_x_fold, must_y_fold,
+                              min_budget=100, max_budget=2700, eta=3, n_trials=27, n_jobs=4, log_path='search.jsonl')
+best = search.run()
+
+A space value is a list (choice), (low, high) (uniform, integers when both are int) or ('log', low, high).
+
+Created by Lukas Park (Jaehyeon Park)
+"""
+
+import hashlib
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import RepeatedKFold
+
+from traditional_machine_learning_cross_validation import modified_cross_validation, resolve_n_jobs
+
+# matrices and splits shared with the trial workers, set once per process
+_search_data = {}
+
+# train_params keys of modified_dl_cross_validation, other TorchObjective parameters go to the model
+train_param_names = ('learning_rate', 'batch_size', 'epochs', 'trainer', 'patience', 'validation_fraction',
+                     'min_delta', 'bf16', 'compile', 'num_threads', 'seed')
+
+
+class SklearnObjective:
+    """A scikit-learn style regressor scored by modified_cross_validation, budget_param receives the budget"""
+    def __init__(self, model_class, fixed_params=None, budget_param=None, seed=None):
+        self.model_class = model_class
+        self.fixed_params = fixed_params or {}
+        self.budget_param = budget_param
+        self.seed = seed
+
+    def identity(self):
+        """Everything of the objective that changes its results, part of the trial log key"""
+        return {'class': qualified_name(self.model_class), 'fixed_params': self.fixed_params,
+                'budget_param': self.budget_param, 'seed': self.seed}
+
+    def __call__(self, params, budget, data):
+        params = dict(self.fixed_params, **params)
+        if self.budget_param is not None:
+            params[self.budget_param] = budget
+        _, final_results = modified_cross_validation(self.model_class(**params), data['x'], data['y'],
+                                                     data['must_x'], data['must_y'], fold=data['fold'],
+                                                     n_repeats=data['n_repeats'], seed=self.seed,
+                                                     splits=data['splits'])
+        return final_results
+
+
+class TorchObjective:
+    """A torch model class scored by modified_dl_cross_validation, budget_param (default epochs) receives the budget"""
+    def __init__(self, model_class, model_params=None, train_params=None, budget_param='epochs', device=None):
+        self.model_class = model_class
+        self.model_params = model_params or {}
+        self.train_params = train_params or {}
+        self.budget_param = budget_param
+        self.device = device
+
+    def identity(self):
+        """Everything of the objective that changes its results, part of the trial log key"""
+        return {'class': qualified_name(self.model_class), 'model_params': self.model_params,
+                'train_params': self.train_params, 'budget_param': self.budget_param, 'device': str(self.device)}
+
+    def __call__(self, params, budget, data):
+        from deep_learning_cross_validation import modified_dl_cross_validation
+        model_params = dict(self.model_params, **{name: value for name, value in params.items()
+                                                  if name not in train_param_names})
+        train_params = dict(self.train_params, **{name: value for name, value in params.items()
+                                                  if name in train_param_names})
+        if self.budget_param in train_param_names:
+            train_params[self.budget_param] = budget
+        elif self.budget_param is not None:
+            model_params[self.budget_param] = budget
+        _, final_results = modified_dl_cross_validation(self.model_class, model_params,
+                                                        data['x_frame'], data['y_frame'],
+                                                        data['must_x_frame'], data['must_y_frame'],
+                                                        train_params, fold=data['fold'], device=self.device,
+                                                        splits=data['splits'])
+        return final_results.iloc[0].to_dict()
+
+
+def sample_value(space, rng):
+    """One value of a space entry, see the module docstring"""
+    if isinstance(space, list):
+        return space[rng.integers(len(space))]
+    if isinstance(space, tuple) and len(space) == 3 and space[0] == 'log':
+        return float(math.exp(rng.uniform(math.log(space[1]), math.log(space[2]))))
+    if isinstance(space, tuple) and len(space) == 2:
+        low, high = space
+        if isinstance(low, int) and isinstance(high, int):
+            return int(rng.integers(low, high + 1))
+        return float(rng.uniform(low, high))
+    return space
+
+
+def sample_trials(spaces, n_trials, seed=0):
+    """n_trials (objective, params) spread round robin over the objectives, the same seed gives the same trials"""
+    rng = np.random.default_rng(seed)
+    names = sorted(spaces)
+    trials = []
+    for i in range(n_trials):
+        name = names[i % len(names)]
+        trials.append((name, {param: sample_value(space, rng) for param, space in sorted(spaces[name].items())}))
+    return trials
+
+
+def plain(value):
+    """JSON friendly copy of value, NumPy scalars become Python numbers"""
+    if isinstance(value, dict):
+        return {str(key): plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [plain(item) for item in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def qualified_name(obj):
+    return f"{getattr(obj, '__module__', '')}.{getattr(obj, '__qualname__', type(obj).__qualname__)}"
+
+
+def objective_identity(objective):
+    """identity() of the objective, other callables are known by their class and budget_param"""
+    if hasattr(objective, 'identity'):
+        return objective.identity()
+    return {'class': qualified_name(objective), 'budget_param': getattr(objective, 'budget_param', None)}
+
+
+def data_fingerprint(data):
+    """sha256 of the fold setup and the training matrices of a search"""
+    digest = hashlib.sha256(json.dumps([data['fold'], data['n_repeats']]).encode())
+    for name in ['x', 'y', 'must_x', 'must_y']:
+        array = data[name]
+        if array is None:
+            digest.update(b'None')
+            continue
+        digest.update(f"{name}{array.shape}{array.dtype}".encode())
+        digest.update(np.ascontiguousarray(array).tobytes() if array.dtype != object else repr(array.tolist()).encode())
+    return digest.hexdigest()[:16]
+
+
+def trial_key(objective, params, budget, identity=None, fingerprint=None):
+    """Identity of one evaluation in the trial log, identity of the objective and fingerprint of the data"""
+    text = json.dumps([objective, plain(identity), plain(params), plain(budget), fingerprint],
+                      sort_keys=True, default=repr)
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+def _set_search_data(objectives, data):
+    _search_data.update(objectives=objectives, data=data)
+
+
+def evaluate_trial(task):
+    """(key, final results or None, error or None, seconds) of one (key, objective, params, budget) task"""
+    key, objective, params, budget = task
+    start = time.perf_counter()
+    try:
+        results = _search_data['objectives'][objective](params, budget, _search_data['data'])
+        return key, plain(results), None, time.perf_counter() - start
+    except Exception as e:
+        return key, None, f"{type(e).__name__}: {e}", time.perf_counter() - start
+
+
+class HyperparameterSearch:
+    """
+    Successive halving over sampled trials of several objectives.
+
+    min_budget, max_budget, eta - rung budgets are min_budget * eta ** rung up to max_budget,
+    after every rung the best len(trials) // eta (at least 1) go on.
+    metric - key of the final CV results to rank by, 'R2' metrics are maximized, the others minimized.
+    n_jobs - trials of a rung evaluated at once, every trial runs its folds serially.
+    log_path - JSON lines trial log, evaluations of the same objective, parameters, budget and data are not run again.
+    """
+    def __init__(self, objectives, spaces, x_train, y_train, must_x_fold, must_y_fold, fold=3, n_repeats=1,
+                 min_budget=1, max_budget=27, eta=3, n_trials=27, metric='CV_RMSE_mean', n_jobs=1,
+                 log_path=None, seed=0, trials=None):
+        ## WARNING MESSAGE
+        unknown = set(spaces) - set(objectives)
+        if unknown:
+            raise ValueError(f"No objective for the spaces: {', '.join(sorted(unknown))}")
+        if eta < 2 or min_budget <= 0 or max_budget < min_budget:
+            raise ValueError("Use eta >= 2 and 0 < min_budget <= max_budget")
+
+        self.objectives = objectives
+        self.trials = trials if trials is not None else sample_trials(spaces, n_trials, seed)
+        self.metric = metric
+        self.maximize = 'R2' in metric
+        self.eta = eta
+        self.n_jobs = resolve_n_jobs(n_jobs)
+        self.log_path = log_path
+        self.budgets = self.rung_budgets(min_budget, max_budget, eta)
+
+        # prepared once, every trial indexes the same matrices and folds
+        self.data = {'fold': fold, 'n_repeats': n_repeats,
+                     'splits': list(RepeatedKFold(n_splits=fold, n_repeats=n_repeats, random_state=123)
+                                    .split(np.arange(len(x_train)))),
+                     'x': np.asarray(x_train), 'y': np.asarray(y_train),
+                     'must_x': None if must_x_fold is None else np.asarray(must_x_fold),
+                     'must_y': None if must_y_fold is None else np.asarray(must_y_fold)}
+        if any(isinstance(objective, TorchObjective) for objective in objectives.values()):
+            self.data.update(x_frame=pd.DataFrame(x_train).astype(float), y_frame=pd.DataFrame(y_train),
+                             must_x_frame=pd.DataFrame(must_x_fold).astype(float), must_y_frame=pd.DataFrame(must_y_fold))
+        self.fingerprint = data_fingerprint(self.data)
+        self.identities = {name: objective_identity(objective) for name, objective in objectives.items()}
+        self.log = self.read_log()
+
+    @staticmethod
+    def rung_budgets(min_budget, max_budget, eta):
+        budgets = []
+        budget = min_budget
+        while budget < max_budget:
+            budgets.append(int(round(budget)) if isinstance(min_budget, int) else budget)
+            budget *= eta
+        budgets.append(max_budget)
+        return budgets
+
+    def read_log(self):
+        """{key: record} of the evaluations in the trial log"""
+        log = {}
+        if self.log_path and os.path.exists(self.log_path):
+            with open(self.log_path) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        record = json.loads(line)
+                        log[record['key']] = record
+        return log
+
+    def write_log(self, record):
+        self.log[record['key']] = record
+        if self.log_path:
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def score(self, record):
+        """Sort key of a record, failed evaluations last"""
+        value = None if record.get('results') is None else record['results'].get(self.metric)
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            return math.inf
+        return -value if self.maximize else value
+
+    def evaluate_rung(self, rung, survivors):
+        """Records of every (trial index, objective, params) of survivors at the budget of rung"""
+        budget = self.budgets[rung]
+        tasks, indexes, records = {}, {}, {}
+        for index, objective, params in survivors:
+            # without a budget_param every rung would train the same model, the first record goes on
+            trial_budget = budget if getattr(self.objectives[objective], 'budget_param', None) is not None else None
+            key = trial_key(objective, params, trial_budget, self.identities[objective], self.fingerprint)
+            if key in self.log:
+                records[index] = self.log[key]
+            else:
+                # trials that sampled the same parameters are evaluated once
+                tasks.setdefault(key, (key, objective, params, trial_budget))
+                indexes.setdefault(key, []).append(index)
+
+        def finish(result):
+            key, results, error, seconds = result
+            _, objective, params, budget = tasks[key]
+            record = {'key': key, 'trial': indexes[key][0], 'objective': objective, 'params': plain(params),
+                      'rung': rung, 'budget': plain(budget), 'data': self.fingerprint, 'results': results,
+                      'error': error, 'seconds': seconds, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+            for index in indexes[key]:
+                records[index] = record
+            # every evaluation is logged as soon as it is done, an interrupted rung resumes from there
+            self.write_log(record)
+
+        n_jobs = min(self.n_jobs, len(tasks))
+        if n_jobs <= 1:
+            _set_search_data(self.objectives, self.data)
+            try:
+                for task in tasks.values():
+                    finish(evaluate_trial(task))
+            finally:
+                _search_data.clear()
+        elif tasks:
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_set_search_data,
+                                     initargs=(self.objectives, self.data)) as executor:
+                for future in as_completed([executor.submit(evaluate_trial, task) for task in tasks.values()]):
+                    finish(future.result())
+        return records
+
+    def run(self, verbose=True):
+        """
+        Run every rung, returns the best record of the last rung:
+        objective, params, budget and the final CV results.
+        """
+        survivors = [(index, objective, params) for index, (objective, params) in enumerate(self.trials)]
+        best = None
+        for rung, budget in enumerate(self.budgets):
+            records = self.evaluate_rung(rung, survivors)
+            ranked = sorted(survivors, key=lambda survivor: (self.score(records[survivor[0]]), survivor[0]))
+            best = records[ranked[0][0]]
+            if verbose:
+                value = best['results'][self.metric] if best['results'] else None
+                print(f"Rung {rung + 1}/{len(self.budgets)}: budget {budget}, {len(survivors)} trials, "
+                      f"best {best['objective']} {best['params']} {self.metric} {value}")
+            if rung < len(self.budgets) - 1:
+                survivors = ranked[:max(1, len(survivors) // self.eta)]
+        return best
+
+    def history(self):
+        """Every logged evaluation on the data of this search as a DataFrame, one row per trial and rung"""
+        rows = []
+        for record in self.log.values():
+            if record.get('data') != self.fingerprint:
+                continue
+            row = {key: record[key] for key in ['trial', 'objective', 'rung', 'budget', 'seconds', 'error']}
+            row.update({f"param_{name}": value for name, value in record['params'].items()})
+            row.update(record['results'] or {})
+            rows.append(row)
+        return pd.DataFrame(rows)
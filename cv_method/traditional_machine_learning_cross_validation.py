@@ -5,11 +5,20 @@ must_x_fold: the data is included mandatorily in training dataset
 
 This cross validation worked with only training datasets
 
+n_repeats: repeated KFold rounds, every round reshuffles the split (the first round is the plain KFold split)
+n_jobs: folds of every round are trained in a process pool, -1 uses every CPU.
+seed: random_state of the model of every fold is seed + fold number, so a parallel run gives the serial results.
+splits: precomputed (train indexes, validation indexes) of every fold, e.g. shared by the trials of hyperparameter_search.
+The training frames are converted to NumPy once and every fold is taken from them by index.
+
 Created by Lukas Park (Jaehyeon Park)
 """
 
-import clone
-from sklearn.model_selection import KFold
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from sklearn.base import clone
+from sklearn.model_selection import RepeatedKFold
 from sklearn.metrics import (mean_absolute_error,
                              mean_absolute_percentage_error,
                              mean_squared_error,
@@ -18,9 +27,61 @@ from sklearn.metrics import (mean_absolute_error,
 import pandas as pd
 import numpy as np
 
+# arrays shared with the fold workers, set once per process
+_fold_data = {}
+
+
+def _set_fold_data(model, x, y, must_x, must_y, seed):
+    _fold_data.update(model=model, x=x, y=y, must_x=must_x, must_y=must_y, seed=seed)
+
+
+def seed_model(model, seed):
+    """Set every random_state / random_seed parameter of model (and of nested estimators) to seed"""
+    params = {name: seed for name in model.get_params() if name.split('__')[-1] in ('random_state', 'random_seed')}
+    if params:
+        model.set_params(**params)
+    return model
+
+
+def fit_fold(task):
+    """Metrics of one fold, task is (fold number, train indexes, validation indexes)"""
+    fold_number, train_idx, val_idx = task
+    data = _fold_data
+    model_clone = clone(data['model'])
+    if data['seed'] is not None:
+        seed_model(model_clone, data['seed'] + fold_number)
+
+    x_fold_train = data['x'][train_idx]
+    y_fold_train = data['y'][train_idx]
+    if data['must_x'] is not None:
+        x_fold_train = np.concatenate([x_fold_train, data['must_x']])
+        y_fold_train = np.concatenate([y_fold_train, data['must_y']])
+
+    model_clone.fit(x_fold_train, y_fold_train)
+
+    y_fold_val = data['y'][val_idx]
+    val_pred = model_clone.predict(data['x'][val_idx])
 
+    mse = mean_squared_error(y_fold_val, val_pred)
+    return {'mse': mse,
+            'rmse': np.sqrt(mse),
+            'r2': r2_score(y_fold_val, val_pred),
+            'mape': mean_absolute_percentage_error(y_fold_val, val_pred),
+            'mae': mean_absolute_error(y_fold_val, val_pred)}
 
-def modified_cross_validation(model, x_train, y_train, must_x_fold, must_y_fold, fold=3):
+
+def resolve_n_jobs(n_jobs):
+    """n_jobs of 1 is serial, None or a negative value uses every CPU like joblib (-1 all, -2 all but one)"""
+    cpus = os.cpu_count() or 1
+    if n_jobs is None:
+        return cpus
+    if n_jobs < 0:
+        return max(1, cpus + 1 + n_jobs)
+    return max(1, n_jobs)
+
+
+def modified_cross_validation(model, x_train, y_train, must_x_fold, must_y_fold, fold=3,
+                              n_repeats=1, n_jobs=1, seed=None, splits=None):
         cv_results = {
             'Fold': [],
             'CV_MSE': [],
@@ -29,7 +90,9 @@ def modified_cross_validation(model, x_train, y_train, must_x_fold, must_y_fold,
             'CV_MAPE': [],
             'CV_MAE':[]
         }
-        
+        if n_repeats > 1:
+            cv_results['Repeat'] = []
+
         final_results = {
             'CV_MSE_mean': None,
             'CV_MSE_std': None,
@@ -42,59 +105,51 @@ def modified_cross_validation(model, x_train, y_train, must_x_fold, must_y_fold,
             'CV_MAE_mean': None,
             'CV_MAE_std': None
         }
-        
-        kf = KFold(n_splits=fold, shuffle=True, random_state=123)
-        
-        fold_mse = []
-        fold_rmse = []
-        fold_r2 = []
-        fold_mape = []
-        fold_mae = []
-        
-        for fold_idx, (train_idx, val_idx) in enumerate(kf.split(x_train)):
-            model_clone = clone(model)
-            
-            x_fold_train = x_train.iloc[train_idx]
-            y_fold_train = y_train.iloc[train_idx]
-            x_fold_val = x_train.iloc[val_idx]
-            y_fold_val = y_train.iloc[val_idx]
-            
-            x_fold_train = pd.concat([x_fold_train, must_x_fold])
-            y_fold_train = pd.concat([y_fold_train, must_y_fold])
-            
-            model_clone.fit(x_fold_train, y_fold_train)
-            
-            val_pred = model_clone.predict(x_fold_val)
-            
-            mse = mean_squared_error(y_fold_val, val_pred)
-            rmse = np.sqrt(mse)
-            r2 = r2_score(y_fold_val, val_pred)
-            mape = mean_absolute_percentage_error(y_fold_val, val_pred)
-            mae = mean_absolute_error(y_fold_val, val_pred)
-            
-            fold_mse.append(mse)
-            fold_rmse.append(rmse)
-            fold_r2.append(r2)
-            fold_mape.append(mape)
-            fold_mae.append(mae)
-            
-            cv_results['Fold'].append(fold_idx + 1)
-            cv_results['CV_MSE'].append(mse)
-            cv_results['CV_RMSE'].append(rmse)
-            cv_results['CV_R2'].append(r2)
-            cv_results['CV_MAPE'].append(mape)
-            cv_results['CV_MAE'].append(mae)
-        
+
+        # one random state for all rounds, the first round splits like KFold(shuffle=True, random_state=123)
+        if splits is None:
+            splits = RepeatedKFold(n_splits=fold, n_repeats=n_repeats, random_state=123).split(np.arange(len(x_train)))
+
+        # NumPy once, every fold indexes these arrays
+        x = np.asarray(x_train)
+        y = np.asarray(y_train)
+        must_x = None if must_x_fold is None or len(must_x_fold) == 0 else np.asarray(must_x_fold)
+        must_y = None if must_x is None else np.asarray(must_y_fold)
+        tasks = [(fold_idx + 1, train_idx, val_idx) for fold_idx, (train_idx, val_idx) in enumerate(splits)]
+
+        n_jobs = min(resolve_n_jobs(n_jobs), len(tasks))
+        if n_jobs == 1:
+            _set_fold_data(model, x, y, must_x, must_y, seed)
+            try:
+                metrics = [fit_fold(task) for task in tasks]
+            finally:
+                _fold_data.clear()
+        else:
+            # the data goes to every worker once, the tasks only carry indexes
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_set_fold_data,
+                                     initargs=(model, x, y, must_x, must_y, seed)) as executor:
+                metrics = list(executor.map(fit_fold, tasks))
+
+        for (fold_number, _, _), fold_metrics in zip(tasks, metrics):
+            cv_results['Fold'].append((fold_number - 1) % fold + 1)
+            if n_repeats > 1:
+                cv_results['Repeat'].append((fold_number - 1) // fold + 1)
+            cv_results['CV_MSE'].append(fold_metrics['mse'])
+            cv_results['CV_RMSE'].append(fold_metrics['rmse'])
+            cv_results['CV_R2'].append(fold_metrics['r2'])
+            cv_results['CV_MAPE'].append(fold_metrics['mape'])
+            cv_results['CV_MAE'].append(fold_metrics['mae'])
+
         # Calculate final results
-        final_results['CV_MSE_mean'] = np.mean(fold_mse)
-        final_results['CV_MSE_std'] = np.std(fold_mse)
-        final_results['CV_RMSE_mean'] = np.mean(fold_rmse)
-        final_results['CV_RMSE_std'] = np.std(fold_rmse)
-        final_results['CV_R2_mean'] = np.mean(fold_r2)
-        final_results['CV_R2_std'] = np.std(fold_r2)
-        final_results['CV_MAPE_mean'] = np.mean(fold_mape)
-        final_results['CV_MAPE_std'] = np.std(fold_mape)
-        final_results['CV_MAE_mean'] = np.mean(fold_mae)
-        final_results['CV_MAE_std'] = np.std(fold_mae)
-        
-        return cv_results, final_results
\ No newline at end of file
+        final_results['CV_MSE_mean'] = np.mean(cv_results['CV_MSE'])
+        final_results['CV_MSE_std'] = np.std(cv_results['CV_MSE'])
+        final_results['CV_RMSE_mean'] = np.mean(cv_results['CV_RMSE'])
+        final_results['CV_RMSE_std'] = np.std(cv_results['CV_RMSE'])
+        final_results['CV_R2_mean'] = np.mean(cv_results['CV_R2'])
+        final_results['CV_R2_std'] = np.std(cv_results['CV_R2'])
+        final_results['CV_MAPE_mean'] = np.mean(cv_results['CV_MAPE'])
+        final_results['CV_MAPE_std'] = np.std(cv_results['CV_MAPE'])
+        final_results['CV_MAE_mean'] = np.mean(cv_results['CV_MAE'])
+        final_results['CV_MAE_std'] = np.std(cv_results['CV_MAE'])
+
+        return cv_results, final_results
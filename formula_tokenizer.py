@@ -0,0 +1,120 @@
+"""
+Formula Tokenizer
+
+Every module reads chemical formulas through this module. The regular expressions are compiled once,
+and each distinct formula string is tokenized once per process; the results are cached and their strings interned.
+
+formula_tokens(formula)         - (element, count text) pairs as written, 'Fe2O3' -> (('Fe', '2'), ('O', '3'))
+validate_formula(formula)       - formula unchanged, FormulaError when a symbol is not an element
+element_counts(formula, merge)  - (element, count) pairs, repeated elements summed, or the last count kept when merge is False
+parse_molecular_formula(formula) - {element: count} with repeated elements summed
+canonical_formula(formula)      - 'CH3CH3' -> 'C2H6', 'Fe2.0O3' -> 'Fe2O3'; elements keep their first position,
+                                  the order decides ties in the charge balance
+parse_charge_key(charge_key)    - 'Fe+3' -> ('Fe', 3)
+
+Created by Jaehyeon Park
+"""
+import re
+import sys
+from collections import defaultdict
+from functools import lru_cache
+
+from radii_collection import element_symbols
+
+# longest symbols first so 'Co' is not read as 'C' + 'o'
+valid_elements_regex = '|'.join(sorted(element_symbols, key=len, reverse=True))
+token_pattern = re.compile(r'([A-Z][a-z]*)(\d*\.?\d*)')
+element_pattern = re.compile(rf'({valid_elements_regex})(\d*\.?\d*)')
+charge_key_pattern = re.compile(r'([A-Z][a-z]?)([+-]\d+)')
+
+
+class FormulaError(Exception):
+    """Custom exception for formula validation errors"""
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+@lru_cache(maxsize=None)
+def _tokens(formula):
+    return tuple((sys.intern(elem), count) for elem, count in token_pattern.findall(formula))
+
+
+def formula_tokens(formula):
+    """(element, count text) pairs of formula, any capital letter with its lower case letters is read as an element"""
+    return _tokens(str(formula))
+
+
+@lru_cache(maxsize=None)
+def _validation_error(formula, symbols_regex):
+    """Message of the FormulaError of formula, None when it is valid"""
+    pattern = element_pattern if symbols_regex is None else re.compile(rf'({symbols_regex})(\d*\.?\d*)')
+    elements = pattern.findall(formula)
+    if not elements:
+        return f"No valid elements found in the formula: {formula}"
+    if ''.join(elem + count for elem, count in elements) != formula:
+        return f"Invalid element symbol found in the formula: {formula}"
+    return None
+
+
+def validate_formula(formula, symbols_regex=None):
+    """Validate chemical formula, symbols_regex is an alternation of the allowed symbols, default every element."""
+    message = _validation_error(formula, symbols_regex)
+    if message is not None:
+        # WARNING MESSAGE
+        raise FormulaError(message)
+    return formula
+
+
+@lru_cache(maxsize=None)
+def _element_counts(formula, merge):
+    counts = defaultdict(float) if merge else {}
+    for elem, count in _tokens(formula):
+        count = float(count) if count else 1.0
+        if merge:
+            counts[elem] += count
+        else:
+            counts[elem] = count
+    return tuple(counts.items())
+
+
+def element_counts(formula, merge=True):
+    """(element, count) pairs in order of first appearance, a missing count is 1"""
+    return _element_counts(str(formula), merge)
+
+
+def parse_molecular_formula(formula):
+    """Parse molecular formula into composition dictionary."""
+    return {elem: float(count) if count else 1.0 for elem, count in element_counts(formula)}
+
+
+@lru_cache(maxsize=None)
+def _canonical_formula(formula):
+    parts = []
+    for elem, count in _element_counts(formula, True):
+        if count == 1:
+            parts.append(elem)
+        else:
+            parts.append(f"{elem}{int(count) if count.is_integer() else count!r}")
+    return sys.intern(''.join(parts))
+
+
+def canonical_formula(formula):
+    """Formula with repeated elements merged and counts written the shortest way, the key of equal formulas"""
+    return _canonical_formula(str(formula))
+
+
+@lru_cache(maxsize=None)
+def parse_charge_key(charge_key):
+    """'Fe+3' -> ('Fe', 3), None when charge_key is not an ion key of radii_collection"""
+    match = charge_key_pattern.match(charge_key)
+    if match is None:
+        return None
+    element, charge = match.groups()
+    return sys.intern(element), int(charge)
+
+
+def cache_info():
+    """Distinct formulas tokenized, validated and counted in this process"""
+    return {'tokens': _tokens.cache_info().currsize, 'validated': _validation_error.cache_info().currsize,
+            'counts': _element_counts.cache_info().currsize}
@@ -20,43 +20,19 @@ import re
 from itertools import product, combinations_with_replacement
 import statistics
 from collections import Counter, defaultdict
-from radii_collection import effective_ionic_radii
-from rdkit import Chem
+from radii_collection import effective_ionic_radii, element_symbols
 
-class FormulaError(Exception):
-    """Custom exception for formula validation errors"""
-    def __init__(self, message):
-        self.message = message
-        super().__init__(self.message)
+from formula_tokenizer import FormulaError, validate_formula, parse_molecular_formula, parse_charge_key
 
 def initialize_periodic_table():
     """Initialize periodic table and valid elements regex"""
-    pt = Chem.GetPeriodicTable()
-    all_symbols = [pt.GetElementSymbol(i) for i in range(1, 119)]
+    all_symbols = list(element_symbols)
     valid_elements_regex = '|'.join(sorted(all_symbols, key=len, reverse=True))
     return valid_elements_regex
 
 def formula_error_check(formula, valid_elements_regex):
     """Validate chemical formula."""
-    pattern = rf'({valid_elements_regex})(\d*\.?\d*)'
-    elements = re.findall(pattern, formula)
-    
-    if not elements:
-        raise FormulaError(f"No valid elements found in the formula: {formula}")
-    
-    parsed_formula = ''.join(elem + count for elem, count in elements)
-    if parsed_formula != formula:
-        raise FormulaError(f"Invalid element symbol found in the formula: {formula}")
-        
-    return formula        
-
-def parse_molecular_formula(formula):
-    match = re.findall(r'([A-Z][a-z]*)(\d*\.?\d*)', str(formula))
-    match_count = defaultdict(float)
-    for elem, count in match:
-        count = float(count) if count else 1
-        match_count[elem] += count
-    return {elem: float(count) if count else 1.0 for elem, count in match_count.items()}
+    return validate_formula(formula, valid_elements_regex)
 
 def calculate_stability_multiple(combo, metals, total_required_charge):
     stability_score = 0
@@ -83,11 +59,11 @@ def calculate_stability(combo, metals, total_required_charge):
 def get_possible_charges(element, effective_ionic_radii):
     possible_charges = []
     for charge_key in effective_ionic_radii.keys():
-        match = re.match(r'([A-Z][a-z]?)([+-]\d+)', charge_key)
-        if match:
-            charge_element, charge = match.groups()
+        parsed = parse_charge_key(charge_key)
+        if parsed:
+            charge_element, charge = parsed
             if charge_element == element:
-                possible_charges.append(int(charge))
+                possible_charges.append(charge)
     return possible_charges
 
 def find_valid_combinations(charge_combinations, oxygen_charge=0):
@@ -120,3 +96,8 @@ def log_transform(x):
         return 0
     sign = 1 if x > 0 else -1
     return sign*np.log10(1 + abs(x))
+
+def signed_log_transform(x):
+    """Vectorized log_transform for numpy arrays."""
+    x = np.asarray(x, dtype=float)
+    return np.sign(x)*np.log10(1 + np.abs(x))
@@ -0,0 +1,102 @@
+"""
+Import time benchmark
+
+Measures the cold start of the scoring entry points, every run is a fresh interpreter.
+
+python import_benchmark.py                      # median import time of prediction and server
+python import_benchmark.py --predict            # + time to the first prediction (needs the model folder)
+python import_benchmark.py --budget 1.0         # exit 1 when a median import time is over 1 second
+
+Created by Jaehyeon Park
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# modules that scoring must not import at start up
+heavy_modules = ['rdkit', 'xgboost', 'seaborn', 'matplotlib', 'plotly', 'sklearn', 'torch', 'catboost', 'scipy']
+
+first_prediction_script = '''
+import json, time
+start = time.perf_counter()
+from prediction import Predictor
+imported = time.perf_counter()
+predictor = Predictor({model_folder!r})
+loaded = time.perf_counter()
+predictor.predict({{'Core': 'CdSe', 'Shell': '', 'Doping': '', 'Doping Rate(%)': '', 'Coating': '', 'Diameter(nm)': 500}})
+predicted = time.perf_counter()
+print(json.dumps({{'import': imported - start, 'load': loaded - imported, 'first prediction': predicted - loaded,
+                  'total': predicted - start}}))
+'''
+
+
+def parse_importtime(stderr):
+    """(module, self seconds, cumulative seconds) of every line printed by python -X importtime"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return rows
+
+
+def time_import(module, repeat=5):
+    """Median cumulative import time of module over repeat fresh interpreters, and the rows of the last run"""
+    times, rows = [], []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                cwd=here, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+        rows = parse_importtime(result.stderr)
+        times.append(next(cumulative for name, _, cumulative in rows if name == module))
+    return statistics.median(times), rows
+
+
+def time_first_prediction(model_folder):
+    """Seconds spent importing, loading the model and scoring the first particle in a fresh interpreter"""
+    result = subprocess.run([sys.executable, '-c', first_prediction_script.format(model_folder=model_folder)],
+                            cwd=here, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"first prediction failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NanoToxRadar cold start benchmark')
+    parser.add_argument('--modules', nargs='+', default=['prediction', 'server'])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='slowest modules to list')
+    parser.add_argument('--budget', type=float, default=None, help='seconds allowed for each import')
+    parser.add_argument('--predict', action='store_true', help='also time the first prediction')
+    parser.add_argument('--model-folder', default='model')
+    args = parser.parse_args()
+
+    over_budget = False
+    for module in args.modules:
+        median, rows = time_import(module, args.repeat)
+        imported = {name.split('.')[0] for name, _, _ in rows}
+        heavy = [name for name in heavy_modules if name in imported]
+        print(f"import {module}: {median:.3f} s (median of {args.repeat})")
+        print(f"  heavy modules imported: {', '.join(heavy) if heavy else 'none'}")
+        for name, self_time, _ in sorted(rows, key=lambda row: row[1], reverse=True)[:args.top]:
+            print(f"  {self_time * 1000:8.1f} ms  {name}")
+        if args.budget is not None and median > args.budget:
+            print(f"  over the {args.budget:.3f} s budget")
+            over_budget = True
+
+    if args.predict:
+        timings = time_first_prediction(args.model_folder)
+        print('first prediction: ' + ', '.join(f"{stage} {seconds:.3f} s" for stage, seconds in timings.items()))
+
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""
+Instrumentation
+
+Optional timings and counters of the prediction pipeline, off by default.
+
+enable() / disable()           - switch recording on and off, NANOTOX_INSTRUMENTATION=1 enables it at import
+add_hook(callback)             - callback(kind, name, value, labels) for every record, kind is 'stage', 'count' or 'observe'
+snapshot()                     - dict of every stage, counter, batch size and per formula record so far
+prometheus_text()              - the same as a Prometheus text exposition, served by server.py --metrics on GET /metrics
+
+What is recorded
+stage seconds        - prepare_particles, calculate_volumes with its prefetch_volumes, core_volume, doping_volume,
+                       shell_volume and coating_volume passes, calculate_amounts, sdec_fp, design_matrix, model_predict
+formula seconds      - time of every formula the volume calculator computed (cache misses only)
+charge combinations  - per formula, 'space' combinations the full enumeration would build, 'enumerated' the ones
+                       actually generated and 'kept' the ones compared for the final choice
+                       Both are summed per role, per formula only the max_formulas slowest are kept
+                       (NANOTOX_INSTRUMENTATION_FORMULAS, default 1000, 0 keeps the role totals only),
+                       so a long running server does not grow with every new formula.
+cache hits / misses  - volume_cache and the prediction cache
+batch size           - particles per featurize / predict call
+
+When disabled every call site costs one attribute check, stage() returns a shared no-op context.
+Volumes computed in the worker processes of prefetch_volumes are only seen as the prefetch_volumes stage.
+
+Created by Jaehyeon Park
+"""
+import contextlib
+import contextvars
+import os
+import threading
+import time
+
+enabled = os.environ.get('NANOTOX_INSTRUMENTATION', '') not in ('', '0')
+
+_hooks = []
+_lock = threading.Lock()
+_null_stage = contextlib.nullcontext()
+_formula = contextvars.ContextVar('formula', default=('', ''))
+
+stages = {}          # stage -> [count, seconds, max seconds]
+counters = {}        # (name, labels) -> value
+observations = {}    # name -> [count, sum, max]
+formulas = {}        # (role, formula) -> {'seconds': s, 'space': n, 'enumerated': n, 'kept': n}
+roles = {}           # role -> the same totals over every formula of the role
+
+max_formulas = int(os.environ.get('NANOTOX_INSTRUMENTATION_FORMULAS', '1000'))
+
+
+def enable(hook=None):
+    """Start recording, optionally with a hook"""
+    global enabled
+    if hook is not None:
+        add_hook(hook)
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def add_hook(callback):
+    """callback(kind, name, value, labels) is called for every record while enabled"""
+    with _lock:
+        _hooks.append(callback)
+
+
+def remove_hook(callback):
+    with _lock:
+        if callback in _hooks:
+            _hooks.remove(callback)
+
+
+def reset():
+    """Forget everything recorded so far, the hooks are kept"""
+    with _lock:
+        stages.clear()
+        counters.clear()
+        observations.clear()
+        formulas.clear()
+        roles.clear()
+
+
+def _notify(kind, name, value, labels):
+    for callback in list(_hooks):
+        callback(kind, name, value, labels)
+
+
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        with _lock:
+            record = stages.setdefault(self.name, [0, 0.0, 0.0])
+            record[0] += 1
+            record[1] += seconds
+            record[2] = max(record[2], seconds)
+        _notify('stage', self.name, seconds, {})
+        return False
+
+
+def stage(name):
+    """Context manager timing one run of a pipeline stage"""
+    return _Stage(name) if enabled else _null_stage
+
+
+def count(name, value=1, **labels):
+    """Add value to a counter"""
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        counters[key] = counters.get(key, 0) + value
+    _notify('count', name, value, labels)
+
+
+def observe(name, value):
+    """Record one value of a distribution, e.g. a batch size"""
+    if not enabled:
+        return
+    with _lock:
+        record = observations.setdefault(name, [0, 0.0, 0.0])
+        record[0] += 1
+        record[1] += value
+        record[2] = max(record[2], value)
+    _notify('observe', name, value, {})
+
+
+def _formula_records(role, name):
+    """The records of a formula and of its role to add to, call with _lock held"""
+    records = [roles.setdefault(role, {'seconds': 0.0, 'space': 0, 'enumerated': 0, 'kept': 0})]
+    if max_formulas > 0:
+        if (role, name) not in formulas and len(formulas) >= 2 * max_formulas:
+            # keep the slowest half, trimming every max_formulas new formulas keeps the cost per record constant
+            slowest = sorted(formulas.items(), key=lambda item: item[1]['seconds'], reverse=True)[:max_formulas]
+            formulas.clear()
+            formulas.update(slowest)
+        records.append(formulas.setdefault((role, name), {'seconds': 0.0, 'space': 0, 'enumerated': 0, 'kept': 0}))
+    return records
+
+
+@contextlib.contextmanager
+def formula(role, name):
+    """Attribute the time and charge combinations recorded inside to one formula of the volume calculator"""
+    token = _formula.set((role, name))
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _formula.reset(token)
+        with _lock:
+            for record in _formula_records(role, name):
+                record['seconds'] += seconds
+        _notify('observe', 'formula_seconds', seconds, {'role': role, 'formula': name})
+
+
+def formula_function(role, function):
+    """function(formula) recorded under formula(role, formula)"""
+    def instrumented(name):
+        with formula(role, name):
+            return function(name)
+    return instrumented
+
+
+def charge_combinations(space, enumerated, kept):
+    """Charge combinations of the formula being computed, see formula()"""
+    if not enabled:
+        return
+    role, name = _formula.get()
+    with _lock:
+        for record in _formula_records(role, name):
+            record['space'] += space
+            record['enumerated'] += enumerated
+            record['kept'] += kept
+    _notify('count', 'charge_combinations', enumerated,
+            {'role': role, 'formula': name, 'space': space, 'kept': kept})
+
+
+def cache_hit_rates():
+    """{cache: hits / (hits + misses)} of the caches counted so far"""
+    rates = {}
+    for (name, labels), value in list(counters.items()):
+        if name == 'cache_hits':
+            cache = dict(labels)['cache']
+            misses = counters.get(('cache_misses', labels), 0)
+            rates[cache] = value / (value + misses) if value + misses else None
+    return rates
+
+
+def snapshot():
+    """Everything recorded so far as plain Python values"""
+    with _lock:
+        return {'enabled': enabled,
+                'stages': {name: {'count': n, 'seconds': total, 'max_seconds': longest}
+                           for name, (n, total, longest) in stages.items()},
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in counters.items()],
+                'observations': {name: {'count': n, 'sum': total, 'max': largest}
+                                 for name, (n, total, largest) in observations.items()},
+                'formulas': [dict(role=role, formula=name, **record) for (role, name), record in formulas.items()],
+                'roles': {role: dict(record) for role, record in roles.items()},
+                'cache_hit_rates': cache_hit_rates()}
+
+
+def _labels(**labels):
+    escaped = {key: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for key, value in labels.items()}
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped.items()) + '}' if escaped else ''
+
+
+def prometheus_text(prefix='nanotox', top_formulas=20):
+    """Prometheus text exposition of snapshot(), only the top_formulas slowest formulas get their own series"""
+    data = snapshot()
+    lines = [f'# HELP {prefix}_stage_seconds Wall time of the pipeline stages',
+             f'# TYPE {prefix}_stage_seconds summary']
+    for name, record in sorted(data['stages'].items()):
+        lines.append(f'{prefix}_stage_seconds_count{_labels(stage=name)} {record["count"]}')
+        lines.append(f'{prefix}_stage_seconds_sum{_labels(stage=name)} {record["seconds"]:.6f}')
+    for name, record in sorted(data['observations'].items()):
+        lines.append(f'# TYPE {prefix}_{name} summary')
+        lines.append(f'{prefix}_{name}_count {record["count"]}')
+        lines.append(f'{prefix}_{name}_sum {record["sum"]:g}')
+
+    names = sorted({counter['name'] for counter in data['counters']})
+    for name in names:
+        lines.append(f'# TYPE {prefix}_{name}_total counter')
+        for counter in data['counters']:
+            if counter['name'] == name:
+                lines.append(f'{prefix}_{name}_total{_labels(**counter["labels"])} {counter["value"]:g}')
+    if data['cache_hit_rates']:
+        lines.append(f'# TYPE {prefix}_cache_hit_ratio gauge')
+        for cache, rate in sorted(data['cache_hit_rates'].items()):
+            if rate is not None:
+                lines.append(f'{prefix}_cache_hit_ratio{_labels(cache=cache)} {rate:.6f}')
+
+    if data['roles']:
+        lines.append(f'# HELP {prefix}_role_formula_seconds Time spent on the formulas of every component role')
+        lines.append(f'# TYPE {prefix}_role_formula_seconds counter')
+        for role, record in sorted(data['roles'].items()):
+            lines.append(f'{prefix}_role_formula_seconds{_labels(role=role)} {record["seconds"]:.6f}')
+        lines.append(f'# TYPE {prefix}_role_charge_combinations counter')
+        for role, record in sorted(data['roles'].items()):
+            for kind in ['space', 'enumerated', 'kept']:
+                lines.append(f'{prefix}_role_charge_combinations{_labels(role=role, kind=kind)} {record[kind]}')
+
+    slowest = sorted(data['formulas'], key=lambda record: record['seconds'], reverse=True)[:top_formulas]
+    if slowest:
+        lines.append(f'# HELP {prefix}_formula_seconds Time spent on the slowest formulas of the volume calculator')
+        lines.append(f'# TYPE {prefix}_formula_seconds gauge')
+        for record in slowest:
+            lines.append(f'{prefix}_formula_seconds{_labels(role=record["role"], formula=record["formula"])} '
+                         f'{record["seconds"]:.6f}')
+        lines.append(f'# TYPE {prefix}_charge_combinations gauge')
+        for record in slowest:
+            for kind in ['space', 'enumerated', 'kept']:
+                lines.append(f'{prefix}_charge_combinations'
+                             f'{_labels(role=record["role"], formula=record["formula"], kind=kind)} {record[kind]}')
+    return '\n'.join(lines) + '\n'
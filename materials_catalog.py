@@ -0,0 +1,56 @@
+"""
+Materials Catalog
+
+The core / shell / doping / coating volume lists indexed by name once at load time.
+
+MaterialsCatalog.volume(role, name) - O(1) volume of a listed material, None when it is not listed
+MaterialsCatalog.volumes(role, names) - the same for a whole column as one hash join
+MaterialsCatalog.coating_mf - coating name -> molecular formula
+
+Duplicated names keep their first row, like the `.values[0]` lookups they replace.
+
+Created by Jaehyeon Park
+"""
+from resources import load_table
+
+# role -> (file, name column, volume column)
+volume_lists = {
+    'core': ('core_volume_list.csv', 'Core', 'Core Volume (nm^3)'),
+    'shell': ('shell_volume_list.csv', 'Shell', 'Shell Volume (nm^3)'),
+    'doping': ('doping_volume_list.csv', 'Doping', 'Doping Volume (nm^3)'),
+    'coating': ('coating_volume_list.csv', 'Coating name', 'Coating Volume (nm^3)'),
+}
+
+
+def name_map(table, name_column, value_column):
+    """name -> value of a volume list, rows without a name are skipped and the first duplicate wins"""
+    table = table.dropna(subset=[name_column]).drop_duplicates(name_column)
+    return dict(zip(table[name_column], table[value_column]))
+
+
+class MaterialsCatalog:
+    """Name indexed volume lists, tables maps each role to its DataFrame"""
+    def __init__(self, tables):
+        self.tables = tables
+        self.volume_maps = {role: name_map(tables[role], name_column, volume_column)
+                            for role, (_, name_column, volume_column) in volume_lists.items()}
+        self.coating_mf = name_map(tables['coating'], 'Coating name', 'mf')
+
+    @classmethod
+    def from_csv(cls):
+        return cls({role: load_table(file_name) for role, (file_name, _, _) in volume_lists.items()})
+
+    def __contains__(self, key):
+        role, name = key
+        return name in self.volume_maps[role]
+
+    def volume(self, role, name):
+        """Listed volume of name, None when name is not in the list of role"""
+        return self.volume_maps[role].get(name)
+
+    def volumes(self, role, names):
+        """Listed volumes of a Series of names, NaN where a name is not listed"""
+        return names.map(self.volume_maps[role])
+
+
+catalog = MaterialsCatalog.from_csv()
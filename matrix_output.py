@@ -0,0 +1,160 @@
+"""
+Matrix output
+
+Compact layout for large prediction runs: one N particles x 110 cells float32 matrix instead of
+one CSV row per (particle, cell). The cell and tissue names are written once in a JSON file next to it.
+
+predictions.npy        - float32 matrix, np.load(path, mmap_mode='r') maps it without reading it
+predictions.meta.json  - shape, cells, tissues, where the particle ids are and the error of every failed particle
+predictions.particles.csv - particle ids of a .npy matrix when they are not the row numbers 0..N-1
+predictions.parquet    - the same matrix as a Parquet table, one float32 column per cell and a Particle column (needs pyarrow)
+
+MatrixWriter fills the matrix chunk by chunk, so batch_predict.py keeps its memory bound:
+positional ids are kept as a start / stop range, other ids go to the sidecar CSV (or the Particle column) chunk by chunk.
+load_matrix reads them back into metadata['particles'].
+
+Created by Jaehyeon Park
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+def metadata_path(path):
+    """predictions.npy -> predictions.meta.json"""
+    return os.path.splitext(path)[0] + '.meta.json'
+
+
+def particles_path(path):
+    """predictions.npy -> predictions.particles.csv"""
+    return os.path.splitext(path)[0] + '.particles.csv'
+
+
+def is_positional(particles, start):
+    """True when particles are the integers start, start + 1, ..."""
+    ids = np.asarray(particles)
+    return ids.dtype.kind in 'iu' and np.array_equal(ids, np.arange(start, start + len(ids)))
+
+
+class MatrixWriter:
+    """
+    Write an (n_particles x cells) float32 prediction matrix in chunks of rows.
+
+    .npy files are preallocated with open_memmap, so n_particles has to be known up front.
+    Parquet files are appended a row group per chunk.
+    """
+    def __init__(self, path, n_particles, metadata):
+        self.path = path
+        self.n_particles = n_particles
+        self.metadata = dict(metadata)
+        self.n_cells = len(self.metadata['cells'])
+        # ids are a range while they are the row numbers, afterwards they are written out chunk by chunk
+        self.positional = True
+        self.errors = {}
+        self.row = 0
+        self.matrix = None
+        self.writer = None
+        self.npy = path.lower().endswith('.npy')
+        if self.npy:
+            self.matrix = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                                    shape=(n_particles, self.n_cells))
+        if os.path.exists(particles_path(path)):
+            os.remove(particles_path(path))
+
+    def append_particles(self, particles):
+        pd.DataFrame({'Particle': particles}).to_csv(particles_path(self.path), mode='a',
+                                                     header=not os.path.exists(particles_path(self.path)), index=False)
+
+    def write_particles(self, particles):
+        if self.positional and is_positional(particles, self.row):
+            return
+        if self.positional and self.npy:
+            # the row numbers written so far go first, in chunks
+            for start in range(0, self.row, 1 << 20):
+                self.append_particles(np.arange(start, min(start + (1 << 20), self.row)))
+        self.positional = False
+        # the Particle column of a Parquet file holds them already
+        if self.npy:
+            self.append_particles(particles)
+
+    def write(self, prediction, particles, errors=None):
+        """Append the rows of prediction, particles are their ids and errors an error dict or None per row"""
+        prediction = np.asarray(prediction, dtype=np.float32)
+        particles = [particle if isinstance(particle, (int, str)) else int(particle) for particle in particles]
+        if self.matrix is not None:
+            self.matrix[self.row:self.row + len(prediction)] = prediction
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.table({'Particle': particles,
+                              **{cell: prediction[:, i] for i, cell in enumerate(self.metadata['cells'])}})
+            table = table.replace_schema_metadata({'nanotoxradar': json.dumps(self.metadata)})
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema)
+            self.writer.write_table(table)
+        self.write_particles(particles)
+        for particle, error in zip(particles, errors or []):
+            if error is not None:
+                self.errors[str(particle)] = error
+        self.row += len(prediction)
+
+    def close(self):
+        if self.matrix is not None:
+            self.matrix.flush()
+            self.matrix = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.positional:
+            particles = {'start': 0, 'stop': self.row}
+        elif self.npy:
+            particles = {'file': os.path.basename(particles_path(self.path))}
+        else:
+            particles = {'column': 'Particle'}
+        metadata = dict(self.metadata, shape=[self.row, self.n_cells], dtype='float32',
+                        particles=particles, errors=self.errors)
+        with open(metadata_path(self.path), 'w') as f:
+            json.dump(metadata, f)
+
+
+def save_matrix(path, prediction, particles, metadata, errors=None):
+    """Write a whole prediction matrix at once, see MatrixWriter"""
+    writer = MatrixWriter(path, len(prediction), metadata)
+    writer.write(prediction, particles, errors)
+    writer.close()
+
+
+def load_particles(path, particles):
+    """Particle ids of the matrix at path from the 'particles' entry of its metadata"""
+    if 'start' in particles:
+        return np.arange(particles['start'], particles['stop'])
+    if 'file' in particles:
+        return pd.read_csv(os.path.join(os.path.dirname(path), particles['file']))['Particle'].to_numpy()
+    return pd.read_parquet(path, columns=[particles['column']])[particles['column']].to_numpy()
+
+
+def load_matrix(path, mmap=True):
+    """
+    (matrix, metadata) of a saved prediction matrix, metadata['particles'] holds the particle ids.
+
+    .npy files are memory-mapped read-only unless mmap is False, Parquet is read into memory.
+    """
+    with open(metadata_path(path)) as f:
+        metadata = json.load(f)
+    metadata['particles'] = load_particles(path, metadata['particles'])
+    if path.lower().endswith('.npy'):
+        return np.load(path, mmap_mode='r' if mmap else None), metadata
+    table = pd.read_parquet(path)
+    return table[metadata['cells']].to_numpy(dtype=np.float32), metadata
+
+
+def matrix_to_long(matrix, metadata):
+    """Expand a saved matrix to the predict_batch layout, one row per (Particle, Cell-identification)"""
+    n_particles, n_cells = matrix.shape
+    return pd.DataFrame({
+        'Particle': np.repeat(metadata['particles'], n_cells),
+        'Cell-identification': np.tile(metadata['cells'], n_particles),
+        'Cell-tissue': np.tile(metadata['tissues'], n_particles),
+        'Prediction': np.asarray(matrix).ravel(),
+    })
@@ -0,0 +1,90 @@
+"""
+Parallel featurization benchmark
+
+Times calculate_volumes on a table of synthetic nanoparticles with many distinct core and coating formulas,
+serial and with a process pool of n_jobs workers, and checks that every run gives the serial volumes.
+The volume cache is emptied before every run so each one computes all the formulas.
+
+python parallel_benchmark.py                        # 2000 particles, n_jobs 1, 2, 4 ... up to the CPU count
+python parallel_benchmark.py --particles 20000 --n-jobs 1 8 32 64
+
+Created by Jaehyeon Park
+"""
+import argparse
+import io
+import contextlib
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from materials_catalog import catalog
+from radii_collection import effective_ionic_radii
+from volume_cache import volume_cache
+import volume_calculator
+
+volume_columns = ['Core Volume (nm^3)', 'Doping Volume (nm^3)', 'Shell Volume (nm^3)', 'Coating Volume (nm^3)']
+
+
+def synthetic_particles(n, seed=0):
+    """n nanoparticles with mostly unlisted mixed oxide cores and organic coatings, so the formulas are computed"""
+    rng = np.random.default_rng(seed)
+    metals = sorted({key.split('+')[0] for key in effective_ionic_radii if '+' in key})
+    shells = [''] * 4 + sorted(catalog.volume_maps['shell'])
+    dopings = sorted(catalog.volume_maps['doping'])
+    rows = []
+    for _ in range(n):
+        first, second = rng.choice(metals, 2, replace=False)
+        core = f"{first}{rng.integers(1, 4)}{second}{rng.integers(1, 3)}O{rng.integers(2, 7)}"
+        coating = f"C{rng.integers(1, 30)}H{rng.integers(2, 60)}O{rng.integers(1, 6)}" if rng.random() < 0.7 else ''
+        doped = rng.random() < 0.3
+        rows.append({'Core': core, 'Shell': rng.choice(shells), 'Doping': rng.choice(dopings) if doped else '',
+                     'Doping Rate(%)': str(rng.integers(1, 10)) if doped else '', 'Coating': coating,
+                     'Diameter(nm)': float(rng.uniform(1, 700))})
+    return pd.DataFrame(rows)
+
+
+def time_volumes(particles, n_jobs):
+    """Seconds of one cold calculate_volumes run and its result"""
+    volume_cache.clear()
+    data = particles.copy()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = volume_calculator.calculate_volumes(data, errors='collect', n_jobs=n_jobs)
+    return time.perf_counter() - start, result
+
+
+def main():
+    cpus = os.cpu_count() or 1
+    default_jobs = sorted({1} | {2 ** i for i in range(1, cpus.bit_length()) if 2 ** i <= cpus} | {cpus})
+    parser = argparse.ArgumentParser(description='NanoToxRadar parallel featurization benchmark')
+    parser.add_argument('--particles', type=int, default=2000)
+    parser.add_argument('--n-jobs', type=int, nargs='+', default=default_jobs)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    particles = synthetic_particles(args.particles, args.seed)
+    formulas = sum(particles[column].nunique() for column in ['Core', 'Doping', 'Shell', 'Coating'])
+    print(f"{len(particles)} particles, {formulas} distinct formulas, {cpus} CPUs")
+
+    serial_time, reference = None, None
+    for n_jobs in args.n_jobs:
+        times = []
+        for _ in range(args.repeat):
+            seconds, result = time_volumes(particles, n_jobs)
+            times.append(seconds)
+        if reference is None:
+            reference = result
+        same = reference[volume_columns].equals(result[volume_columns]) and reference['Error'].equals(result['Error'])
+        best = min(times)
+        if n_jobs == 1:
+            serial_time = best
+        speedup = f", {serial_time / best:.2f}x" if serial_time else ''
+        print(f"n_jobs {n_jobs:3d}: {best:.3f} s ({len(particles) / best:.0f} particles/s{speedup})"
+              f"{'' if same else ', VOLUMES DIFFER FROM THE FIRST RUN'}")
+
+
+if __name__ == '__main__':
+    main()
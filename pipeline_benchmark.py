@@ -0,0 +1,283 @@
+"""
+Prediction pipeline benchmark
+
+Times every stage of the prediction pipeline on corpora of 1, 100, 10k and 100k nanoparticles:
+calculate_volumes, calculate_amounts, calculate_sdec_fp, the design matrix and the CatBoost prediction.
+Most particles are drawn from the bundled volume lists, whose volumes are catalog lookups, and a share of them
+(--computed-share, default a quarter) are the unlisted mixed oxides and organic coatings of
+parallel_benchmark.synthetic_particles, whose volumes go through the charge solver and the per formula calculation.
+Every stage reports seconds, rows/s and its peak traced memory, the results are saved as JSON together with
+checksums of the volumes, fingerprints and predictions, so a run on another commit can be compared for speed and output.
+
+The volume cache is emptied before every run of calculate_volumes, so the unlisted formulas are computed again every run.
+calculate_volumes is also timed on the listed and the computed particles apart, see 'volume_cases' of the results.
+The design matrix holds one row per particle and cell, it is built and scored in chunks of --predict-chunk particles.
+Peak memory is measured in an extra run of every stage under tracemalloc, it counts Python and NumPy allocations
+(not the memory CatBoost allocates itself); max_rss_mb is the peak resident size of the whole process.
+
+python pipeline_benchmark.py --output bench.json                     # 1, 100, 10000 and 100000 particles
+python pipeline_benchmark.py --sizes 1000 --repeat 3 --compare bench.json
+
+Created by Jaehyeon Park
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from amount_calculator import calculate_amounts
+from formula_utils import signed_log_transform
+from materials_catalog import catalog
+from parallel_benchmark import synthetic_particles
+from prediction import Predictor, build_design_matrix, model_folder, prepare_particles
+from sdec_fp_generator import calculate_sdec_fp
+from volume_cache import volume_cache
+from volume_calculator import calculate_volumes
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+default_sizes = [1, 100, 10000, 100000]
+stages = ['calculate_volumes', 'calculate_amounts', 'calculate_sdec_fp', 'design_matrix', 'prediction']
+
+
+def listed_corpus(n, seed=0):
+    """
+    n nanoparticles with listed components: every particle has a core, about half a shell, a third a dopant
+    (a tenth of those two different ones), half a coating, and a log uniform diameter of 1-700 nm.
+    """
+    rng = np.random.default_rng(seed)
+    cores, shells, dopings, coatings = (sorted(catalog.volume_maps[role]) for role in ['core', 'shell', 'doping', 'coating'])
+
+    shell = np.where(rng.random(n) < 0.5, rng.choice(shells, n), '')
+    coating = np.where(rng.random(n) < 0.5, rng.choice(coatings, n), '')
+    doped = rng.random(n) < 0.3
+    double = doped & (rng.random(n) < 0.1)
+    # two different dopants, the same one twice is not a valid particle
+    first = rng.integers(0, len(dopings), n)
+    second = (first + rng.integers(1, len(dopings), n)) % len(dopings)
+    first, second = np.array(dopings)[first], np.array(dopings)[second]
+    rate, second_rate = rng.integers(1, 11, n), rng.integers(1, 11, n)
+    doping = np.where(double, np.char.add(np.char.add(first, '/'), second), np.where(doped, first, ''))
+    doping_rate = np.where(double, [f"{a}/{b}" for a, b in zip(rate, second_rate)], np.where(doped, rate.astype(str), ''))
+    return pd.DataFrame({'Core': rng.choice(cores, n), 'Shell': shell, 'Doping': doping, 'Doping Rate(%)': doping_rate,
+                         'Coating': coating, 'Diameter(nm)': np.exp(rng.uniform(0, np.log(700), n))})
+
+
+def particle_corpus(n, seed=0, computed_share=0.25):
+    """n nanoparticles, computed_share of them from synthetic_particles, the Case column says which ones"""
+    n_computed = int(round(n * computed_share))
+    listed = listed_corpus(n - n_computed, seed).assign(Case='listed')
+    computed = synthetic_particles(n_computed, seed).assign(Case='computed')
+    return pd.concat([listed, computed], ignore_index=True)
+
+
+def checksum(values):
+    """sha256 of an array rounded to 10 decimals, equal outputs give equal checksums"""
+    values = np.round(np.asarray(values, dtype=float), 10)
+    return hashlib.sha256(np.ascontiguousarray(values).tobytes()).hexdigest()[:16]
+
+
+def run_stage(function, memory):
+    """(seconds, peak traced MB or None, result) of one call of function"""
+    if memory:
+        tracemalloc.start()
+        result = function()
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+        return None, peak, result
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, None, result
+
+
+def featurization(predictor, particles):
+    """The calculate_volumes, calculate_amounts and calculate_sdec_fp stages, each takes the output of the previous one"""
+    def volumes(_):
+        volume_cache.clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            return calculate_volumes(prepare_particles(particles, errors='collect'), errors='collect', n_jobs=predictor.n_jobs)
+
+    def amounts(data):
+        result = calculate_amounts(data, errors='collect')
+        return result[result['Error'].isna().to_numpy()].reset_index(drop=True)
+
+    def sdec(data):
+        fingerprints = calculate_sdec_fp(data, predictor.df_atom)
+        return pd.DataFrame(signed_log_transform(fingerprints.to_numpy()), columns=fingerprints.columns)
+
+    return {'calculate_volumes': volumes, 'calculate_amounts': amounts, 'calculate_sdec_fp': sdec}
+
+
+def score_in_chunks(predictor, df_sdec_log, predict_chunk, memory=False):
+    """
+    ({design_matrix: seconds, prediction: seconds}, {stage: peak MB or None}, predictions) of every fingerprint
+    against every cell, one design matrix of predict_chunk particles at a time.
+    """
+    design_rows = predictor.cells.design_rows()
+    seconds = dict.fromkeys(['design_matrix', 'prediction'], 0.0)
+    peaks = dict.fromkeys(seconds, 0.0 if memory else None)
+    predictions = []
+    if memory:
+        tracemalloc.start()
+    for start in range(0, len(df_sdec_log), predict_chunk):
+        for stage in seconds:
+            if memory:
+                tracemalloc.reset_peak()
+            begin = time.perf_counter()
+            if stage == 'design_matrix':
+                x_data = build_design_matrix(df_sdec_log.iloc[start:start + predict_chunk], design_rows)
+            else:
+                predictions.append(predictor.model.predict(x_data))
+            seconds[stage] += time.perf_counter() - begin
+            if memory:
+                peaks[stage] = max(peaks[stage], tracemalloc.get_traced_memory()[1] / 2 ** 20)
+        del x_data
+    if memory:
+        tracemalloc.stop()
+    predictions = np.concatenate(predictions) if predictions else np.empty(0)
+    return seconds, peaks, predictions.reshape(len(df_sdec_log), len(design_rows))
+
+
+def benchmark(predictor, particles, repeat=1, memory=True, predict_chunk=1000):
+    """Best seconds, rows/s and peak memory of every stage on particles, with the output checksums"""
+    report, outputs, value = {}, {}, None
+    for stage, function in featurization(predictor, particles).items():
+        times = []
+        for _ in range(repeat):
+            seconds, _, result = run_stage(lambda: function(value), memory=False)
+            times.append(seconds)
+        peak = run_stage(lambda: function(value), memory=True)[1] if memory else None
+        value = outputs[stage] = result
+        report[stage] = {'seconds': min(times), 'peak_memory_mb': peak}
+
+    # the full design matrix of a large batch does not fit in memory, the last two stages are timed chunk by chunk
+    runs = [score_in_chunks(predictor, value, predict_chunk) for _ in range(repeat)]
+    peaks = score_in_chunks(predictor, value, predict_chunk, memory=True)[1] if memory else dict.fromkeys(runs[0][0])
+    outputs['prediction'] = runs[0][2]
+    for stage in runs[0][0]:
+        report[stage] = {'seconds': min(run[0][stage] for run in runs), 'peak_memory_mb': peaks[stage]}
+
+    for stage in report.values():
+        stage['rows_per_second'] = len(particles) / stage['seconds'] if stage['seconds'] > 0 else None
+
+    # catalog lookups and computed formulas scale differently, calculate_volumes is timed on each alone
+    volume_cases = {}
+    for case, subset in particles.groupby('Case', sort=False):
+        volumes_of_case = featurization(predictor, subset.reset_index(drop=True))['calculate_volumes']
+        seconds = min(run_stage(lambda: volumes_of_case(None), memory=False)[0] for _ in range(repeat))
+        volume_cases[case] = {'rows': len(subset), 'seconds': seconds,
+                              'rows_per_second': len(subset) / seconds if seconds > 0 else None}
+    volume_columns = ['Core Volume (nm^3)', 'Doping Volume (nm^3)', 'Shell Volume (nm^3)', 'Coating Volume (nm^3)']
+    volumes = outputs['calculate_volumes'].reindex(columns=volume_columns).apply(pd.to_numeric, errors='coerce')
+    total = sum(stage['seconds'] for stage in report.values())
+    return {'rows': len(particles), 'scored_rows': len(outputs['calculate_amounts']),
+            'stages': report, 'volume_cases': volume_cases, 'total_seconds': total, 'rows_per_second': len(particles) / total if total > 0 else None,
+            'checksums': {'volumes': checksum(volumes.to_numpy()),
+                          'fingerprints': checksum(outputs['calculate_sdec_fp'].to_numpy()),
+                          'predictions': checksum(outputs['prediction'])}}
+
+
+def git_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=here, capture_output=True, text=True)
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def environment():
+    import catboost
+    return {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'catboost': catboost.__version__,
+            'machine': platform.machine(), 'cpus': os.cpu_count()}
+
+
+def max_rss_mb():
+    """Peak resident memory of this process, ru_maxrss is in kB on Linux and in bytes on macOS, None on Windows"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def compare(results, reference):
+    """Print the speed ratio of every stage against a previous run and the outputs that changed"""
+    previous = {result['rows']: result for result in reference['results']}
+    print(f"\ncompared with {reference['environment'].get('commit')} ({reference['environment'].get('time')})")
+    changed = False
+    for result in results:
+        old = previous.get(result['rows'])
+        if old is None:
+            continue
+        ratios = ', '.join(f"{stage} {old['stages'][stage]['seconds'] / result['stages'][stage]['seconds']:.2f}x"
+                           for stage in stages if result['stages'][stage]['seconds'])
+        ratios += ''.join(f", calculate_volumes {case} {old['volume_cases'][case]['seconds'] / timing['seconds']:.2f}x"
+                          for case, timing in result['volume_cases'].items()
+                          if timing['seconds'] and case in old.get('volume_cases', {}))
+        print(f"{result['rows']:>7d} rows: {ratios}")
+        for name, value in result['checksums'].items():
+            if old['checksums'].get(name) != value:
+                print(f"          {name} DIFFER FROM THE REFERENCE")
+                changed = True
+    return changed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NanoToxRadar prediction pipeline benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes)
+    parser.add_argument('--repeat', type=int, default=1, help='timed runs of every stage, the best is reported')
+    parser.add_argument('--predict-chunk', type=int, default=1000, help='particles per design matrix')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run of every stage')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--computed-share', type=float, default=0.25,
+                        help='share of particles with unlisted formulas whose volumes are computed')
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--model-folder', default=model_folder)
+    parser.add_argument('--output', default=None, help='JSON file for the results')
+    parser.add_argument('--compare', default=None, help='JSON file of a previous run')
+    args = parser.parse_args()
+
+    predictor = Predictor(args.model_folder, n_jobs=args.n_jobs)
+    results = []
+    for size in args.sizes:
+        particles = particle_corpus(size, args.seed, args.computed_share)
+        result = benchmark(predictor, particles, args.repeat, not args.no_memory, args.predict_chunk)
+        results.append(result)
+        print(f"{size} particles ({result['scored_rows']} scored): {result['total_seconds']:.3f} s, "
+              f"{result['rows_per_second']:.0f} rows/s")
+        for stage in stages:
+            timing = result['stages'][stage]
+            memory = f", {timing['peak_memory_mb']:.1f} MB peak" if timing['peak_memory_mb'] is not None else ''
+            print(f"  {stage:18s} {timing['seconds']:9.4f} s  {timing['rows_per_second'] or 0:12.0f} rows/s{memory}")
+        for case, timing in result['volume_cases'].items():
+            print(f"    volumes {case:10s} {timing['seconds']:9.4f} s  {timing['rows_per_second'] or 0:12.0f} rows/s"
+                  f"  ({timing['rows']} particles)")
+
+    report = {'environment': environment(), 'seed': args.seed, 'computed_share': args.computed_share,
+              'repeat': args.repeat, 'n_jobs': args.n_jobs,
+              'predict_chunk': args.predict_chunk, 'max_rss_mb': max_rss_mb(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    changed = False
+    if args.compare:
+        with open(args.compare) as f:
+            changed = compare(results, json.load(f))
+    sys.exit(1 if changed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,120 +1,435 @@
 """
 To predict with all module and make the results
+
+Predictor - loads the model and lookup tables once and keeps them for every prediction.
+
+predict_batch - score a whole DataFrame of nanoparticles with a single CatBoost call,
+the SDEC FP of every particle is repeated for the 110 cell types and stacked into one design matrix.
+cells= / tissues= limit the design matrix to the requested cell lines or tissues, see cell_catalog.
+
+predict_diameter_sweep - one composition over many diameters, the volumes, charges and amounts per unit volume / surface
+are computed once and the SDEC FP of every diameter is particle volume x volume term + surface area x surface term.
 """
 import warnings
 warnings.filterwarnings('ignore')
 
-from volume_calculator import calculate_volumes
-from formula_utils import log_transform
+from volume_calculator import calculate_volumes, sphere_volume, sphere_surface
+from formula_utils import log_transform, signed_log_transform
 from amount_calculator import calculate_amounts
-from sdec_fp_generator import calculate_sdec_fp
+from sdec_fp_generator import calculate_sdec_fp, SDECEngine
 from collections import defaultdict
-from xgboost import XGBRegressor as xgb
-from catboost import CatBoostRegressor
 import pandas as pd
 import numpy as np
-import joblib
 import json
-import math
-import re
 import os
 
-import seaborn as sns
-import matplotlib.pyplot as plt
-import plotly.express as px
-import json
-import ast
+from resources import load_table, resource_path
+from cell_catalog import CellCatalog, cell_tissue_table
+import instrumentation
+
+model_folder = resource_path('model')
+
+particle_columns = ['Core', 'Shell', 'Doping', 'Doping Rate(%)', 'Coating', 'Diameter(nm)']
+
+
+def load_model(model_folder=model_folder):
+    """Load the CatBoost toxicity model, catboost is imported here so importing this module stays fast"""
+    from catboost import CatBoostRegressor
+    cell_line_best_catboost = CatBoostRegressor()
+    cell_line_best_catboost.load_model(os.path.join(model_folder, 'best_tox_catboost.cbm'))
+    return cell_line_best_catboost
+
+
+def prepare_particles(particles, errors='raise'):
+    """
+    Fill the optional fields of the nanoparticle table the way the volume calculator expects
+
+    errors='collect' adds an 'Error' column and marks rows whose Diameter(nm) is not a positive number
+    instead of raising, their diameter is set to 0.
+    """
+    data = particles[particle_columns].copy()
+    for col in ['Core', 'Shell', 'Doping', 'Doping Rate(%)', 'Coating']:
+        data[col] = data[col].fillna('').astype(str)
+    if errors != 'collect':
+        data['Diameter(nm)'] = data['Diameter(nm)'].astype(float)
+        return data.reset_index(drop=True)
+
+    data = data.reset_index(drop=True)
+    data['Error'] = None
+    diameter = pd.to_numeric(data['Diameter(nm)'], errors='coerce').astype(float)
+    invalid = ~(diameter > 0)
+    for i in np.flatnonzero(invalid.to_numpy()):
+        data.at[i, 'Error'] = {'code': 'invalid_diameter', 'component': 'Diameter(nm)',
+                               'message': f"Diameter(nm) must be a positive number: {data.at[i, 'Diameter(nm)']}"}
+    data['Diameter(nm)'] = diameter.where(~invalid, 0.0)
+    return data
+
+
+def build_design_matrix(df_sdec_log, cell_type):
+    """Stack N SDEC rows against the one-hot cell types into one (N x cells) design matrix"""
+    n_particles = len(df_sdec_log)
+    n_cells = len(cell_type)
+    re_sdec = pd.DataFrame(np.repeat(df_sdec_log.values, n_cells, axis=0),
+                           columns=df_sdec_log.columns)
+    re_cell = pd.DataFrame(np.tile(cell_type.values, (n_particles, 1)),
+                           columns=cell_type.columns)
+    return pd.concat([re_sdec, re_cell], axis=1)
+
+
+class Predictor:
+    """
+    Keep the CatBoost model and every lookup table in memory for repeated predictions.
+
+    The model, the electron configuration table and the cell tables are read once here,
+    the volume lists are loaded once per process by materials_catalog, both through resources.load_table.
+    n_jobs - processes computing the volumes of new formulas, 1 is serial and -1 uses every CPU
+    cache - keep the prediction vector of every canonical particle, see prediction_cache,
+            a sqlite path keeps them between runs. Also enabled by NANOTOX_PREDICTION_CACHE.
+    """
+    def __init__(self, model_folder=model_folder, n_jobs=1, cache=None):
+        self.n_jobs = n_jobs
+        self._domain = None
+        self.model_path = os.path.join(model_folder, 'best_tox_catboost.cbm')
+        self.model = load_model(model_folder)
+        self.cache = None
+        if cache or os.environ.get('NANOTOX_PREDICTION_CACHE'):
+            self.enable_cache(cache if isinstance(cache, str) else None)
+        self.df_atom = load_table('degenerated_electronic_configuration_without_spin.xlsx')
+        self.sdec_engine = SDECEngine(self.df_atom)
+
+        self.cells = CellCatalog.from_csv()
+        self.cell_type = self.cells.cell_type
+        self.cell_info = self.cells.cell_info
+        self.cell_id = self.cells.cell_id
+        self.cell_table = self.cells.cell_table
+        self.cell_tissue = self.cells.cell_tissue
+        self.nest_order = self.cells.nest_order
+
+    def featurize(self, particles):
+        """Log transformed SDEC FP of every particle, one row per particle"""
+        instrumentation.observe('batch_size', len(particles))
+        with instrumentation.stage('prepare_particles'):
+            data = prepare_particles(particles)
+        with instrumentation.stage('calculate_volumes'):
+            volumes = calculate_volumes(data, n_jobs=self.n_jobs)
+        with instrumentation.stage('calculate_amounts'):
+            amounts = calculate_amounts(volumes)
+        with instrumentation.stage('sdec_fp'):
+            return pd.DataFrame(self.sdec_engine.log_fingerprints(amounts), columns=self.sdec_engine.orbitals)
+
+    def featurize_with_errors(self, particles):
+        """
+        Log transformed SDEC FP of the particles that can be handled, and the error of every particle.
 
-# nano particle ready
-nanoparticle = {'Core':'CdSe',
-               'Shell':'',
-               'Doping': '',
-               'Doping Rate(%)': '',
-               'Coating': '',
-               'Diameter(nm)': 500}
+        Returns (fingerprints of the ok rows, boolean mask of the ok rows, list with an error dict or None per particle).
+        A bad particle never stops the batch, see volume_calculator.ComponentError for the error codes.
+        """
+        instrumentation.observe('batch_size', len(particles))
+        with instrumentation.stage('prepare_particles'):
+            data = prepare_particles(particles, errors='collect')
+        with instrumentation.stage('calculate_volumes'):
+            volumes = calculate_volumes(data, errors='collect', n_jobs=self.n_jobs)
+        with instrumentation.stage('calculate_amounts'):
+            amounts = calculate_amounts(volumes, errors='collect')
 
-model_folder = 'model'
+        ok = amounts['Error'].isna().to_numpy()
+        ok_rows = amounts[ok].reset_index(drop=True)
+        try:
+            with instrumentation.stage('sdec_fp'):
+                fingerprints = self.sdec_engine.log_fingerprints(ok_rows)
+        except Exception:
+            # find the rows that break the batch, the others keep their fingerprints
+            rows = []
+            for i in range(len(ok_rows)):
+                try:
+                    rows.append(self.sdec_engine.log_fingerprints(ok_rows.iloc[[i]])[0])
+                except Exception as e:
+                    amounts.at[np.flatnonzero(ok)[i], 'Error'] = {'code': 'fingerprint_error', 'component': 'SDEC FP',
+                                                                  'message': f"{type(e).__name__}: {e}"}
+                    rows.append(None)
+            fingerprints = np.array([row for row in rows if row is not None]).reshape(-1, len(self.sdec_engine.orbitals))
+            ok = amounts['Error'].isna().to_numpy()
 
-data = pd.DataFrame([nanoparticle])
+        errors = [None if ok_row else error for ok_row, error in zip(ok, amounts['Error'])]
+        if instrumentation.enabled:
+            instrumentation.count('failed_particles', int((~ok).sum()))
+        return pd.DataFrame(fingerprints, columns=self.sdec_engine.orbitals), ok, errors
 
-# Tox Model
-cell_line_best_catboost = CatBoostRegressor()
-cell_line_best_catboost.load_model(os.path.join(model_folder, 'best_tox_catboost.cbm'))
+    def score(self, df_sdec_log, selection):
+        """(N x selected cells) predictions of N fingerprints, only the selected cell rows are built and scored"""
+        with instrumentation.stage('design_matrix'):
+            x_data = build_design_matrix(df_sdec_log, self.cells.design_rows(selection))
+        with instrumentation.stage('model_predict'):
+            prediction = self.model.predict(x_data)
+        return prediction.reshape(len(df_sdec_log), len(selection))
 
-# Needed Data
-df_atom = pd.read_excel('degenerated_electronic_configuration_without_spin.xlsx')
+    def enable_cache(self, path=None, maxsize=65536):
+        """Serve repeated particles from a PredictionCache, path is an optional sqlite file"""
+        from prediction_cache import open_cache
+        self.cache = open_cache(self.model_path, path, maxsize)
+        return self.cache
 
-# Only Cell lines
-cell_type = pd.read_csv('cell_type_test_data.csv')
+    def cached_predictions(self, particles, errors='exit'):
+        """
+        (N x all cells) predictions of the particles, and the error of every particle.
 
-# All Cell info
-cell_info = pd.read_csv('cell_all_info_test.csv')
+        Known particles come from self.cache under their canonical key, the distinct unknown ones are scored
+        together as they were submitted and stored. Errors are kept per exact particle, they are never cached.
+        """
+        from prediction_cache import canonical_particle, particle_key, exact_key
+        records = particles.to_dict('records')
+        keys = [particle_key(canonical_particle(particle)) for particle in records]
+        found = self.cache.get_many(keys)
+
+        if instrumentation.enabled:
+            hits = sum(key in found for key in keys)
+            instrumentation.count('cache_hits', hits, cache='prediction')
+            instrumentation.count('cache_misses', len(keys) - hits, cache='prediction')
+        # the first row of every distinct submitted particle the cache does not know
+        first = {}
+        for i, (particle, key) in enumerate(zip(records, keys)):
+            if key not in found:
+                first.setdefault(exact_key(particle), i)
+        failed = {}
+        if first:
+            rows = list(first.values())
+            todo = particles.iloc[rows]
+            all_cells = np.arange(len(self.cell_id))
+            if errors == 'collect':
+                df_sdec_log, ok, todo_errors = self.featurize_with_errors(todo)
+                prediction = self.score(df_sdec_log, all_cells) if ok.any() else np.empty((0, len(all_cells)))
+                failed = {exact: error for exact, error, ok_row in zip(first, todo_errors, ok) if not ok_row}
+                scored = [row for row, ok_row in zip(rows, ok) if ok_row]
+            else:
+                prediction = self.score(self.featurize(todo), all_cells)
+                scored = rows
+            scored_keys = [keys[row] for row in scored]
+            self.cache.put_many(zip(scored_keys, prediction))
+            found.update(zip(scored_keys, prediction))
+
+        matrix = np.full((len(keys), len(self.cell_id)), np.nan)
+        particle_errors = [None] * len(keys)
+        for i, key in enumerate(keys):
+            error = failed.get(exact_key(records[i])) if failed else None
+            if error is not None:
+                particle_errors[i] = error
+            elif key in found:
+                matrix[i] = found[key]
+        return matrix, particle_errors
+
+    def predict_matrix(self, particles, cells=None, tissues=None):
+        """
+        Predictions as an (N particles x cells) array in the order of self.cell_id
+
+        cells / tissues keep only the listed cell lines or tissues, the columns follow self.cells.select(cells, tissues).
+        """
+        selection = self.cells.select(cells, tissues)
+        if self.cache is not None:
+            return self.cached_predictions(particles)[0][:, selection]
+        return self.score(self.featurize(particles), selection)
+
+    def predict_with_errors(self, particles, cells=None, tissues=None):
+        """
+        Error tolerant predict_matrix.
+
+        Returns the (N particles x cells) array with NaN rows for the particles that failed,
+        and a list holding an error dict (code, component, message) or None for every particle.
+        """
+        selection = self.cells.select(cells, tissues)
+        if self.cache is not None:
+            prediction, errors = self.cached_predictions(particles, errors='collect')
+            return prediction[:, selection], errors
+        df_sdec_log, ok, errors = self.featurize_with_errors(particles)
+        prediction = np.full((len(ok), len(selection)), np.nan)
+        if ok.any():
+            prediction[ok] = self.score(df_sdec_log, selection)
+        return prediction, errors
+
+    def predict_batch(self, particles, errors='exit', cells=None, tissues=None, domain=False):
+        """
+        Predict the cytotoxicity of every nanoparticle in particles for all cell types, or the cells / tissues listed.
+
+        particles needs the columns Core, Shell, Doping, Doping Rate(%), Coating and Diameter(nm).
+        The result is tidy: one row per (Particle, Cell-identification) with its Cell-tissue and Prediction,
+        Particle is the index label of the input row.
+        errors='collect' keeps going past bad particles: their Prediction is NaN and
+        the 'Error' column holds the error dict (code, component, message), None for the others.
+        domain=True adds the applicability domain columns of every particle, see applicability_domain.
+        """
+        selection = self.cells.select(cells, tissues)
+        if not domain and errors == 'collect':
+            prediction, particle_errors = self.predict_with_errors(particles, cells, tissues)
+        elif not domain:
+            prediction = self.predict_matrix(particles, cells, tissues)
+        elif errors == 'collect':
+            df_sdec_log, ok, particle_errors = self.featurize_with_errors(particles)
+            prediction = np.full((len(ok), len(selection)), np.nan)
+            if ok.any():
+                prediction[ok] = self.score(df_sdec_log, selection)
+        else:
+            df_sdec_log = self.featurize(particles)
+            ok = np.ones(len(df_sdec_log), dtype=bool)
+            prediction = self.score(df_sdec_log, selection)
+        metadata = self.cells.metadata(selection)
+        n_cells = len(selection)
+        result = pd.DataFrame({
+            'Particle': np.repeat(particles.index.values, n_cells),
+            'Cell-identification': np.tile(metadata['cells'], len(particles)),
+            'Cell-tissue': np.tile(metadata['tissues'], len(particles)),
+            'Prediction': prediction.ravel(),
+        })
+        if errors == 'collect':
+            particle_errors_array = np.empty(len(particle_errors), dtype=object)
+            particle_errors_array[:] = particle_errors
+            result['Error'] = np.repeat(particle_errors_array, n_cells)
+        if domain:
+            # failed particles keep NaN distances and are outside the domain
+            flags = self.domain().evaluate(df_sdec_log).set_index(np.flatnonzero(ok)).reindex(range(len(ok)))
+            for column in flags.columns:
+                values = flags[column].to_numpy()
+                if column.startswith('In '):
+                    values = values == True
+                result[column] = np.repeat(values, n_cells)
+        return result
+
+    def domain(self):
+        """ApplicabilityDomain of the training set, built on first use"""
+        if self._domain is None:
+            from applicability_domain import ApplicabilityDomain
+            self._domain = ApplicabilityDomain.from_training_data(self.sdec_engine.orbitals)
+        return self._domain
+
+    def predict(self, nanoparticle, cells=None, tissues=None):
+        """Nested {tissue: {cell: prediction}} result of a single nanoparticle dict"""
+        return self.nest(self.predict_matrix(pd.DataFrame([nanoparticle]), cells, tissues)[0], cells, tissues)
+
+    def nest(self, prediction, cells=None, tissues=None):
+        """Turn one row of predict_matrix, with the same cells / tissues, into the nested tissue -> cell dictionary"""
+        prediction = prediction.tolist()
+        if cells is not None or tissues is not None:
+            # position of every selected column in the row
+            position = {column: i for i, column in enumerate(self.cells.select(cells, tissues))}
+            prediction = [prediction[position[column]] if column in position else None for column in range(len(self.cell_id))]
+        nested_result = defaultdict(dict)
+        for cell_tissue, cell_id, column in self.nest_order:
+            if prediction[column] is not None:
+                nested_result[cell_tissue][cell_id] = prediction[column]
+        return dict(nested_result)
+
+    def fingerprint_basis(self, composition):
+        """
+        (volume term, surface term) of the raw SDEC FP of one composition.
+
+        Core and doping amounts grow with the particle volume, shell and coating amounts with its surface area,
+        so the SDEC FP at any diameter is particle volume * volume term + surface area * surface term.
+        """
+        particle = dict(composition, **{'Diameter(nm)': 1.0})
+        data = prepare_particles(pd.DataFrame([particle, particle]))
+        volumes = calculate_volumes(data, n_jobs=self.n_jobs)
+        volumes['Particle Volume (nm^3)'] = [1.0, 0.0]
+        volumes['Particle Surface Area (nm^2)'] = [0.0, 1.0]
+        volume_term, surface_term = self.sdec_engine.fingerprints(calculate_amounts(volumes))
+        return volume_term, surface_term
+
+    def predict_diameter_sweep(self, composition, diameters, cells=None, tissues=None):
+        """
+        Predictions of one composition at every diameter, scored in one batched call.
+
+        composition has the keys Core, Shell, Doping, Doping Rate(%) and Coating, Diameter(nm) is ignored.
+        Returns the predict_batch layout with a Diameter(nm) column in place of Particle.
+        """
+        diameters = np.asarray(diameters, dtype=float).ravel()
+        ## WARNING MESSAGE
+        if not (diameters > 0).all():
+            raise ValueError("Diameter(nm) of a sweep must be positive")
+
+        volume_term, surface_term = self.fingerprint_basis(composition)
+        # the particle volume and surface of mc_np_vol_surface
+        fingerprints = np.outer(sphere_volume(diameters), volume_term) + np.outer(sphere_surface(diameters), surface_term)
+        df_sdec_log = pd.DataFrame(signed_log_transform(fingerprints), columns=self.sdec_engine.orbitals)
+
+        selection = self.cells.select(cells, tissues)
+        prediction = self.score(df_sdec_log, selection)
+        metadata = self.cells.metadata(selection)
+        return pd.DataFrame({
+            'Diameter(nm)': np.repeat(diameters, len(selection)),
+            'Cell-identification': np.tile(metadata['cells'], len(diameters)),
+            'Cell-tissue': np.tile(metadata['tissues'], len(diameters)),
+            'Prediction': prediction.ravel(),
+        })
 
+    def cell_metadata(self, cells=None, tissues=None):
+        """Cell-identification and Cell-tissue of every column of predict_matrix, stored once next to a matrix output"""
+        return self.cells.metadata(self.cells.select(cells, tissues))
 
-# To generate volumes
-volumes = calculate_volumes(data)
 
-# To generate amounts
-amounts = calculate_amounts(volumes)
+_default_predictor = None
 
-# To generate SDEC FP
-sdec_fp = calculate_sdec_fp(amounts, df_atom=df_atom)
 
-df_sdec_log = sdec_fp.apply(lambda x: x.map(log_transform))
+def get_predictor():
+    """Shared Predictor of this process, created on first use"""
+    global _default_predictor
+    if _default_predictor is None:
+        _default_predictor = Predictor()
+    return _default_predictor
 
-cell_id = [col for col in cell_info.columns if 'Cell-identification' in col]
 
-re_sdec = pd.concat([df_sdec_log] * len(cell_type), ignore_index=True)
-x_data = pd.concat([re_sdec, cell_type], axis = 1)
+def predict_batch(particles, predictor=None, errors='exit', cells=None, tissues=None, domain=False):
+    """
+    Predict the cytotoxicity of every nanoparticle in particles for all cell types.
 
+    Uses the shared Predictor unless one is given, see Predictor.predict_batch for the result layout and errors.
+    """
+    if predictor is None:
+        predictor = get_predictor()
+    return predictor.predict_batch(particles, errors=errors, cells=cells, tissues=tissues, domain=domain)
 
-### Save prediction Result ###
-prediction = cell_line_best_catboost.predict(x_data)
-result = {cell: float(pred) for cell, pred in zip(cell_id, prediction)}
-cell_tissue = [col for col in cell_info.columns if 'Cell-tissue' in col]
 
-cell_id_with_tissue = []
+def predict_diameter_sweep(composition, diameters, predictor=None, cells=None, tissues=None):
+    """
+    Predictions of one composition over a grid of diameters, e.g. np.linspace(1, 700, 700).
 
-for index, row in cell_info.iterrows():
-    id_columns_with_1 = [col for col in cell_id if row[col] == 1]
-    tissue_columns_with_1 = [col for col in cell_tissue if row[col] == 1]
-    combined_columns = id_columns_with_1 + tissue_columns_with_1
+    Uses the shared Predictor unless one is given, see Predictor.predict_diameter_sweep.
+    """
+    if predictor is None:
+        predictor = get_predictor()
+    return predictor.predict_diameter_sweep(composition, diameters, cells=cells, tissues=tissues)
 
-    cell_id_with_tissue.append(combined_columns)
 
-df = pd.DataFrame(cell_id_with_tissue, columns=['Cell-identification', 'Cell-tissue'])
+if __name__ == '__main__':
+    # nano particle ready
+    nanoparticle = {'Core':'CdSe',
+                   'Shell':'',
+                   'Doping': '',
+                   'Doping Rate(%)': '',
+                   'Coating': '',
+                   'Diameter(nm)': 500}
 
-### output: JSON ###
-nested_result = defaultdict(dict)
-for _, row in df.iterrows():
-    cell_id = row['Cell-identification']
-    cell_tissue = row['Cell-tissue'].replace('Cell-tissue-organ-origin_', '')
-    
-    if cell_id in result:
-        nested_result[cell_tissue][cell_id] = result[cell_id]
+    predictor = Predictor()
 
-final_result = dict(nested_result)
+    ### Save prediction Result ###
+    prediction = predictor.predict_matrix(pd.DataFrame([nanoparticle]))[0]
+    result = {cell: float(pred) for cell, pred in zip(predictor.cell_id, prediction)}
 
-import pprint
-print(f"final result has been saved successfully")
-pprint.pprint(json.dumps(final_result))
+    ### output: JSON ###
+    final_result = predictor.nest(prediction)
 
-### output: csv file ###
-data_for_df = []
-for _, row in df.iterrows():
-    cell_id = row['Cell-identification']
-    cell_tissue = row['Cell-tissue'].replace('Cell-tissue-organ-origin_', '')
+    import pprint
+    print(f"final result has been saved successfully")
+    pprint.pprint(json.dumps(final_result))
 
-    if cell_id in result:
+    ### output: csv file ###
+    data_for_df = []
+    for cell_tissue, cell_id, _ in predictor.nest_order:
         data_for_df.append({
             'Cell-tissue': cell_tissue.lower(),
             'Cell-identification': cell_id.split('_')[-1],
             'Prediction': round(result[cell_id],3)
         })
 
-# Convert the list of dictionaries into a DataFrame
-df_pred = pd.DataFrame(data_for_df)
+    # Convert the list of dictionaries into a DataFrame
+    df_pred = pd.DataFrame(data_for_df)
 
-# Save the DataFrame to a CSV file
-df_pred.sort_values(by='Cell-tissue').to_csv('result_from_model.csv', index=False)
-print(f"final result has been saved successfully")
\ No newline at end of file
+    # Save the DataFrame to a CSV file
+    df_pred.sort_values(by='Cell-tissue').to_csv('result_from_model.csv', index=False)
+    print(f"final result has been saved successfully")
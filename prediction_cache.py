@@ -0,0 +1,193 @@
+"""
+Prediction Cache
+
+Repeated nanoparticles are scored once: the full 110 cell prediction vector is kept under a key of the canonical particle.
+
+canonical_particle - the fields as the pipeline reads them (missing text is '', nothing stripped or rounded),
+                     only orders that provably give the same prediction are normalized:
+                     two shells or two coatings (their volumes and element counts are summed, a + b == b + a,
+                     not so in floating point for three) and two dopings of different single elements with their rates.
+                     Other dopings keep their order, the SDEC FP pairs the merged elements of the dopings
+                     with their amounts in order (see sdec_fp_generator.component_amounts).
+                     The formulas themselves keep their element order, it decides ties in the charge balance
+                     (see volume_cache), so 'SiO2' and 'O2Si' are different particles.
+PredictionCache    - in-process LRU, optionally backed by a sqlite file, every entry is tagged with model_tag(),
+                     a hash of the model file and the lookup tables, so a new model or table invalidates the stored vectors.
+
+The canonical particle is only the key, the pipeline always scores the particles as they were submitted,
+so predictions and errors are the same with and without the cache.
+
+Created by Jaehyeon Park
+"""
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from formula_tokenizer import FormulaError, element_counts
+from resources import file_hash, resource_path
+from volume_cache import tables_checksum
+
+# bump when the prediction pipeline changes without a change of the model or the tables
+CACHE_VERSION = 2
+
+lookup_files = ['degenerated_electronic_configuration_without_spin.xlsx', 'cell_type_test_data.csv', 'cell_all_info_test.csv']
+
+
+def model_tag(model_path):
+    """sha256 of the model file, the lookup tables, radii_collection and the volume lists"""
+    digest = hashlib.sha256(f"v{CACHE_VERSION}".encode())
+    digest.update(file_hash(model_path).encode())
+    for name in lookup_files:
+        digest.update(file_hash(resource_path(name)).encode())
+    digest.update(tables_checksum().encode())
+    return digest.hexdigest()
+
+
+def text(value):
+    """A text field as prepare_particles reads it, '' for missing values"""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ''
+    return str(value)
+
+
+def number(value):
+    """Exact float text of a number, other values are kept as text"""
+    if isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, bool):
+        return repr(float(value))
+    return ['text', text(value)]
+
+
+def sorted_pair(value):
+    """'B/A' -> 'A/B' for two items, other entries are returned unchanged"""
+    items = value.split('/')
+    return '/'.join(sorted(items)) if len(items) == 2 else value
+
+
+def single_element(formula):
+    """The element of a formula of one element, e.g. 'Au' or 'O2', otherwise None"""
+    counts = element_counts(formula)
+    return counts[0][0] if len(counts) == 1 else None
+
+
+def canonical_particle(particle):
+    """Canonical Core, Shell, Doping, Doping Rate(%), Coating and Diameter(nm) of a nanoparticle dict, the cache key"""
+    doping = text(particle.get('Doping'))
+    rate = text(particle.get('Doping Rate(%)'))
+    dopings, rates = doping.split('/'), rate.split('/')
+    if len(dopings) == 2 and len(rates) == 2:
+        # the order of two dopings of different single elements changes neither the element amounts
+        # nor the total doping ratio the core is left with (a + b == b + a, not so for three)
+        try:
+            elements = {single_element(item) for item in dopings}
+        except FormulaError:
+            elements = {None}
+        if None not in elements and len(elements) == 2:
+            pairs = sorted(zip(dopings, rates))
+            doping, rate = '/'.join(pair[0] for pair in pairs), '/'.join(pair[1] for pair in pairs)
+    return {'Core': text(particle.get('Core')),
+            'Shell': sorted_pair(text(particle.get('Shell'))),
+            'Doping': doping,
+            'Doping Rate(%)': rate,
+            'Coating': sorted_pair(text(particle.get('Coating'))),
+            'Diameter(nm)': number(particle.get('Diameter(nm)'))}
+
+
+def exact_key(particle):
+    """Key of a particle exactly as submitted"""
+    text_fields = [text(particle.get(col)) for col in ['Core', 'Shell', 'Doping', 'Doping Rate(%)', 'Coating']]
+    return json.dumps(text_fields + [number(particle.get('Diameter(nm)'))])
+
+
+def particle_key(canonical):
+    """Content address of a canonical particle"""
+    text = json.dumps([canonical[col] for col in ['Core', 'Shell', 'Doping', 'Doping Rate(%)', 'Coating', 'Diameter(nm)']])
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class PredictionCache:
+    """
+    LRU of particle key -> prediction vector, with an optional sqlite store behind it.
+
+    get_many(keys) returns the known vectors, put(key, vector) keeps one. Only successful predictions are stored.
+    """
+    def __init__(self, tag, maxsize=65536, path=None):
+        self.tag = tag
+        self.maxsize = maxsize
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        if path:
+            self.open(path)
+
+    def open(self, path):
+        """Use the sqlite file at path as the persistent store"""
+        self.close()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS predictions (
+                                   key TEXT, tag TEXT, prediction BLOB, PRIMARY KEY (key, tag))""")
+        # vectors of another model or other tables are never read again
+        self.connection.execute("DELETE FROM predictions WHERE tag != ?", (self.tag,))
+        self.connection.commit()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+
+    def _remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def get_many(self, keys):
+        """{key: vector} of the keys found in memory or in the sqlite store"""
+        found, missing = {}, []
+        with self.lock:
+            for key in dict.fromkeys(keys):
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[key] = self.memory[key]
+                else:
+                    missing.append(key)
+            if missing and self.connection is not None:
+                for start in range(0, len(missing), 500):
+                    batch = missing[start:start + 500]
+                    rows = self.connection.execute(
+                        f"SELECT key, prediction FROM predictions WHERE tag = ? AND key IN ({','.join('?' * len(batch))})",
+                        [self.tag] + batch).fetchall()
+                    for key, blob in rows:
+                        found[key] = np.frombuffer(blob, dtype=np.float64)
+                        self._remember(key, found[key])
+            self.hits += len(found)
+            self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put_many(self, items):
+        """Keep every (key, vector) of items"""
+        items = [(key, np.asarray(vector, dtype=np.float64)) for key, vector in items]
+        with self.lock:
+            for key, vector in items:
+                self._remember(key, vector)
+            if self.connection is not None:
+                self.connection.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)",
+                                            [(key, self.tag, vector.tobytes()) for key, vector in items])
+                self.connection.commit()
+
+
+def open_cache(model_path, path=None, maxsize=65536):
+    """PredictionCache tagged for the model at model_path, path defaults to NANOTOX_PREDICTION_CACHE"""
+    return PredictionCache(model_tag(model_path), maxsize=maxsize,
+                           path=path or os.environ.get('NANOTOX_PREDICTION_CACHE'))
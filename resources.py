@@ -0,0 +1,90 @@
+"""
+Resources
+
+Data files of NanoToxRadar are found next to this module, not in the working directory.
+
+load_table(name) - parse a bundled CSV / Excel table once per process.
+The parsed DataFrame is also pickled to the resource cache under the sha256 of the source file,
+later starts load the pickle instead of parsing the file again, and editing the file changes its key.
+
+The cache lives in NANOTOX_CACHE_DIR, default .resource_cache next to this module.
+If it cannot be written (read-only install) tables are parsed from the source files as before.
+
+Created by Jaehyeon Park
+"""
+import hashlib
+import os
+import pickle
+
+import pandas as pd
+
+package_dir = os.path.dirname(os.path.abspath(__file__))
+cache_dir = os.environ.get('NANOTOX_CACHE_DIR', os.path.join(package_dir, '.resource_cache'))
+
+_tables = {}
+
+
+def resource_path(name):
+    """Absolute path of a bundled file, absolute names are returned unchanged"""
+    return os.path.join(package_dir, name)
+
+
+def file_hash(path):
+    """sha256 of the file at path"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_table(path):
+    """Parse a CSV or Excel file into a DataFrame"""
+    if path.endswith(('.xlsx', '.xls')):
+        return pd.read_excel(path)
+    return pd.read_csv(path)
+
+
+def cached_table_path(path, digest):
+    return os.path.join(cache_dir, f"{os.path.basename(path)}.{digest[:16]}.pkl")
+
+
+def remove_stale(path, current):
+    """Delete cached pickles of earlier versions of the file at path"""
+    prefix = os.path.basename(path) + '.'
+    for file_name in os.listdir(cache_dir):
+        cached = os.path.join(cache_dir, file_name)
+        if file_name.startswith(prefix) and file_name.endswith('.pkl') and cached != current:
+            os.remove(cached)
+
+
+def load_table(name):
+    """
+    DataFrame of a bundled table, parsed once per process and cached on disk by file hash.
+
+    Every call returns a copy so callers may modify it freely.
+    """
+    path = resource_path(name)
+    if path not in _tables:
+        digest = file_hash(path)
+        cached = cached_table_path(path, digest)
+        table = None
+        if os.path.exists(cached):
+            try:
+                with open(cached, 'rb') as f:
+                    table = pickle.load(f)
+            except Exception:
+                table = None
+        if table is None:
+            table = read_table(path)
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                temporary = f"{cached}.{os.getpid()}.tmp"
+                with open(temporary, 'wb') as f:
+                    pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(temporary, cached)
+                remove_stale(path, cached)
+            except OSError:
+                pass
+        _tables[path] = table
+    return _tables[path].copy()
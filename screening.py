@@ -0,0 +1,468 @@
+"""
+Design space screening
+
+Ranks every core x shell x doping x coating combination of the bundled volume lists,
+over a grid of diameters and doping rates, by the predicted cytotoxicity across the selected cells.
+
+The cartesian product is generated lazily and scored in chunks of compositions, only the current top-k is kept in memory.
+Every component (core, shell, dopant at a doping rate, coating) is solved once: its volume comes from volume_cache
+and its element amounts and SDEC FP contribution per unit particle volume or surface are cached.
+The SDEC FP of a composition is the sum of its component contributions, less the elements a later component
+takes over (see sdec_fp_generator.component_amounts), at any diameter (see Predictor.fingerprint_basis).
+
+Pruning
+- components outside the domain of the volume calculator are dropped before the product is generated,
+  diameters / doping rates outside the range the model was trained on are dropped from the grid
+- components with the same contribution as an earlier one are merged, so those duplicate compositions are never generated,
+  the top-k keeps one candidate per SDEC FP (e.g. a core whose elements the shell all takes over), the only fingerprint
+  set kept is the one of its k members
+- a composition whose score bound over all its diameters cannot beat the current top-k is not scored (ScoreBound)
+- --domain-only drops the candidates outside the applicability domain before they are scored,
+  otherwise every candidate gets the applicability domain flags of applicability_domain
+
+python screening.py --top-k 20 --diameters 10 50 100 --doping-rates 1 5 --tissues lung
+python screening.py --cores TiO2 ZnO --shells "" --coatings "" PEG --top-k 5 --smallest
+
+Created by Jaehyeon Park
+"""
+import argparse
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from formula_utils import signed_log_transform
+from materials_catalog import catalog
+from prediction import Predictor, model_folder, particle_columns
+from sdec_fp_generator import component_amounts, coating_formula
+from volume_cache import volume_cache
+from volume_calculator import component_volumes, prefetch_volumes, sphere_volume, sphere_surface
+from amount_calculator import calculate_doping_amount_columns
+
+# ranges of the training data, see README
+diameter_range = (1, 700)
+doping_rate_range = (1, 100)
+
+domain_columns = ['kNN distance', 'Leverage', 'In kNN domain', 'In leverage domain', 'In domain']
+
+aggregates = {'mean': np.mean, 'max': np.max, 'min': np.min, 'median': np.median}
+
+# enumeration order of the grid, one ComponentTable each
+roles = ['core', 'shell', 'doping', 'coating']
+
+
+def listed(role):
+    """Names of the volume list of role in file order"""
+    return list(catalog.volume_maps[role])
+
+
+def component_volume(role, name):
+    """Volume of one component through volume_cache, None when the volume calculator cannot handle it"""
+    try:
+        volume = volume_cache.get(role, name, component_volumes[role][1])
+    except Exception:
+        return None
+    if volume is None or (isinstance(volume, float) and np.isnan(volume)):
+        return None
+    return volume
+
+
+class ComponentTable:
+    """
+    Element amounts of the components of one role per unit particle volume (core, doping) or surface (shell, coating).
+
+    names - the component of every row, the first of every group of components with the same amounts
+    amounts, present - (components x elements) amounts and which elements the component sets
+    contributions - (components x orbitals) raw SDEC FP of every component alone
+    ratio - total doping ratio of the row, it scales the core amounts
+    members - components merged into every row, invalid - components the calculator cannot handle
+    """
+    def __init__(self, sdec_engine, entries):
+        self.names, self.ratio, self.members, self.invalid = [], [], [], 0
+        amounts, present, rows = [], [], {}
+        for name, element_amounts, ratio in entries:
+            if element_amounts is None:
+                self.invalid += 1
+                continue
+            amount = np.zeros(len(sdec_engine.elements))
+            mask = np.zeros(len(sdec_engine.elements), dtype=bool)
+            for elem, value in element_amounts.items():
+                if elem in sdec_engine.element_index:
+                    amount[sdec_engine.element_index[elem]] = value
+                    mask[sdec_engine.element_index[elem]] = True
+            key = (amount.tobytes(), mask.tobytes(), ratio)
+            if key in rows:
+                self.members[rows[key]] += 1
+                continue
+            rows[key] = len(self.names)
+            self.names.append(name)
+            self.ratio.append(ratio)
+            self.members.append(1)
+            amounts.append(amount)
+            present.append(mask)
+        shape = (len(self.names), len(sdec_engine.elements))
+        self.amounts = np.array(amounts).reshape(shape)
+        self.present = np.array(present, dtype=bool).reshape(shape)
+        self.ratio = np.asarray(self.ratio, dtype=float)
+        self.contributions = self.amounts @ sdec_engine.orbital_matrix
+
+    def __len__(self):
+        return len(self.names)
+
+
+class ScoreBound:
+    """
+    Bound of the score of a composition over all of its diameters, without scoring it.
+
+    The model is a sum of oblivious trees, every level of a tree tests one feature against a border.
+    Over the diameters each fingerprint feature stays between its lowest and highest value, so a level can only
+    take the branches that interval reaches, while the one-hot cell features are fixed for every cell.
+    The best reachable leaf of every tree, summed, bounds the prediction of a cell at every diameter
+    (highest for largest, lowest otherwise), and mean, max, min and median never decrease when one of their cells does.
+    Cells that take the same branches of a tree share its evaluation, a tree without cell levels is evaluated once.
+    """
+    def __init__(self, model, n_fingerprint, design_rows, largest=True, block_size=2 ** 22):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'model.json')
+            model.save_model(path, format='json')
+            with open(path) as f:
+                exported = json.load(f)
+        flat_index = [feature['flat_feature_index'] for feature in exported['features_info'].get('float_features', [])]
+        scale, bias = exported.get('scale_and_bias', [1.0, [0.0]])
+        self.scale = scale
+        self.bias = bias[0] if isinstance(bias, list) else bias
+        self.largest = largest
+        self.high = (scale > 0) == largest
+        self.block_size = block_size
+
+        trees = exported['oblivious_trees']
+        self.depth = max(len(tree['splits']) for tree in trees)
+        cells = design_rows.to_numpy(dtype=np.float32)
+        features, borders, fixed, leaves, columns = [], [], [], [], []
+        for tree in trees:
+            splits = tree['splits']
+            values = np.asarray(tree['leaf_values'], dtype=float)
+            ## WARNING MESSAGE
+            if any(split['split_type'] != 'FloatFeature' for split in splits) or len(values) != 2 ** len(splits):
+                raise ValueError("ScoreBound needs a one dimensional model of float feature oblivious trees")
+            # shallower trees get levels that do not change the leaf
+            values = np.tile(values, 2 ** (self.depth - len(splits)))
+            feature = [flat_index[split['float_feature_index']] for split in splits] + [0] * (self.depth - len(splits))
+            border = [split['border'] for split in splits] + [0.0] * (self.depth - len(splits))
+            cell_levels = [level for level, f in enumerate(feature) if level < len(splits) and f >= n_fingerprint]
+
+            # the branch every cell takes at the cell levels
+            bits = np.array([cells[:, feature[level] - n_fingerprint] > np.float32(border[level])
+                             for level in cell_levels], dtype=bool).reshape(len(cell_levels), len(cells)).T
+            patterns, pattern_of_cell = np.unique(bits, axis=0, return_inverse=True)
+            for pattern_index, pattern in enumerate(patterns):
+                level_fixed = np.full(self.depth, -1, dtype=np.int8)
+                level_fixed[len(splits):] = 0
+                level_fixed[cell_levels] = pattern
+                features.append([0 if level_fixed[level] >= 0 else f for level, f in enumerate(feature)])
+                borders.append(border)
+                fixed.append(level_fixed)
+                leaves.append(values if self.high else -values)
+                columns.append(np.ravel(pattern_of_cell) == pattern_index)
+
+        self.features = np.array(features, dtype=np.intp)
+        self.borders = np.array(borders, dtype=np.float32)
+        self.fixed = np.array(fixed, dtype=np.int8)
+        self.leaves = np.array(leaves)
+        self.cells = np.array(columns, dtype=float)
+
+    def __call__(self, low, high):
+        """(compositions x cells) bound of the prediction, low and high are the (compositions x features) intervals"""
+        # the model compares float32 features with float32 borders
+        low, high = np.asarray(low, dtype=np.float32), np.asarray(high, dtype=np.float32)
+        free = self.fixed < 0
+        block = max(1, self.block_size // self.leaves.size)
+        best = np.empty((len(low), len(self.leaves)))
+        for start in range(0, len(low), block):
+            can_high = np.where(free, high[start:start + block, self.features] > self.borders, self.fixed == 1)
+            can_low = np.where(free, low[start:start + block, self.features] <= self.borders, self.fixed == 0)
+            values = self.leaves[None]
+            # the last level is the highest bit of the leaf index
+            for level in range(self.depth - 1, -1, -1):
+                half = values.shape[-1] // 2
+                values = np.maximum(np.where(can_low[:, :, level, None], values[..., :half], -np.inf),
+                                    np.where(can_high[:, :, level, None], values[..., half:], -np.inf))
+            best[start:start + block] = values[..., 0]
+        sums = best @ self.cells
+        return self.scale * (sums if self.high else -sums) + self.bias
+
+
+class ScreeningEngine:
+    """
+    Lazy screen of a composition grid.
+
+    cores, shells, dopings, coatings - names to combine, default every listed core and '' plus every listed shell,
+    dopant and coating. '' means without the component.
+    aggregate - how the predictions of the selected cells become one score: mean, max, min or median.
+    domain_only - skip candidates outside the applicability domain instead of only flagging them.
+    bound - skip the compositions ScoreBound shows cannot enter the top-k.
+    stats counts the compositions generated, out of the calculator domain, merged as duplicates and pruned by the bound,
+    and the candidates (composition x diameter) outside the applicability domain, scored and
+    left out of the top-k as duplicates of a member.
+    """
+    def __init__(self, predictor, cores=None, shells=None, dopings=None, coatings=None,
+                 diameters=(10, 50, 100), doping_rates=(1, 5, 10), cells=None, tissues=None,
+                 aggregate='mean', chunk_size=512, domain_only=False, bound=True):
+        self.predictor = predictor
+        self.cores = listed('core') if cores is None else list(cores)
+        self.shells = [''] + listed('shell') if shells is None else list(shells)
+        self.dopings = [''] + listed('doping') if dopings is None else list(dopings)
+        self.coatings = [''] + listed('coating') if coatings is None else list(coatings)
+        self.diameters = np.asarray(diameters, dtype=float)
+        self.doping_rates = [rate for rate in doping_rates]
+        self.selection = predictor.cells.select(cells, tissues)
+        self.aggregate = aggregates[aggregate]
+        self.chunk_size = chunk_size
+        self.domain = predictor.domain()
+        self.domain_only = domain_only
+        self.bound = bound
+        self.tables = None
+        self.stats = dict.fromkeys(['compositions', 'out_of_domain', 'duplicates', 'bounded', 'outside_ad', 'scored'], 0)
+
+        ## WARNING MESSAGE
+        self.diameters = self.diameters[(self.diameters >= diameter_range[0]) & (self.diameters <= diameter_range[1])]
+        self.doping_rates = [rate for rate in self.doping_rates if doping_rate_range[0] <= float(rate) <= doping_rate_range[1]]
+        if len(self.diameters) == 0:
+            raise ValueError(f"no diameter inside {diameter_range[0]}-{diameter_range[1]} nm to screen")
+
+    def size(self):
+        """Number of compositions in the grid, without the diameters"""
+        doped = sum(1 for doping in self.dopings if doping != '')
+        dopings = (len(self.dopings) - doped) + doped * len(self.doping_rates)
+        return len(self.cores) * len(self.shells) * dopings * len(self.coatings)
+
+    def doping_options(self):
+        for doping in self.dopings:
+            if doping == '':
+                yield '', ''
+            else:
+                for rate in self.doping_rates:
+                    yield doping, f"{rate:g}" if isinstance(rate, float) else str(rate)
+
+    def component_tables(self):
+        """{role: ComponentTable} of the grid, built once"""
+        if self.tables is not None:
+            return self.tables
+        names = {'core': self.cores, 'shell': self.shells, 'doping': self.dopings, 'coating': self.coatings}
+        if self.predictor.n_jobs != 1:
+            longest = max(len(column) for column in names.values())
+            prefetch_volumes(pd.DataFrame({component_volumes[role][0]: column + [''] * (longest - len(column))
+                                           for role, column in names.items()}), self.predictor.n_jobs)
+        volumes = {role: {name: component_volume(role, name) for name in column} for role, column in names.items()}
+
+        def unit_amounts(role, name, volume):
+            """Element amounts of a shell, coating or core at unit particle surface or volume"""
+            if volume is None or (role == 'core' and not volume):
+                return None
+            amount = 1.0 / volume if volume else 0.0
+            if role == 'core':
+                return component_amounts(name, '', '', '', amount, 0, 0, 0)
+            if role == 'shell':
+                return component_amounts('', '', name, '', 0, 0, amount, 0)
+            return component_amounts('', '', '', coating_formula(name), 0, 0, 0, amount)
+
+        def doping_amounts(doping, rate):
+            """(element amounts at unit particle volume, total doping ratio) of a dopant at a doping rate"""
+            if doping == '' or rate == '':
+                return {}, 0.0
+            volume = volumes['doping'][doping]
+            if volume is None:
+                return None, 0.0
+            amount, ratio, failure = calculate_doping_amount_columns(
+                np.ones(1), np.array([rate], dtype=object), np.array([volume], dtype=object), errors='collect')
+            if failure[0] is not None:
+                return None, 0.0
+            return component_amounts('', doping, '', '', 0, amount[0], 0, 0), float(ratio[0])
+
+        sdec_engine = self.predictor.sdec_engine
+        tables = {role: ComponentTable(sdec_engine, [(name, unit_amounts(role, name, volumes[role][name]), 0.0)
+                                                    for name in names[role]])
+                  for role in ['core', 'shell', 'coating']}
+        tables['doping'] = ComponentTable(sdec_engine, [((doping, rate),) + doping_amounts(doping, rate)
+                                                        for doping, rate in self.doping_options()])
+        self.tables = tables
+        return tables
+
+    def grid(self):
+        """(core, shell, doping, coating) row indexes of every composition left to generate, lazily"""
+        tables = self.component_tables()
+        return itertools.product(*(range(len(tables[role])) for role in roles))
+
+    def compositions(self):
+        """Every composition generated by screen as a dict, lazily"""
+        for rows in self.grid():
+            yield self.composition(rows)
+
+    def composition(self, rows):
+        core, shell, (doping, rate), coating = (self.tables[role].names[row] for role, row in zip(roles, rows))
+        return {'Core': core, 'Shell': shell, 'Doping': doping, 'Doping Rate(%)': rate, 'Coating': coating}
+
+    def count_pruned(self):
+        """Compositions of the grid out of the calculator domain and merged as duplicates, none of them is generated"""
+        tables = self.component_tables()
+        valid = np.prod([len(tables[role]) for role in roles], dtype=float)
+        members = np.prod([sum(tables[role].members) for role in roles], dtype=float)
+        self.stats['out_of_domain'] += int(self.size() - members)
+        self.stats['duplicates'] += int(members - valid)
+
+    def basis(self, rows):
+        """
+        (volume terms, surface terms) of the raw SDEC FP of a chunk of composition rows.
+
+        The sum of the component contributions, without the elements a later component of
+        core, doping, coating, shell sets again.
+        """
+        core, shell, doping, coating = (self.tables[role] for role in roles)
+        c, s, d, o = np.asarray(rows).T
+        taken_core = core.present[c] & (doping.present[d] | coating.present[o] | shell.present[s])
+        taken_doping = doping.present[d] & (coating.present[o] | shell.present[s])
+        taken_coating = coating.present[o] & shell.present[s]
+
+        orbital_matrix = self.predictor.sdec_engine.orbital_matrix
+        # the core takes the particle volume the dopants leave
+        core_share = (1 - doping.ratio[d])[:, None]
+        volume_terms = (core_share * (core.contributions[c] - (core.amounts[c] * taken_core) @ orbital_matrix)
+                        + doping.contributions[d] - (doping.amounts[d] * taken_doping) @ orbital_matrix)
+        surface_terms = (coating.contributions[o] - (coating.amounts[o] * taken_coating) @ orbital_matrix
+                         + shell.contributions[s])
+        return volume_terms, surface_terms
+
+    def score_chunk(self, rows, score_bound=None, threshold=None):
+        """
+        (score, composition rows, diameter, domain flags, fingerprint key) of every candidate of a chunk of compositions.
+
+        With a threshold, compositions whose bound is not above it are skipped.
+        """
+        volume_terms, surface_terms = self.basis(rows)
+        volume, surface = sphere_volume(self.diameters), sphere_surface(self.diameters)
+        # (compositions x diameters x orbitals), as in predict_diameter_sweep
+        sweeps = signed_log_transform(volume[None, :, None] * volume_terms[:, None, :]
+                                      + surface[None, :, None] * surface_terms[:, None, :])
+
+        if score_bound is not None and threshold is not None:
+            sign = 1 if score_bound.largest else -1
+            bounds = sign * self.aggregate(score_bound(sweeps.min(axis=1), sweeps.max(axis=1)), axis=1)
+            # a candidate enters the heap only above its minimum, the tolerance covers the summation order
+            keep = bounds + 1e-9 * np.maximum(1, np.abs(bounds)) > threshold
+            self.stats['bounded'] += int((~keep).sum())
+            rows, sweeps = list(itertools.compress(rows, keep)), sweeps[keep]
+            if not rows:
+                return []
+
+        candidates = [(composition, diameter) for composition in rows for diameter in self.diameters]
+        df_sdec_log = pd.DataFrame(sweeps.reshape(-1, sweeps.shape[-1]), columns=self.predictor.sdec_engine.orbitals)
+        flags = self.domain.evaluate(df_sdec_log)
+        if self.domain_only:
+            inside = flags['In domain'].to_numpy()
+            self.stats['outside_ad'] += int((~inside).sum())
+            candidates = list(itertools.compress(candidates, inside))
+            df_sdec_log = df_sdec_log[inside].reset_index(drop=True)
+            flags = flags[inside].reset_index(drop=True)
+            if not candidates:
+                return []
+        prediction = self.predictor.score(df_sdec_log, self.selection)
+        scores = self.aggregate(prediction, axis=1)
+        self.stats['scored'] += len(candidates)
+        keys = [hashlib.blake2b(fingerprint.tobytes(), digest_size=16).digest() for fingerprint in df_sdec_log.to_numpy()]
+        domain = zip(*(flags[column].tolist() for column in domain_columns))
+        return [(score, composition, diameter, flags, key)
+                for score, (composition, diameter), flags, key in zip(scores.tolist(), candidates, domain, keys)]
+
+    def screen(self, top_k=100, largest=True, limit=None, verbose=False):
+        """
+        The top_k candidates by score, highest first unless largest is False.
+
+        limit stops after that many generated compositions.
+        Returns a DataFrame with the composition, Diameter(nm), Score and the applicability domain columns.
+        """
+        heap = []
+        members = set()
+        sign = 1 if largest else -1
+        counter = itertools.count()
+        score_bound = None
+        if self.bound:
+            score_bound = ScoreBound(self.predictor.model, len(self.predictor.sdec_engine.orbitals),
+                                     self.predictor.cells.design_rows(self.selection), largest)
+        grid = self.grid()
+        self.count_pruned()
+        if limit is not None:
+            grid = itertools.islice(grid, limit)
+        start = time.perf_counter()
+
+        while True:
+            chunk = list(itertools.islice(grid, self.chunk_size))
+            if not chunk:
+                break
+            self.stats['compositions'] += len(chunk)
+            threshold = heap[0][0] if len(heap) >= top_k else None
+            for score, rows, diameter, domain, key in self.score_chunk(chunk, score_bound, threshold):
+                # ties keep the candidate generated first, a candidate with the SDEC FP of a member adds nothing
+                item = (sign * score, -next(counter), rows, diameter, domain, key)
+                if key in members:
+                    self.stats['duplicates'] += 1
+                    continue
+                if len(heap) < top_k:
+                    heapq.heappush(heap, item)
+                    members.add(key)
+                elif item[0] > heap[0][0]:
+                    members.discard(heapq.heapreplace(heap, item)[-1])
+                    members.add(key)
+            if verbose:
+                elapsed = time.perf_counter() - start
+                print(f"{self.stats['compositions']} compositions, {self.stats['bounded']} bounded, "
+                      f"{self.stats['scored']} candidates scored ({self.stats['scored'] / elapsed:.0f}/s)")
+
+        ranked = sorted(heap, reverse=True)
+        return pd.DataFrame([dict(self.composition(rows), **{'Diameter(nm)': float(diameter), 'Score': sign * key},
+                                  **dict(zip(domain_columns, domain)))
+                             for key, _, rows, diameter, domain, _ in ranked],
+                            columns=particle_columns + ['Score'] + domain_columns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NanoToxRadar design space screening')
+    parser.add_argument('--cores', nargs='*', default=None, help='default every listed core')
+    parser.add_argument('--shells', nargs='*', default=None, help='default none and every listed shell, "" for none')
+    parser.add_argument('--dopings', nargs='*', default=None, help='default none and every listed dopant')
+    parser.add_argument('--coatings', nargs='*', default=None, help='default none and every listed coating')
+    parser.add_argument('--diameters', nargs='+', type=float, default=[10, 50, 100])
+    parser.add_argument('--doping-rates', nargs='+', type=float, default=[1, 5, 10])
+    parser.add_argument('--cells', nargs='+', default=None)
+    parser.add_argument('--tissues', nargs='+', default=None)
+    parser.add_argument('--aggregate', choices=sorted(aggregates), default='mean')
+    parser.add_argument('--top-k', type=int, default=100)
+    parser.add_argument('--smallest', action='store_true', help='rank the lowest scores first')
+    parser.add_argument('--limit', type=int, default=None, help='screen only the first compositions')
+    parser.add_argument('--chunk-size', type=int, default=512)
+    parser.add_argument('--domain-only', action='store_true', help='skip candidates outside the applicability domain')
+    parser.add_argument('--no-bound', action='store_true', help='score every composition, without the score bound')
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--model-folder', default=model_folder)
+    parser.add_argument('--output', default=None, help='CSV file for the ranking')
+    args = parser.parse_args()
+
+    predictor = Predictor(args.model_folder, n_jobs=args.n_jobs)
+    engine = ScreeningEngine(predictor, args.cores, args.shells, args.dopings, args.coatings,
+                             args.diameters, args.doping_rates, args.cells, args.tissues,
+                             args.aggregate, args.chunk_size, args.domain_only, not args.no_bound)
+    print(f"{engine.size()} compositions x {len(engine.diameters)} diameters")
+    ranking = engine.screen(args.top_k, not args.smallest, args.limit, verbose=True)
+    print(engine.stats)
+    print(ranking.to_string(index=False))
+    if args.output:
+        ranking.to_csv(args.output, index=False)
+
+
+if __name__ == '__main__':
+    main()
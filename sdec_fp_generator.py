@@ -3,23 +3,21 @@ To represent the structure of nanomaterials
 SDEC FP has been employed and supplemented calculation of multi-components in this code.
 
 This code is to generate the SDEC FP for a nanomaterial with function get_component_amounts.
+SDECEngine computes the SDEC FP of a whole batch as one sparse composition x orbital matrix product.
 
 Created by Jaehyeon Park, source from Ph.D Shin
 """
 
 import pandas as pd
 import numpy as np
-from collections import defaultdict
 import json
-from formula_utils import log_transform
+from formula_utils import log_transform, signed_log_transform
 from amount_calculator import get_component_amounts
-import re
+from formula_tokenizer import element_counts
 
-# Load volume data
-shell_volume_data = pd.read_csv('shell_volume_list.csv')
-doping_volume_data = pd.read_csv('doping_volume_list.csv')
-core_volume_data = pd.read_csv('core_volume_list.csv')
-coating_volume_data = pd.read_csv('coating_volume_list.csv')
+# Coating name -> molecular formula from the materials catalog, the first entry wins for duplicated names
+from materials_catalog import catalog
+coating_mf_map = catalog.coating_mf
 
 def calculate_electronic_configuration(amount_components, df_atom_map):
     """Calculate electronic configuration for components"""
@@ -31,145 +29,100 @@ def calculate_electronic_configuration(amount_components, df_atom_map):
             ec[atom] = calculated_row
     return ec
 
-def calculate_sdec_fp(data, df_atom):
-    """Calculate SDEC fingerprint for the data"""
-    # Prepare atom mapping
-    df_atom_map = df_atom.set_index('atom')
-    try:
-        df_atom_map = df_atom_map.drop(['AN'], axis=1)
-    except:
-        pass
-        
-    sdec_fp = []
-    
-    for idx, row in data.iterrows():
-        core = row['Core']
-        doping = row['Doping']
-        shell = row['Shell']
-        coating = row['Coating']
-        num_core = row['Amounts of Core']
-        num_doping = row['Amounts of Doping']
-        num_shell = row['Amounts of Shell']
-        num_coating = row['Amounts of Coating']
-
-        # CORE COMPONENT NUMBER
-        amount_component_core = {}
-        match_core = re.findall(r'([A-Z][a-z]*)(\d*\.?\d*)', core)
-        core_component = {elem: float(count) if count else 1.0 for elem, count in match_core}
-        for elem, count in core_component.items():
-            amount_in_core = count * num_core
-            amount_component_core[elem] = float(amount_in_core) if amount_in_core else 0
-
-        # DOPING COMPONENT NUMBER
-        amount_component_doping = {}
-        if doping != '':
-            match_doping = re.findall(r'([A-Z][a-z]*)(\d*\.?\d*)', str(doping))
-            match_doping_count = defaultdict(float)
-            for elem, count in match_doping:
-                count = float(count) if count else 1
-                match_doping_count[elem] += count
-            doping_component = {elem: count for elem, count in match_doping_count.items()}
-            if len(doping_component) >= 2:
-                doping_amount_list = [float(x) for x in num_doping.split('/')]
-                for (elem, count), amount_each in zip(doping_component.items(), doping_amount_list):
-                    amount_in_doping = count * amount_each
-                    amount_component_doping[elem] = amount_in_doping
-            else:
-                doping_amount_list = float(num_doping)
-                for elem, count in doping_component.items():
-                    amount_in_doping = count * doping_amount_list
-                    amount_component_doping[elem] = amount_in_doping
-            pass
-        # SHELL COMPONENT NUMBER
-        amount_component_shell = {}
-        if shell != '':
-            match_shell = re.findall(r'([A-Z][a-z]*)(\d*\.?\d*)', str(shell))
-            match_shell_count = defaultdict(float)
-            for elem, count in match_shell:
-                count = float(count) if count else 1
-                match_shell_count[elem] += count
-            shell_component = {elem: count for elem, count in match_shell_count.items()}
-            if shell_component:
-                for elem, count in shell_component.items():
-                    amount_in_shell = count * num_shell
-                    amount_component_shell[elem] = amount_in_shell
-            pass
-
-        # COATING COMPONENT NUMBER
-        amount_component_coating = {}
-        if coating != '':
-            if coating in coating_volume_data['Coating name'].values:
-                coating_mf = coating_volume_data.loc[coating_volume_data['Coating name'] == coating, 'mf'].values[0]
-                match_coating = re.findall(r'([A-Z][a-z]*)(\d*\.?\d*)', str(coating_mf))
-                match_coating_count = defaultdict(float)
-                for elem, count in match_coating:
-                    count = float(count) if count else 1
-                    match_coating_count[elem] += count
-                coating_component = {elem: count for elem, count in match_coating_count.items()}
-                if coating_component:
-                    for elem, count in coating_component.items():
-                        amount_in_coating = count * num_coating
-                        amount_component_coating[elem] = amount_in_coating
-            elif '/' in coating:
-                coating_list = coating.split('/')
-                coating_total_list = []
-                for coating_sub in coating_list:
-                    if coating_sub in coating_volume_data['Coating name'].values:
-                        coating_mf = coating_volume_data.loc[coating_volume_data['Coating name'] == coating_sub, 'mf'].values[0]
-                        coating_total_list.append(coating_mf)
-                    else:
-                        coating_total_list.append(coating_sub)
-                match_coating = re.findall(r'([A-Z][a-z]*)(\d*\.?\d*)', str(coating_total_list))
-                match_coating_count = defaultdict(float)
-                for elem, count in match_coating:
-                    count = float(count) if count else 1
-                    match_coating_count[elem] += count
-                coating_component = {elem: count for elem, count in match_coating_count.items()}
-                if coating_component:
-                    for elem, count in coating_component.items():
-                        amount_in_coating = count * num_coating
-                        amount_component_coating[elem] = amount_in_coating                    
-            pass
-    
-    core_ec = {}
-    for atom, value in amount_component_core.items():
-        if atom in df_atom_map.index:
-            row = df_atom_map.loc[atom]
-            calculated_row = row * value
-            core_ec[atom] = calculated_row
+def parse_component(formula, merge=True):
+    """Element counts of a component formula, repeated elements are summed unless merge is False"""
+    return element_counts(formula, merge)
 
-    doping_ec = {}
-    for atom, value in amount_component_doping.items():
-        if atom in df_atom_map.index:
-            row = df_atom_map.loc[atom]
-            caculated_row = row * value
-            doping_ec[atom] = calculated_row
+def coating_formula(coating):
+    """Molecular formula of a coating, multiple coatings are joined with '/' and unknown names are kept as formula"""
+    if coating in coating_mf_map:
+        return coating_mf_map[coating]
+    elif '/' in coating:
+        return '/'.join(coating_mf_map.get(coating_sub, coating_sub) for coating_sub in coating.split('/'))
+    # a single coating outside the coating list does not contribute to the SDEC FP
+    return ''
 
-    shell_ec = {}
-    for atom, value in amount_component_shell.items():
-        if atom in df_atom_map.index:
-            row = df_atom_map.loc[atom]
-            calculated_row = row * value
-            shell_ec[atom] = calculated_row
+def component_amounts(core, doping, shell, coating_mf, num_core, num_doping, num_shell, num_coating):
+    """
+    Amount of every element in one particle.
 
-    coating_ec = {}
-    for atom, value in amount_component_coating.items():
-        if atom in df_atom_map.index:
-            row = df_atom_map.loc[atom]
-            calculated_row = row * value
-            coating_ec[atom] = calculated_row
-
-    df_atom_map_config = df_atom_map.transpose()
-    combined_ec = pd.Series(0, index=df_atom_map_config.index)
-    components = {**core_ec, **doping_ec, **coating_ec, **shell_ec}
-
-    for sub, config in components.items():
-        combined_ec += config
-        
-    sdec_data = {}
-    for ec, value in combined_ec.items():
-        sdec_data[ec] = value
-    sdec_fp.append(sdec_data)
-    
-    return pd.DataFrame(sdec_fp)
+    An element present in several components takes the amount of the last one of
+    core, doping, coating, shell, the same precedence the SDEC FP has always been built with.
+    """
+    amounts = {}
 
+    # CORE COMPONENT NUMBER
+    for elem, count in parse_component(core, merge=False):
+        amount_in_core = count * num_core
+        amounts[elem] = float(amount_in_core) if amount_in_core else 0
+
+    # DOPING COMPONENT NUMBER
+    if doping != '':
+        doping_component = parse_component(doping)
+        if len(doping_component) >= 2:
+            doping_amount_list = [float(x) for x in num_doping.split('/')]
+            for (elem, count), amount_each in zip(doping_component, doping_amount_list):
+                amounts[elem] = count * amount_each
+        else:
+            for elem, count in doping_component:
+                amounts[elem] = count * float(num_doping)
+
+    # COATING COMPONENT NUMBER
+    if coating_mf != '':
+        for elem, count in parse_component(coating_mf):
+            amounts[elem] = count * num_coating
+
+    # SHELL COMPONENT NUMBER
+    if shell != '':
+        for elem, count in parse_component(shell):
+            amounts[elem] = count * num_shell
+
+    return amounts
+
+class SDECEngine:
+    """
+    Vectorized SDEC FP.
+
+    The electron configuration table is kept as a dense element x orbital array,
+    every particle becomes a sparse composition row of element amounts,
+    and the fingerprints of the whole batch are one (particles x elements) @ (elements x orbitals) product.
+    """
+    def __init__(self, df_atom):
+        df_atom_map = df_atom.set_index('atom')
+        df_atom_map = df_atom_map.drop(['AN'], axis=1, errors='ignore')
+        self.elements = list(df_atom_map.index)
+        self.orbitals = list(df_atom_map.columns)
+        self.element_index = {elem: i for i, elem in enumerate(self.elements)}
+        self.orbital_matrix = df_atom_map.values.astype(float)
+
+    def composition_matrix(self, data):
+        """Sparse (particles x elements) matrix of element amounts"""
+        from scipy import sparse
+        coating_mf = {coating: coating_formula(coating) for coating in set(data['Coating'])}
+        rows, cols, values = [], [], []
+        columns = zip(data['Core'], data['Doping'], data['Shell'], data['Coating'],
+                      data['Amounts of Core'], data['Amounts of Doping'],
+                      data['Amounts of Shell'], data['Amounts of Coating'])
+        for i, (core, doping, shell, coating, num_core, num_doping, num_shell, num_coating) in enumerate(columns):
+            amounts = component_amounts(core, doping, shell, coating_mf[coating],
+                                        num_core, num_doping, num_shell, num_coating)
+            for elem, amount in amounts.items():
+                if elem in self.element_index:
+                    rows.append(i)
+                    cols.append(self.element_index[elem])
+                    values.append(amount)
+        return sparse.csr_matrix((np.asarray(values, dtype=float), (rows, cols)),
+                                 shape=(len(data), len(self.elements)))
+
+    def fingerprints(self, data):
+        """(particles x orbitals) SDEC FP array"""
+        return np.asarray(self.composition_matrix(data) @ self.orbital_matrix)
+
+    def log_fingerprints(self, data):
+        """SDEC FP with the sign preserving log transform, as fed to the model"""
+        return signed_log_transform(self.fingerprints(data))
+
+def calculate_sdec_fp(data, df_atom):
+    """Calculate SDEC fingerprint for the data"""
+    engine = SDECEngine(df_atom)
+    return pd.DataFrame(engine.fingerprints(data), columns=engine.orbitals)
@@ -0,0 +1,263 @@
+"""
+Local HTTP prediction server
+
+POST /predict with one nanoparticle as JSON, the same keys as the nanoparticle dictionary in prediction.py,
+returns the nested {tissue: {cell: prediction}} JSON that prediction.py prints.
+A list of nanoparticles returns a list of nested results.
+
+Requests arriving within a few milliseconds of each other are collected by MicroBatcher
+and scored together with one batched CatBoost call.
+
+python server.py --port 8000 --max-wait-ms 5
+python server.py --metrics          # GET /metrics answers the instrumentation counters in the Prometheus text format
+
+Created by Jaehyeon Park
+"""
+import argparse
+import asyncio
+import json
+
+import pandas as pd
+
+from prediction import Predictor, model_folder, particle_columns
+import instrumentation
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+MAX_BODY_SIZE = 10 * 1024 * 1024
+
+
+class RequestError(Exception):
+    """Client side error with the HTTP status to answer"""
+    def __init__(self, status, message):
+        self.status = status
+        self.message = message
+        super().__init__(self.message)
+
+
+def normalize_particle(particle):
+    """Check one nanoparticle dict and fill the optional fields with ''"""
+    if not isinstance(particle, dict):
+        raise RequestError(400, "Each nanoparticle must be a JSON object")
+    if not particle.get('Core'):
+        raise RequestError(400, "Core is required")
+    if particle.get('Diameter(nm)') in (None, ''):
+        raise RequestError(400, "Diameter(nm) is required")
+    try:
+        diameter = float(particle['Diameter(nm)'])
+    except (TypeError, ValueError):
+        raise RequestError(400, f"Diameter(nm) must be a number: {particle['Diameter(nm)']}")
+
+    normalized = {col: '' if particle.get(col) is None else str(particle.get(col)) for col in particle_columns}
+    normalized['Diameter(nm)'] = diameter
+    return normalized
+
+
+class MicroBatcher:
+    """
+    Collect concurrent nanoparticles for max_wait_ms and score them in one predict call.
+
+    Scoring runs in the default executor so the event loop keeps accepting requests meanwhile.
+    Particles the volume calculator cannot handle get a 400 with their error message, the rest of the batch is scored.
+    If a batch still fails, its particles are scored one by one so one bad particle only fails its own request.
+    """
+    def __init__(self, predictor, max_wait_ms=5, max_batch_size=256):
+        self.predictor = predictor
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.queue = asyncio.Queue()
+        self.worker = None
+
+    def start(self):
+        self.worker = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, particle):
+        """Queue one normalized nanoparticle and wait for its nested result"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((particle, future))
+        return await future
+
+    async def collect(self):
+        """Wait for the first request, then gather more until the window closes or the batch is full"""
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def score(self, particles):
+        """Nested results for a list of particles, or the exception for every one that failed"""
+        try:
+            prediction, errors = self.predictor.predict_with_errors(pd.DataFrame(particles))
+            return [RequestError(400, error['message']) if error is not None else self.predictor.nest(row)
+                    for row, error in zip(prediction, errors)]
+        except (Exception, SystemExit):
+            # SystemExit is the only non-Exception the volume calculator raises,
+            # KeyboardInterrupt and cancellation go through
+            if len(particles) == 1:
+                raise
+        results = []
+        for particle in particles:
+            try:
+                results.append(self.score([particle])[0])
+            except (Exception, SystemExit) as e:
+                results.append(e)
+        return results
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.collect()
+            particles = [particle for particle, _ in batch]
+            try:
+                results = await loop.run_in_executor(None, self.score, particles)
+            except (Exception, SystemExit) as e:
+                results = [e] * len(batch)
+            for (particle, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, SystemExit):
+                    # the volume calculator exits on materials it cannot handle
+                    future.set_exception(RequestError(400, f"Invalid nanoparticle: {particle}"))
+                elif isinstance(result, BaseException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+class PredictionServer:
+    """asyncio HTTP/1.1 server in front of a MicroBatcher"""
+    def __init__(self, predictor, host='127.0.0.1', port=8000, max_wait_ms=5, max_batch_size=256):
+        self.host = host
+        self.port = port
+        self.batcher = MicroBatcher(predictor, max_wait_ms=max_wait_ms, max_batch_size=max_batch_size)
+
+    async def read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, path, _ = request_line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            raise RequestError(400, "Malformed request line")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get('content-length', 0) or 0)
+        if length > MAX_BODY_SIZE:
+            raise RequestError(413, "Request body is too large")
+        body = await reader.readexactly(length) if length else b''
+        return method, path.split('?', 1)[0], headers, body
+
+    async def dispatch(self, method, path, body):
+        if path == '/health':
+            return 200, {'status': 'ok'}
+        if path == '/metrics' and instrumentation.enabled:
+            return 200, instrumentation.prometheus_text()
+        if path != '/predict':
+            raise RequestError(404, f"Unknown path: {path}")
+        if method != 'POST':
+            raise RequestError(405, "Use POST /predict")
+
+        try:
+            payload = json.loads(body or b'null')
+        except json.JSONDecodeError as e:
+            raise RequestError(400, f"Invalid JSON: {e}")
+
+        if isinstance(payload, list):
+            particles = [normalize_particle(particle) for particle in payload]
+            results = await asyncio.gather(*(self.batcher.submit(particle) for particle in particles))
+            return 200, list(results)
+        return 200, await self.batcher.submit(normalize_particle(payload))
+
+    async def write_response(self, writer, status, payload, keep_alive):
+        if isinstance(payload, str):
+            body, content_type = payload.encode('utf-8'), 'text/plain; version=0.0.4'
+        else:
+            body, content_type = json.dumps(payload).encode('utf-8'), 'application/json'
+        head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                keep_alive = False
+                try:
+                    request = await self.read_request(reader)
+                    if request is None:
+                        break
+                    method, path, headers, body = request
+                    keep_alive = headers.get('connection', '').lower() == 'keep-alive'
+                    status, payload = await self.dispatch(method, path, body)
+                except RequestError as e:
+                    status, payload = e.status, {'error': e.message}
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except Exception as e:
+                    status, payload = 500, {'error': str(e)}
+                await self.write_response(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+    async def serve_forever(self):
+        self.batcher.start()
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        print(f"NanoToxRadar server listening on http://{self.host}:{self.port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.batcher.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NanoToxRadar local prediction server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--model-folder', default=model_folder)
+    parser.add_argument('--max-wait-ms', type=float, default=5,
+                        help='how long to collect concurrent requests before scoring them together')
+    parser.add_argument('--max-batch-size', type=int, default=256)
+    parser.add_argument('--cache', nargs='?', const=True, default=None,
+                        help='answer repeated nanoparticles from the prediction cache, optionally kept in a sqlite file')
+    parser.add_argument('--metrics', action='store_true', help='record stage timings and counters, served on GET /metrics')
+    args = parser.parse_args()
+
+    if args.metrics:
+        instrumentation.enable()
+    predictor = Predictor(args.model_folder, cache=args.cache)
+    server = PredictionServer(predictor, host=args.host, port=args.port,
+                              max_wait_ms=args.max_wait_ms, max_batch_size=args.max_batch_size)
+    asyncio.run(server.serve_forever())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+# the modules live at the repository root
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+
+@pytest.fixture(scope='session')
+def predictor(tmp_path_factory):
+    """Predictor with a small CatBoost model trained on data/x_train.csv, the released model is not in the repository"""
+    from catboost import CatBoostRegressor
+    from prediction import Predictor
+    x_train = pd.read_csv(os.path.join(root, 'data', 'x_train.csv'), index_col=0)
+    y_train = pd.read_csv(os.path.join(root, 'data', 'y_train.csv'), index_col=0)['pXC50']
+    model = CatBoostRegressor(iterations=200, depth=6, random_seed=0, verbose=0, allow_writing_files=False)
+    model.fit(x_train, y_train)
+    folder = tmp_path_factory.mktemp('model')
+    model.save_model(str(folder / 'best_tox_catboost.cbm'))
+    return Predictor(str(folder))
@@ -0,0 +1,62 @@
+"""
+The charge solver against the itertools enumeration it replaced
+
+Created by Jaehyeon Park
+"""
+import pytest
+
+import charge_solver
+from charge_solver import (_balance_problems, _bundled_formulas, _integer_costs, _Metal, _accepted_totals,
+                           _reachable, _optimal_combinations, enumerate_charge_balance, enumeration_size,
+                           possible_charges, solve_charge_balance)
+from formula_utils import calculate_stability
+
+problems = [(formula, *problem) for formula in _bundled_formulas() for problem in _balance_problems(formula)
+            if enumeration_size(problem[0]) <= 2_000_000]
+
+
+def test_bundled_formulas_have_problems():
+    assert len(problems) > 100
+
+
+@pytest.mark.parametrize('formula, metals, anion_charge, total_required_charge, key', problems,
+                         ids=[f"{problem[0]}-{problem[4]}" for problem in problems])
+def test_solver_matches_enumeration(formula, metals, anion_charge, total_required_charge, key):
+    expected = enumerate_charge_balance(metals, anion_charge, total_required_charge, key)
+    assert solve_charge_balance(metals, anion_charge, total_required_charge, key) == expected
+
+
+# Fe2Mn2O5 has three combinations of the lowest stability score
+tied_metals, tied_anion_charge, tied_required_charge = {'Fe': 2, 'Mn': 2}, -10, 10
+
+
+def optimal_combinations(metals, anion_charge, total_required_charge):
+    costs = _integer_costs(metals, total_required_charge)
+    solver_metals = [_Metal(elem, count, possible_charges(elem), costs[elem]) for elem, count in metals.items()]
+    accepted = _accepted_totals(_reachable(solver_metals, [None] * len(solver_metals))[-1], anion_charge)
+    return list(_optimal_combinations(solver_metals, accepted, [None] * len(solver_metals)))
+
+
+def test_tied_combinations_match_enumeration():
+    assert len(optimal_combinations(tied_metals, tied_anion_charge, tied_required_charge)) == 3
+    expected = enumerate_charge_balance(tied_metals, tied_anion_charge, tied_required_charge)
+    assert solve_charge_balance(tied_metals, tied_anion_charge, tied_required_charge) == expected
+
+
+@pytest.mark.parametrize('cap', [1, 2])
+def test_tied_combinations_cap(monkeypatch, cap):
+    monkeypatch.setattr(charge_solver, 'MAX_TIED_COMBINATIONS', cap)
+    tied = optimal_combinations(tied_metals, tied_anion_charge, tied_required_charge)
+    solved = solve_charge_balance(tied_metals, tied_anion_charge, tied_required_charge)
+
+    # only the first cap combinations in enumeration order are compared
+    assert solved in tied[:cap]
+    assert sum(map(sum, solved)) + tied_anion_charge == 0
+    expected = enumerate_charge_balance(tied_metals, tied_anion_charge, tied_required_charge)
+    assert calculate_stability(solved, tied_metals, tied_required_charge) == pytest.approx(
+        calculate_stability(expected, tied_metals, tied_required_charge))
+
+
+def test_no_balance():
+    assert solve_charge_balance({'Fe': 1}, -40, 40) is None
+    assert enumerate_charge_balance({'Fe': 1}, -40, 40) is None
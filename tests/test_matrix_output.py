@@ -0,0 +1,42 @@
+"""
+The matrix writer keeps the particle ids out of memory and load_matrix reads them back
+
+Created by Jaehyeon Park
+"""
+import json
+import os
+
+import numpy as np
+
+from matrix_output import MatrixWriter, load_matrix, matrix_to_long, metadata_path, particles_path
+
+metadata = {'cells': ['A', 'B'], 'tissues': ['lung', 'liver']}
+
+
+def write_chunks(path, chunks):
+    writer = MatrixWriter(path, sum(len(ids) for ids in chunks), metadata)
+    for ids in chunks:
+        writer.write(np.full((len(ids), 2), len(ids)), ids)
+    writer.close()
+
+
+def test_positional_ids_are_a_range(tmp_path):
+    path = str(tmp_path / 'predictions.npy')
+    write_chunks(path, [range(0, 3), range(3, 5)])
+    with open(metadata_path(path)) as f:
+        assert json.load(f)['particles'] == {'start': 0, 'stop': 5}
+    assert not os.path.exists(particles_path(path))
+    matrix, loaded = load_matrix(path)
+    assert loaded['particles'].tolist() == [0, 1, 2, 3, 4]
+    assert len(matrix_to_long(matrix, loaded)) == 10
+
+
+def test_other_ids_go_to_the_sidecar(tmp_path):
+    path = str(tmp_path / 'predictions.npy')
+    write_chunks(path, [[0, 1], [2, 7], [8]])
+    with open(metadata_path(path)) as f:
+        assert json.load(f)['particles'] == {'file': 'predictions.particles.csv'}
+    assert load_matrix(path)[1]['particles'].tolist() == [0, 1, 2, 7, 8]
+
+    write_chunks(path, [['a', 'b']])
+    assert load_matrix(path)[1]['particles'].tolist() == ['a', 'b']
@@ -0,0 +1,73 @@
+"""
+The prediction cache serves the predictions of the uncached pipeline
+
+Created by Jaehyeon Park
+"""
+import numpy as np
+import pandas as pd
+
+from prediction_cache import canonical_particle
+
+multi_dopant_particles = pd.DataFrame([
+    {'Core': 'CdSe', 'Shell': '', 'Doping': 'ZnO/Au', 'Doping Rate(%)': '1/2', 'Coating': '', 'Diameter(nm)': 10},
+    {'Core': 'CdSe', 'Shell': '', 'Doping': 'Au/ZnO', 'Doping Rate(%)': '2/1', 'Coating': '', 'Diameter(nm)': 10},
+    {'Core': 'TiO2', 'Shell': 'ZnS', 'Doping': 'Fe3O4/Ag', 'Doping Rate(%)': '5/1', 'Coating': 'PEG', 'Diameter(nm)': 25},
+    {'Core': 'TiO2', 'Shell': 'ZnS', 'Doping': 'Ag/Fe3O4', 'Doping Rate(%)': '1/5', 'Coating': 'PEG', 'Diameter(nm)': 25},
+    {'Core': 'ZnO', 'Shell': '', 'Doping': 'TiO2/Mn', 'Doping Rate(%)': '3/3', 'Coating': '', 'Diameter(nm)': 40},
+    {'Core': 'Fe3O4', 'Shell': '', 'Doping': 'Zn/Au', 'Doping Rate(%)': '1/2', 'Coating': '', 'Diameter(nm)': 10},
+    {'Core': 'Fe3O4', 'Shell': '', 'Doping': 'Au/Zn', 'Doping Rate(%)': '2/1', 'Coating': '', 'Diameter(nm)': 10},
+    {'Core': 'Fe3O4', 'Shell': '', 'Doping': 'Zn/Au/Ag', 'Doping Rate(%)': '1/2/3', 'Coating': '', 'Diameter(nm)': 10},
+    {'Core': 'Fe3O4', 'Shell': '', 'Doping': 'Ag/Zn/Au', 'Doping Rate(%)': '3/1/2', 'Coating': '', 'Diameter(nm)': 10},
+])
+
+# particles the canonical key must not change: whitespace, an inexact diameter, swapped shells
+exact_particles = pd.DataFrame([
+    {'Core': ' CdSe', 'Shell': '', 'Doping': '', 'Doping Rate(%)': '', 'Coating': '', 'Diameter(nm)': 10},
+    {'Core': 'CdSe', 'Shell': '', 'Doping': '', 'Doping Rate(%)': '', 'Coating': '', 'Diameter(nm)': 10},
+    {'Core': 'CdSe', 'Shell': '', 'Doping': '', 'Doping Rate(%)': '', 'Coating': '', 'Diameter(nm)': 10.0004},
+    {'Core': 'CdSe', 'Shell': 'CdS/ZnS', 'Doping': '', 'Doping Rate(%)': '', 'Coating': '', 'Diameter(nm)': 10},
+    {'Core': 'CdSe', 'Shell': 'ZnS/CdS', 'Doping': '', 'Doping Rate(%)': '', 'Coating': '', 'Diameter(nm)': 10},
+    {'Core': 'CdSe', 'Shell': 'ZnS/Unobtainium', 'Doping': '', 'Doping Rate(%)': '', 'Coating': '', 'Diameter(nm)': 10},
+])
+
+
+def test_multi_element_dopings_keep_their_order():
+    canonical = canonical_particle({'Core': 'CdSe', 'Doping': 'ZnO/Au', 'Doping Rate(%)': '1/2', 'Diameter(nm)': 10})
+    assert (canonical['Doping'], canonical['Doping Rate(%)']) == ('ZnO/Au', '1/2')
+
+
+def test_single_element_dopings_are_sorted():
+    first = canonical_particle({'Core': 'CdSe', 'Doping': 'Zn/Au', 'Doping Rate(%)': '1/2', 'Diameter(nm)': 10})
+    second = canonical_particle({'Core': 'CdSe', 'Doping': 'Au/Zn', 'Doping Rate(%)': '2/1', 'Diameter(nm)': 10})
+    assert first == second
+    assert (first['Doping'], first['Doping Rate(%)']) == ('Au/Zn', '2/1')
+
+
+def test_keys_keep_the_submitted_fields():
+    keys = [canonical_particle(particle) for particle in exact_particles.to_dict('records')]
+    assert keys[0] != keys[1] and keys[1] != keys[2]
+    assert keys[3] == keys[4]
+
+
+def test_cached_predictions_match_uncached(predictor):
+    predictor.cache = None
+    expected = predictor.predict_matrix(multi_dopant_particles)
+    predictor.enable_cache()
+    try:
+        # the second call is served from the cache
+        for _ in range(2):
+            np.testing.assert_array_equal(predictor.predict_matrix(multi_dopant_particles), expected)
+    finally:
+        predictor.cache = None
+
+
+def test_cached_errors_match_uncached(predictor):
+    predictor.cache = None
+    expected = predictor.predict_batch(exact_particles, errors='collect')
+    assert expected.groupby('Particle')['Error'].first().notna().tolist() == [True, False, False, False, False, True]
+    predictor.enable_cache()
+    try:
+        for _ in range(2):
+            pd.testing.assert_frame_equal(predictor.predict_batch(exact_particles, errors='collect'), expected)
+    finally:
+        predictor.cache = None
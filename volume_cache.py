@@ -0,0 +1,150 @@
+"""
+Volume Cache
+
+The volume of a core, shell, coating or doping depends only on its formula, not on the diameter,
+so the result of volume_calculator is memoized per (role, formula).
+
+VolumeCache - in-process LRU, optionally backed by a sqlite file shared between runs.
+Rows of the sqlite file are tagged with tables_checksum(), a hash of radii_collection
+and the *_volume_list.csv files, so editing any of them invalidates the stored volumes.
+
+Formulas are keyed as written: the volume lists are looked up by exact name and the element order
+decides ties in the charge balance, so 'SiO2' and 'O2Si' are not merged.
+
+Created by Jaehyeon Park
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import radii_collection
+from materials_catalog import volume_lists
+from resources import resource_path
+
+# bump when the volume rules in volume_calculator change
+CACHE_VERSION = 1
+
+volume_list_files = [file_name for file_name, _, _ in volume_lists.values()]
+
+# stored for formulas that are handled but leave the volume unset
+_MISSING = object()
+
+
+def tables_checksum(files=None):
+    """sha256 of radii_collection and the volume lists, the tag of every stored volume"""
+    files = [radii_collection.__file__] + [resource_path(name) for name in (volume_list_files if files is None else files)]
+    digest = hashlib.sha256(f"v{CACHE_VERSION}".encode())
+    for path in files:
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class VolumeCache:
+    """
+    LRU of formula -> volume per component role, with an optional sqlite store behind it.
+
+    get(role, formula, compute) returns the cached volume or calls compute(formula) once and keeps the result.
+    compute may return None when it leaves the volume unset, None is cached as well.
+    Exceptions and sys.exit of compute are not cached.
+    """
+    def __init__(self, maxsize=4096, path=None):
+        self.maxsize = maxsize
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        self.checksum = None
+        if path:
+            self.open(path)
+
+    def open(self, path):
+        """Use the sqlite file at path as the persistent store"""
+        self.close()
+        self.checksum = tables_checksum()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS volumes (
+                                   role TEXT, formula TEXT, checksum TEXT, volume TEXT,
+                                   PRIMARY KEY (role, formula, checksum))""")
+        # volumes computed from older tables are never read again
+        self.connection.execute("DELETE FROM volumes WHERE checksum != ?", (self.checksum,))
+        self.connection.commit()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def clear(self):
+        """Forget the in-process volumes, e.g. after replacing a volume list in memory"""
+        with self.lock:
+            self.memory.clear()
+
+    def _remember(self, key, value):
+        with self.lock:
+            self.memory[key] = value
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.maxsize:
+                self.memory.popitem(last=False)
+
+    def _load(self, role, formula):
+        row = self.connection.execute(
+            "SELECT volume FROM volumes WHERE role = ? AND formula = ? AND checksum = ?",
+            (role, formula, self.checksum)).fetchone()
+        if row is None:
+            return _MISSING
+        volume = row[0]
+        if volume is None or role == 'doping':
+            return volume
+        return float(volume)
+
+    def _store(self, role, formula, volume):
+        self.connection.execute("INSERT OR REPLACE INTO volumes VALUES (?, ?, ?, ?)",
+                                (role, formula, self.checksum, None if volume is None else str(volume)))
+        self.connection.commit()
+
+    def contains(self, role, formula):
+        """True when the volume of formula is in memory, the sqlite store is not consulted"""
+        with self.lock:
+            return (role, formula) in self.memory
+
+    def put(self, role, formula, volume):
+        """Keep a volume computed elsewhere, e.g. in a worker process"""
+        if self.connection is not None:
+            self._store(role, formula, volume)
+        self._remember((role, formula), volume)
+
+    def get(self, role, formula, compute):
+        key = (role, formula)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+
+        volume = _MISSING
+        if self.connection is not None:
+            volume = self._load(role, formula)
+        if volume is _MISSING:
+            self.misses += 1
+            volume = compute(formula)
+            if self.connection is not None:
+                self._store(role, formula, volume)
+        else:
+            self.hits += 1
+        self._remember(key, volume)
+        return volume
+
+
+# shared by volume_calculator, set NANOTOX_VOLUME_CACHE to a sqlite file to keep volumes between runs
+volume_cache = VolumeCache(path=os.environ.get('NANOTOX_VOLUME_CACHE'))
+
+
+def enable_disk_cache(path):
+    """Keep the volumes of the shared cache in the sqlite file at path"""
+    volume_cache.open(path)
+    return volume_cache
@@ -11,63 +11,61 @@ warnings.filterwarnings('ignore')
 
 import sys
 import numpy as np
-import re
 from collections import Counter, defaultdict
 import pandas as pd
 import itertools
 from itertools import product
 import statistics
-from radii_collection import metallic_radii, effective_ionic_radii, neutral_radii
+import os
+import math
+from concurrent.futures import ProcessPoolExecutor
+from radii_collection import metallic_radii, effective_ionic_radii, neutral_radii, element_symbols
 from formula_utils import (get_possible_charges, 
                            find_valid_combinations,
                            calculate_stability,
                            calculate_stability_multiple,
                            calculate_stability_single,
                            parse_molecular_formula)
-from rdkit import Chem
+from formula_tokenizer import (FormulaError, validate_formula, valid_elements_regex,
+                               formula_tokens, parse_charge_key)
+from charge_solver import solve_charge_balance
+from volume_cache import volume_cache
+import instrumentation
+from materials_catalog import catalog
 
 """
 Initialize constants and base data
 """
-pt = Chem.GetPeriodicTable()
-all_symbols = [pt.GetElementSymbol(i) for i in range(1, 119)]
-valid_elements_regex = '|'.join(sorted(all_symbols, key=len, reverse=True))
-
-# Load volume data
-shell_volume_data = pd.read_csv('shell_volume_list.csv')
-doping_volume_data = pd.read_csv('doping_volume_list.csv')
-core_volume_data = pd.read_csv('core_volume_list.csv')
-coating_volume_data = pd.read_csv('coating_volume_list.csv')
-
-class FormulaError(Exception):
-    """Custom exception for formula validation errors"""
-    def __init__(self, message):
+all_symbols = list(element_symbols)
+
+# Load volume data, indexed by name in the materials catalog
+shell_volume_data = catalog.tables['shell']
+doping_volume_data = catalog.tables['doping']
+core_volume_data = catalog.tables['core']
+coating_volume_data = catalog.tables['coating']
+
+class ComponentError(Exception):
+    """
+    A nanoparticle component the volume calculator cannot handle.
+
+    code - invalid_formula, charge_balance, out_of_domain, unknown_material, calculation_error ...
+    component - Core, Shell, Doping, Coating or the input column at fault
+    """
+    def __init__(self, code, component, message):
+        self.code = code
+        self.component = component
         self.message = message
         super().__init__(self.message)
 
+    def as_dict(self):
+        return {'code': self.code, 'component': self.component, 'message': self.message}
+
 """
 Base utility functions
 """
 def formula_error_check(formula):
     """Validate chemical formula."""
-    pattern = rf'({valid_elements_regex})(\d*\.?\d*)'
-    elements = re.findall(pattern, formula)
-    # print(f"Found elements: {elements}") - Debugging test
-    
-    if not elements:
-        # WARNING MESSAGE
-        raise FormulaError(f"No valid elements found in the formula: {formula}")
-        # WARNING MESSAGE
-    
-    parsed_formula = ''.join(elem + count for elem, count in elements)
-    # print(f"Parsed formula: {parsed_formula}") - Debugging test
-    
-    if parsed_formula != formula:
-        # WARNING MESSAGE
-        raise FormulaError(f"Invalid element symbol found in the formula: {formula}")
-        # WARNING MESSAGE
-        
-    return formula
+    return validate_formula(formula)
 
 def sphere_volume(r):
     """Calculate sphere volume."""
@@ -77,15 +75,6 @@ def sphere_surface(r):
     """Calculate sphere surface area."""
     return 4*np.pi*(r**2)
 
-def parse_molecular_formula(formula):
-    """Parse molecular formula into composition dictionary."""
-    match = re.findall(r'([A-Z][a-z]*)(\d*\.?\d*)', str(formula))
-    match_count = defaultdict(float)
-    for elem, count in match:
-        count = float(count) if count else 1
-        match_count[elem] += count
-    return {elem: float(count) if count else 1.0 for elem, count in match_count.items()}
-
 """
 Charge calculation functions
 """
@@ -121,868 +110,566 @@ def calculate_stability(combo, metals, total_required_charge):
         raise FormulaError("Invalid charge combination structure")
     
 def mc_np_vol_surface(data):
-    for idx, row in data.iterrows():
-        if row['Diameter(nm)']:
-            data.loc[idx, 'Particle Volume (nm^3)'] = sphere_volume(row['Diameter(nm)'])
-            data.loc[idx, 'Particle Surface Area (nm^2)'] = sphere_surface(row['Diameter(nm)'])
-            
+    """Particle volume and surface area of every row with a diameter"""
+    has_diameter = data['Diameter(nm)'].astype(bool)
+    if has_diameter.any():
+        diameter = data.loc[has_diameter, 'Diameter(nm)'].astype(float)
+        data.loc[has_diameter, 'Particle Volume (nm^3)'] = sphere_volume(diameter)
+        data.loc[has_diameter, 'Particle Surface Area (nm^2)'] = sphere_surface(diameter)
+    return data
+
+
+def record_errors(data, errors):
+    """Keep the first error of every row in the 'Error' column, errors is a Series of error dicts or NaN"""
+    if 'Error' not in data:
+        data['Error'] = None
+    failed = data['Error'].isna() & errors.notna()
+    if failed.any():
+        data.loc[failed, 'Error'] = errors[failed]
+    return data
+
+def assign_volumes(data, column, volume_column, role, formula_volume, errors='exit', known=None):
+    """
+    Fill volume_column from the formulas in column.
+
+    Every distinct formula is resolved once through volume_cache, rows whose formula gives no volume are left as they are.
+    errors - 'exit' prints the message and exits like the command line always did, 'raise' raises the ComponentError,
+    'collect' stores it in the 'Error' column of the failed rows and keeps going.
+    known - formula -> volume already computed, e.g. by prefetch_volumes
+    """
+    volumes, failures = {}, {}
+    if instrumentation.enabled:
+        formula_volume = instrumentation.formula_function(role, formula_volume)
+    for formula in pd.unique(data[column]):
+        if known is not None and formula in known:
+            volumes[formula] = known[formula]
+            continue
+        try:
+            volumes[formula] = volume_cache.get(role, formula, formula_volume)
+        except ComponentError as e:
+            if errors == 'exit':
+                print(e.message)
+                sys.exit(1)
+            if errors == 'raise':
+                raise
+            failures[formula] = e.as_dict()
+        except Exception as e:
+            if errors != 'collect':
+                raise
+            failures[formula] = ComponentError('calculation_error', column, f"{column} {formula}: {type(e).__name__}: {e}").as_dict()
+
+    values = data[column].map(volumes)
+    mask = values.notna()
+    if mask.any():
+        data.loc[mask, volume_column] = values[mask]
+    if failures:
+        record_errors(data, data[column].map(failures))
     return data
 
 """
 CORE VOLUME (STRING)
 """
 
-def core_volume_process(data):
-    for idx, row in data.iterrows():
-        core = row['Core']
-        if core in core_volume_data['Core'].values:
-            core_volume = core_volume_data.loc[core_volume_data['Core'] == core, 'Core Volume (nm^3)'].values[0]
-            data.loc[idx, 'Core Volume (nm^3)'] = core_volume
+def core_formula_volume(core):
+    """Core Volume (nm^3) of one core, from the core volume list or from its formula"""
+    if ('core', core) in catalog:
+        return catalog.volume('core', core)
+    try:
+        formula_check = formula_error_check(core)
+        
+        elements = formula_tokens(core)
+        composition = {elem: float(count) if count else 1.0 for elem, count in elements}
+        stable_core = []
+        # IF CORE HAS OXYGEN - EFFECTIVE RADII
+        if 'O' in composition:
+            oxygen_count = composition['O']
+            oxygen_charge = -2*oxygen_count
+            has_float = any(isinstance(count, float) and not count.is_integer() for count in composition.values())
+            # IF CORE HAS FLOAT NUMBER
+            if has_float:
+                metals = {elem: float(count) if count else 1.0 for elem, count in elements if elem != 'O'}
+                possible_charges = {}
+                for metal in metals.keys():
+                    possible_charges[metal] = []
+                    for charge_key in effective_ionic_radii.keys():
+                        parsed = parse_charge_key(charge_key)
+                        if parsed:
+                            charge_element, charge = parsed
+                            if charge_element == metal:
+                                possible_charges[metal].append(charge)
+                                
+                valid_combinations = []
+                exact_combinations = []
+                approx_combinations = []
+                for combo in product(*(possible_charges[elem] for elem in metals)):
+                    total = sum(metals[elem] * state for elem, state in zip(metals, combo))
+                    if round(total + oxygen_charge, 2) == 0:
+                        exact_combinations.append(combo)
+                    elif abs(round(total + oxygen_charge, 2)) <= 2:
+                        approx_combinations.append(combo)
+                if exact_combinations:
+                    valid_combinations = exact_combinations
+                elif approx_combinations:
+                    valid_combinations = approx_combinations
+                if instrumentation.enabled:
+                    space = math.prod(len(possible_charges[elem]) for elem in metals)
+                    instrumentation.charge_combinations(space, space, len(valid_combinations))
+        
+                if valid_combinations:
+                    most_stable = min(valid_combinations, key=lambda x: (
+                        abs(round(sum(metals[elem] * charge for elem, charge in zip(metals, x)) + oxygen_charge, 2)),
+                        statistics.stdev(x) if len(set(x)) > 1 else 0))
+                    for subs, charge in zip(list(metals.keys()), most_stable):
+                        stable_core.append(f"{subs}+{charge}")
+                else:
+                    ## WARNING MESSAGE
+                    raise ComponentError('charge_balance', 'Core', f"Core material error: {core} is incorrect.")
+                    ## WARNING MESSAGE
+                    
+                stable_core.extend(['O-2'] * int(oxygen_count))
+            # CORE HAS NO FLOAT
+            else:
+                metals = [elem for elem in composition if elem != 'O']
+                metals_comp = {elem: int(count) if count else 1 for elem, count in elements if elem !='O'}
+                if len(metals) == 1:
+                    element = metals[0]
+                    most_stable = solve_charge_balance(metals_comp, oxygen_charge, abs(oxygen_charge))
+                    if most_stable is None:
+                        ## WARNING MESSAGE
+                        raise ComponentError('charge_balance', 'Core', f"Core material error: {core} is incorrect.")
+                        ## WARNING MESSAGE
+                    for charge in most_stable[0]:
+                        stable_core.append(f"{element}+{charge}")
+                    stable_core.extend(['O-2'] * int(oxygen_count))
+                # CORE HAS UPPER 2 METALS
+                elif len(metals) >= 2:
+                    most_stable = solve_charge_balance(metals_comp, oxygen_charge, abs(oxygen_charge))
+                    if most_stable is None:
+                        ## WARNING MESSAGE
+                        raise ComponentError('charge_balance', 'Core', f"Core material error: {core} is incorrect.")
+                        ## WARNING MESSAGE
+                    for metal, charges in zip(metals_comp.keys(), most_stable):
+                        for charge in charges:
+                            stable_core.append(f"{metal}+{charge}")
+                    stable_core.extend(['O-2'] * int(oxygen_count))                    
+    
+    
+        # IF CORE HAS NO OXYGEN
         else:
-            try:
-                formula_check = formula_error_check(core)
-                
-                elements = re.findall(r'([A-Z][a-z]*)(\d*\.?\d*)', core)
-                composition = {elem: float(count) if count else 1.0 for elem, count in elements}
-                stable_core = []
-                # IF CORE HAS OXYGEN - EFFECTIVE RADII
-                if 'O' in composition:
-                    oxygen_count = composition['O']
-                    oxygen_charge = -2*oxygen_count
-                    has_float = any(isinstance(count, float) and not count.is_integer() for count in composition.values())
-                    # IF CORE HAS FLOAT NUMBER
-                    if has_float:
-                        metals = {elem: float(count) if count else 1.0 for elem, count in elements if elem != 'O'}
-                        possible_charges = {}
-                        for metal in metals.keys():
-                            possible_charges[metal] = []
-                            for charge_key in effective_ionic_radii.keys():
-                                match = re.match(r'([A-Z][a-z]?)([+-]\d+)', charge_key)
-                                if match:
-                                    charge_element, charge = match.groups()
-                                    if charge_element == metal:
-                                        possible_charges[metal].append(int(charge))
-                                        
-                        valid_combinations = []
-                        exact_combinations = []
-                        approx_combinations = []
-                        for combo in product(*(possible_charges[elem] for elem in metals)):
-                            total = sum(metals[elem] * state for elem, state in zip(metals, combo))
-                            if round(total + oxygen_charge, 2) == 0:
-                                exact_combinations.append(combo)
-                            elif abs(round(total + oxygen_charge, 2)) <= 2:
-                                approx_combinations.append(combo)
-                        if exact_combinations:
-                            valid_combinations = exact_combinations
-                        elif approx_combinations:
-                            valid_combinations = approx_combinations
-                
-                        if valid_combinations:
-                            most_stable = min(valid_combinations, key=lambda x: (
-                                abs(round(sum(metals[elem] * charge for elem, charge in zip(metals, x)) + oxygen_charge, 2)),
-                                statistics.stdev(x) if len(set(x)) > 1 else 0))
-                            for subs, charge in zip(list(metals.keys()), most_stable):
-                                stable_core.append(f"{subs}+{charge}")
+            has_float = any(isinstance(count, float) and not count.is_integer() for count in composition.values())
+            if has_float:
+                metals = {elem: float(count) if count else 1.0 for elem, count in elements if elem != 'O'}
+                possible_charges = {}
+                for metal in metals.keys():
+                    possible_charges[metal] = []
+                    for charge_key in effective_ionic_radii.keys():
+                        parsed = parse_charge_key(charge_key)
+                        if parsed:
+                            charge_element, charge = parsed
+                            if charge_element == metal:
+                                possible_charges[metal].append(charge)
+                                
+                                
+                valid_combinations = []
+                exact_combinations = []
+                approx_combinations = []
+                for combo in product(*(possible_charges[elem] for elem in metals)):
+                    total = sum(metals[elem] * state for elem, state in zip(metals, combo))
+                    if total == 0:
+                        exact_combinations.append(combo)
+                    elif abs(total) <= 2:
+                        approx_combinations.append(combo)
+                if exact_combinations:
+                    valid_combinations = exact_combinations
+                elif approx_combinations:
+                    valid_combinations = approx_combinations
+                if instrumentation.enabled:
+                    space = math.prod(len(possible_charges[elem]) for elem in metals)
+                    instrumentation.charge_combinations(space, space, len(valid_combinations))
+        
+                if valid_combinations:
+                    most_stable = min(valid_combinations, key=lambda x: (
+                        abs(round(sum(metals[elem] * charge for elem, charge in zip(metals, x)), 2)),
+                        statistics.stdev(x) if len(set(x)) > 1 else 0))
+                    for subs, charge in zip(list(metals.keys()), most_stable):
+                        if charge > 0:
+                            stable_core.append(f"{subs}+{charge}")
                         else:
-                            ## WARNING MESSAGE
-                            print(f"Core material error: {core} is incorrect.")
-                            sys.exit(1)
-                            ## WARNING MESSAGE
-                            
-                        stable_core.extend(['O-2'] * int(oxygen_count))
-                    # CORE HAS NO FLOAT
-                    else:
-                        metals = [elem for elem in composition if elem != 'O']
-                        metals_comp = {elem: int(count) if count else 1 for elem, count in elements if elem !='O'}
-                        if len(metals) == 1:
-                            element = metals[0]
-                            possible_charges = []
-                            for charge_key in effective_ionic_radii.keys():
-                                match = re.match(r'([A-Z][a-z]?)([+-]\d+)', charge_key)
-                                if match:
-                                    charge_element, charge = match.groups()
-                                    if charge_element == element:
-                                        possible_charges.append(int(charge))
-                                        
-                                        
-                            charge_combinations = itertools.combinations_with_replacement(possible_charges, int(composition[element]))
+                            stable_core.append(f"{subs}{charge}")
+                else:
+                    ## WARNING MESSAGE
+                    raise ComponentError('charge_balance', 'Core', f"Core material error: {core} is incorrect.")
+                    ## WARNING MESSAGE
+            else:
+                metals = [elem for elem in composition]
+                metals_comp = {elem: int(count) if count else 1 for elem, count in elements if elem !='O'}
+                if len(metals) == 1:
+                    element = metals[0]
+                    stable_core.append(element)
                 
-                            valid_combinations = []
-                            approx_combinations = []
-                            exact_combinations = []
-                            for combo in charge_combinations:
-                                total_charge = sum(combo)
-                                if total_charge + oxygen_charge == 0:
-                                    exact_combinations.append(combo)
-                                elif abs(total_charge + oxygen_charge) <= 2:
-                                    approx_combinations.append(combo)
-                                    
-                            if exact_combinations:
-                                valid_combinations = exact_combinations
-                            elif approx_combinations:
-                                valid_combinations = approx_combinations
-                            else:
-                                ## WARNING MEESAGE
-                                print(f"Core material error: {core} is incorrect.")
-                                sys.exit(1)
-                                ## WARNING MEESAGE
-                            if valid_combinations:
-                                most_stable = min(valid_combinations, 
-                                                key=lambda x: calculate_stability(x, metals_comp, abs(oxygen_charge)))
-                                for charge in most_stable:
-                                    stable_core.append(f"{element}+{charge}")
-                            else:
-                                ## WARNING MEESAGE
-                                print(f"Core material error: {core} is incorrect.")
-                                sys.exit(1)
-                                ## WARNING MESSAGE
-                            stable_core.extend(['O-2'] * int(oxygen_count))
-                        # CORE HAS UPPER 2 METALS
-                        elif len(metals) >= 2:
-                            possible_charges = {}
-                            for metal in metals:
-                                possible_charges[metal] = []
-                                for charge_key in effective_ionic_radii.keys():
-                                    match = re.match(r'([A-Z][a-z]?)([+-]\d+)', charge_key)
-                                    if match:
-                                        charge_element, charge = match.groups()
-                                        if charge_element == metal:
-                                            possible_charges[metal].append(int(charge))
+                else:
+                    most_stable = solve_charge_balance(metals_comp, key='first_charge')
+                    if most_stable is None:
+                        ## WARNING MESSAGE
+                        raise ComponentError('charge_balance', 'Core', f"Core material error: {core} is incorrect.")
+                        ## WARNING MESSAGE
+                    for subs, charge in zip(metals_comp.keys(), most_stable):
+                        if charge[0] > 0:
+                            stable_core.append(f"{subs}+{charge[0]}")
+                        else:
+                            stable_core.append(f"{subs}{charge[0]}")
 
-                
-                            charge_combinations = itertools.product(*(itertools.combinations_with_replacement(possible_charges[metal], int(composition[metal])) for metal in metals))
-                            
-                            valid_combinations = []
-                            approx_combinations = []
-                            exact_combinations = []
-                            for combo in charge_combinations:
-                                total_charge = sum(sum(metal_combo) for metal_combo in combo)
-                                if total_charge + oxygen_charge == 0:
-                                    exact_combinations.append(combo)
-                                elif abs(total_charge + oxygen_charge) <= 2:
-                                    approx_combinations.append(combo)
-                            if exact_combinations:
-                                valid_combinations = exact_combinations
-                            elif approx_combinations:
-                                valid_combinations = approx_combinations
-                            else:
-                                ## WARNING MESSAGE
-                                print(f"Core material error: {core} is incorrect.")
-                                sys.exit(1)
-                                ## WARNING MESSAGE
-                            if valid_combinations:
-                                most_stable = min(valid_combinations, 
-                                                key=lambda x: calculate_stability(x, metals_comp, abs(oxygen_charge)))
-                                for metal, charges in zip(metals_comp.keys(), most_stable):
-                                    for charge in charges:
-                                        stable_core.append(f"{metal}+{charge}")
-                            else:
-                                ## WARNING MESSAGE
-                                print(f"Core material error: {core} is incorrect.")
-                                sys.exit(1)
-                                ## WARNING MESSAGE
-                            stable_core.extend(['O-2'] * int(oxygen_count))                    
-            
-            
-                # IF CORE HAS NO OXYGEN
+        core_data = dict(Counter(stable_core))
+        # VOLUME CALCULATOR
+        if len(core_data) == 1:
+            for subs, count in core_data.items():
+                radius = metallic_radii.get(subs)
+                if radius:
+                    return float(count*sphere_volume(radius/1000))
                 else:
+                    ## WARNING MESSAGE
+                    raise ComponentError('out_of_domain', 'Core', f"Sorry, {subs} is out of domain")
+                    ## WARNING MESSAGE
+        else:
+            total_volume = 0
+            for subs, count in core_data.items():
+                radius = effective_ionic_radii.get(subs)
+                if radius:
+                    volume = sphere_volume(radius/1000)
                     has_float = any(isinstance(count, float) and not count.is_integer() for count in composition.values())
                     if has_float:
-                        metals = {elem: float(count) if count else 1.0 for elem, count in elements if elem != 'O'}
-                        print(metals)
-                        possible_charges = {}
-                        for metal in metals.keys():
-                            possible_charges[metal] = []
-                            for charge_key in effective_ionic_radii.keys():
-                                match = re.match(r'([A-Z][a-z]?)([+-]\d+)', charge_key)
-                                if match:
-                                    charge_element, charge = match.groups()
-                                    if charge_element == metal:
-                                        possible_charges[metal].append(int(charge))
-                                        
-                                        
-                        valid_combinations = []
-                        exact_combinations = []
-                        approx_combinations = []
-                        for combo in product(*(possible_charges[elem] for elem in metals)):
-                            total = sum(metals[elem] * state for elem, state in zip(metals, combo))
-                            if total == 0:
-                                exact_combinations.append(combo)
-                            elif abs(total) <= 2:
-                                approx_combinations.append(combo)
-                        if exact_combinations:
-                            valid_combinations = exact_combinations
-                        elif approx_combinations:
-                            valid_combinations = approx_combinations
-                
-                        if valid_combinations:
-                            most_stable = min(valid_combinations, key=lambda x: (
-                                abs(round(sum(metals[elem] * charge for elem, charge in zip(metals, x)), 2)),
-                                statistics.stdev(x) if len(set(x)) > 1 else 0))
-                            for subs, charge in zip(list(metals.keys()), most_stable):
-                                if charge > 0:
-                                    stable_core.append(f"{subs}+{charge}")
-                                else:
-                                    stable_core.append(f"{subs}{charge}")
-                        else:
-                            ## WARNING MESSAGE
-                            print(f"Core material error: {core} is incorrect.")
-                            sys.exit(1)
-                            ## WARNING MESSAGE
+                        element = subs.split('+')[0].split('-')[0]
+                        element = element.strip()
+                        ratio = composition.get(element, 1.0)
+                        total_volume += volume * ratio
                     else:
-                        metals = [elem for elem in composition]
-                        metals_comp = {elem: int(count) if count else 1 for elem, count in elements if elem !='O'}
-                        if len(metals) == 1:
-                            element = metals[0]
-                            stable_core.append(element)
-                        
-                        else:
-                            possible_charges = {}
-                            for metal in metals:
-                                possible_charges[metal] = []
-                                for charge_key in effective_ionic_radii.keys():
-                                    match = re.match(r'([A-Z][a-z]?)([+-]\d+)', charge_key)
-                                    if match:
-                                        charge_element, charge = match.groups()
-                                        if charge_element == metal:
-                                            possible_charges[metal].append(int(charge))
-
-                
-                            charge_combinations = itertools.product(*(itertools.combinations_with_replacement(possible_charges[metal], int(composition[metal])) for metal in metals))
-                            
-                            valid_combinations = []
-                            approx_combinations = []
-                            exact_combinations = []
-                            for combo in charge_combinations:
-                                total_charge = sum(sum(metal_combo) for metal_combo in combo)
-                                if total_charge == 0:
-                                    exact_combinations.append(combo)
-                                elif abs(total_charge) <= 2:
-                                    approx_combinations.append(combo)
-                            if exact_combinations:
-                                valid_combinations = exact_combinations
-                            elif approx_combinations:
-                                valid_combinations = approx_combinations
-                            else:
-                                ## WARNING MESSAGE
-                                print(f"Core material error: {core} is incorrect.")
-                                sys.exit(1)
-                                ## WARNING MESSAGE
-                            if valid_combinations:
-                                most_stable = min(valid_combinations, key=lambda x: 
-                                                (abs(round(sum(metals_comp[elem] * charge[0] for elem, charge in zip(metals_comp.keys(), x)), 2)),
-                                                statistics.stdev([charge[0] for charge in x]) if len(set(charge[0] for charge in x)) > 1 else 0))
-                                for subs, charge in zip(metals_comp.keys(), most_stable):
-                                    if charge > 0:
-                                        stable_core.append(f"{subs}+{charge[0]}")
-                                    else:
-                                        stable_core.append(f"{subs}{charge[0]}")
-                            else:
-                                ## WARNING MESSAGE
-                                print(f"Core material error: {core} is incorrect.")
-                                sys.exit(1)
-                                ## WARNING MESSAGE
-        
-                core_data = dict(Counter(stable_core))
-                # VOLUME CALCULATOR
-                if len(core_data) == 1:
-                    for subs, count in core_data.items():
-                        radius = metallic_radii.get(subs)
-                        if radius:
-                            data.loc[idx, 'Core Volume (nm^3)'] = float(count*sphere_volume(radius/1000))
-                        else:
-                            ## WARNING MESSAGE
-                            print(f"Sorry, {subs} is out of domain")
-                            sys.exit(1)
-                            ## WARNING MESSAGE
+                        total_volume += volume * count
                 else:
-                    total_volume = 0
-                    for subs, count in core_data.items():
-                        radius = effective_ionic_radii.get(subs)
-                        if radius:
-                            volume = sphere_volume(radius/1000)
-                            has_float = any(isinstance(count, float) and not count.is_integer() for count in composition.values())
-                            if has_float:
-                                element = subs.split('+')[0].split('-')[0]
-                                element = element.strip()
-                                ratio = composition.get(element, 1.0)
-                                total_volume += volume * ratio
-                            else:
-                                total_volume += volume * count
-                        else:
-                            ## WARNING MESSAGE
-                            print(f"Sorry, {subs} is out of domain")
-                            sys.exit(1)
-                            ## WARNING MESSAGE
-                    data.loc[idx, 'Core Volume (nm^3)'] = float(total_volume)
-                    
-            except FormulaError as e:
-                print(f"Core material error: {core} is incorrect. {str(e)}")
-                sys.exit(1)
-                
-    return data
+                    ## WARNING MESSAGE
+                    raise ComponentError('out_of_domain', 'Core', f"Sorry, {subs} is out of domain")
+                    ## WARNING MESSAGE
+            return float(total_volume)
+            
+    except FormulaError as e:
+        raise ComponentError('invalid_formula', 'Core', f"Core material error: {core} is incorrect. {str(e)}")
+
+
+def core_volume_process(data, errors='exit', known=None):
+    return assign_volumes(data, 'Core', 'Core Volume (nm^3)', 'core', core_formula_volume, errors, known)
                 
 """
 DOPING VOLUME (STRING)
 """
-def doping_volume_process(data):
-    for idx, row in data.iterrows():
-        doping = row['Doping']
-        # IF DOPING ITEMS ARE MULTIPLE
-        if '/' in doping:
-            doping_list = doping.split('/')
-            doping_volume = []
-            for elem in doping_list:
-                volume = doping_volume_data.loc[doping_volume_data['Doping'] == elem, 'Doping Volume (nm^3)'].values[0]
-                doping_volume.append(f"{volume}")
-            data.loc[idx, 'Doping Volume (nm^3)'] = '/'.join(f"{float(x)}" for x in doping_volume)
-        
-        # IF DOPING ITEMS ARE SINGLE
-        else:
-            if doping in doping_volume_data['Doping'].values:
-                doping_volume = doping_volume_data.loc[doping_volume_data['Doping'] == doping, 'Doping Volume (nm^3)'].values[0]
-                data.loc[idx, 'Doping Volume (nm^3)'] = str(doping_volume)
-                
-            # IF DOPING ITEMS ARE NOTHING
-            elif doping == '':
-                data.loc[idx, 'Doping Volume (nm^3)'] = str(0)
-                
-    return data
+def doping_formula_volume(doping):
+    """Doping Volume (nm^3) of one doping entry as a string, multiple dopings are joined with '/'"""
+    # IF DOPING ITEMS ARE MULTIPLE
+    if '/' in doping:
+        doping_list = doping.split('/')
+        doping_volume = []
+        for elem in doping_list:
+            if ('doping', elem) not in catalog:
+                raise ComponentError('unknown_material', 'Doping', f"Doping material error: {elem} is not in the doping volume list.")
+            volume = catalog.volume('doping', elem)
+            doping_volume.append(f"{volume}")
+        return '/'.join(f"{float(x)}" for x in doping_volume)
+
+    # IF DOPING ITEMS ARE SINGLE
+    if ('doping', doping) in catalog:
+        doping_volume = catalog.volume('doping', doping)
+        return str(doping_volume)
+
+    # IF DOPING ITEMS ARE NOTHING
+    if doping == '':
+        return str(0)
+    return None
+
+
+def doping_volume_process(data, errors='exit', known=None):
+    return assign_volumes(data, 'Doping', 'Doping Volume (nm^3)', 'doping', doping_formula_volume, errors, known)
 
 """
 SHELL VOLUME (NOT STRING)
 """
 
-def shell_volume_process(data):
-    for idx, row in data.iterrows():
-        shell = row['Shell']
-        # IF SHELL ITEMS ARE MULTIPLE
-        if '/' in shell:
-            shell_list = shell.split('/')
-            shell_volume = 0
-            for elem in shell_list:
-                volume = shell_volume_data.loc[shell_volume_data['Shell'] == elem, 'Shell Volume (nm^3)'].values[0]
-                shell_volume += volume
-            data.loc[idx, 'Shell Volume (nm^3)'] = shell_volume
-        
-        # IF SHELL ITEMS ARE SINGLE
-        else:
-            if shell in shell_volume_data['Shell'].values:
-                shell_volume = shell_volume_data.loc[shell_volume_data['Shell'] == shell, 'Shell Volume (nm^3)'].values[0]
-                data.loc[idx, 'Shell Volume (nm^3)'] = shell_volume
-                
-            # IF SHELL ITEMS ARE NOTHING
-            elif shell == '':
-                data.loc[idx, 'Shell Volume (nm^3)'] = 0
-                
-    return data
+def shell_formula_volume(shell):
+    """Shell Volume (nm^3) of one shell entry, multiple shells are summed"""
+    # IF SHELL ITEMS ARE MULTIPLE
+    if '/' in shell:
+        shell_list = shell.split('/')
+        shell_volume = 0
+        for elem in shell_list:
+            if ('shell', elem) not in catalog:
+                raise ComponentError('unknown_material', 'Shell', f"Shell material error: {elem} is not in the shell volume list.")
+            volume = catalog.volume('shell', elem)
+            shell_volume += volume
+        return shell_volume
+
+    # IF SHELL ITEMS ARE SINGLE
+    if ('shell', shell) in catalog:
+        return catalog.volume('shell', shell)
+
+    # IF SHELL ITEMS ARE NOTHING
+    if shell == '':
+        return 0
+    return None
+
+
+def shell_volume_process(data, errors='exit', known=None):
+    return assign_volumes(data, 'Shell', 'Shell Volume (nm^3)', 'shell', shell_formula_volume, errors, known)
 
 """
 COATING VOLUME - USERS INPUT THE MOLECULAR FORMULA DIRECTLY (NOT STRING)
 (pm) -> (nm)
 """
 
-def coating_volume_process(data):
-    for idx, row in data.iterrows():
-        coating = row['Coating']
-        # IF COATING ITEMS ARE SINGLE
-        if '/' not in coating:
-            if coating in coating_volume_data['Coating name'].values:
-                coating_volume = coating_volume_data.loc[coating_volume_data['Coating name'] == coating, 'Coating Volume (nm^3)'].values[0]
-                data.loc[idx, 'Coating Volume (nm^3)'] = coating_volume
-                
-            # IF COATING ITEMS ARE NOTHING
-            elif coating == '':
-                data.loc[idx, 'Coating Volume (nm^3)'] = 0
-                
-            elif coating not in coating_volume_data['Coating name'].values:
-                try:
-                    formula_check = formula_error_check(coating)
-                    match = re.findall(r'([A-Z][a-z]*)(\d*\.?\d*)', str(coating))
-                    match_count = defaultdict(float)
-                    for elem, count in match:
-                            count = float(count) if count else 1
-                            match_count[elem] += count
-                    coating_count = {elem: float(count) if count else 1.0 for elem, count in match_count.items()}
-                    # COATING HAS NO OXYGEN
-                    if 'O' not in coating_count:
-                        if len(coating_count) == 1:
-                            total_volume = 0
-                            for subs, count in coating_count.items():
-                                radius = metallic_radii.get(subs)
-                                if radius:
-                                    subs_volume = sphere_volume(radius / 1000)
-                                    total_volume += count * subs_volume
-                                else:
-                                    # WARNING MESSAGE
-                                    print(f"Coating material error: {coating} is incorrect. Give More Specific Molecular formula.")
-                                    sys.exit(1)
-                                    # WARNING MESSAGE
-                            data.loc[idx, 'Coating Volume (nm^3)'] = float(total_volume)
-                        else:
-                            # IF 'C' IN COATING - NEUTRAL RADII
-                            if 'C' in coating_count:
-                                total_volume = 0
-                                for subs, count in coating_count.items():
-                                    radius = neutral_radii.get(subs)
-                                    if radius:
-                                        subs_volume = sphere_volume(radius / 1000)
-                                        total_volume += count * subs_volume
-                                data.loc[idx, 'Coating Volume (nm^3)'] = float(total_volume)
-                            # IF 'C' NOT IN COATING - EFFECTIVE RADII
-                            else:
-                                stable_coating = []
-                                metals = [elem for elem in coating_count]
-                                metals_comp = coating_count
-                                possible_charges = {}
-                                for metal in metals:
-                                    possible_charges[metal] = []
-                                    for charge_key in effective_ionic_radii.keys():
-                                        match = re.match(r'([A-Z][a-z]?)([+-]\d+)', charge_key)
-                                        if match:
-                                            charge_element, charge = match.groups()
-                                            if charge_element == metal:
-                                                possible_charges[metal].append(int(charge))
-
-                                charge_combinations = itertools.product(*(
-                                    itertools.combinations_with_replacement(possible_charges[metal], int(coating_count[metal])) for metal in metals))
-                                
-                                valid_combinations = []
-                                approx_combinations = []
-                                exact_combinations = []
-                                for combo in charge_combinations:
-                                    total_charge = sum(sum(metal_combo) for metal_combo in combo)
-                                    if total_charge == 0:
-                                        exact_combinations.append(combo)
-                                    elif abs(total_charge) <= 2:
-                                        approx_combinations.append(combo)
-                                if exact_combinations:
-                                    valid_combinations = exact_combinations
-                                elif approx_combinations:
-                                    valid_combinations = approx_combinations
-                                else:
-                                    ## WARNING MESSAGE ##
-                                    print(f"Coating material error: {coating} is incorrect. Give More Specific Molecular formula.")
-                                    sys.exit(1)
-                                    ## WARNING MESSAGE ##
-                                if valid_combinations:
-                                    most_stable = min(valid_combinations, 
-                                                        key=lambda x: calculate_stability(x, metals_comp, abs(oxygen_charge)))
-                                    for subs, charges in zip(metals, most_stable):
-                                        for charge in charges:
-                                            if charge > 0:
-                                                stable_coating.append(f"{subs}+{charge}")
-                                            else:
-                                                stable_coating.append(f"{subs}{charge}")
-                                else:
-                                    ## WARNING MESSAGE ##
-                                    print(f"Coating material error: {coating} is incorrect. Give More Specific Molecular formula.")
-                                    sys.exit(1)
-                                    ## WARNING MESSAGE ##
-                                coating_data = dict(Counter(stable_coating))
-                                if len(coating_data) >= 2:
-                                    total_volume = 0
-                                    for subs, count in coating_data.items():
-                                        radius = effective_ionic_radii.get(subs)
-                                        if radius:
-                                            subs_volume = sphere_volume(radius / 1000)
-                                            total_volume += count * subs_volume
-                                        else:
-                                            ## WARNING MESSAGE
-                                            print(f"Sorry, {subs} is out of domain")
-                                            sys.exit(1)
-                                            ## WARNING MESSAGE
-                                    data.loc[idx, 'Coating Volume (nm^3)'] = float(total_volume)
-                                        
-                    # COATING HAS OXYGEN
+def coating_molecule_volume(coating):
+    """
+    Volume of one coating molecule from its formula, radii depend on carbon and oxygen in it.
+    None when the formula is handled but gives no volume.
+    """
+    try:
+        formula_check = formula_error_check(coating)
+        coating_count = parse_molecular_formula(coating)
+        # COATING HAS NO OXYGEN
+        if 'O' not in coating_count:
+            if len(coating_count) == 1:
+                total_volume = 0
+                for subs, count in coating_count.items():
+                    radius = metallic_radii.get(subs)
+                    if radius:
+                        subs_volume = sphere_volume(radius / 1000)
+                        total_volume += count * subs_volume
                     else:
-                        # "C" IN COATING WITH OXYGEN
-                        if 'C' in coating_count:
-                            total_volume = 0
-                            for subs, count in coating_count.items():
-                                radius = neutral_radii.get(subs)
-                                if radius:
-                                    subs_volume = sphere_volume(radius / 1000)
-                                    total_volume += count * subs_volume
-                                else:
-                                    ## WARNING MESSAGE
-                                    print(f"Sorry, {subs} is out of domain")
-                                    sys.exit(1)
-                                    ## WARNING MESSAGE
-                            data.loc[idx, 'Coating Volume (nm^3)'] = float(total_volume)
-                        # "C" NOT IN COATING WITH OXYGEN -> METAL + OXYGEN
-                        else:
-                            metals = [elem for elem in coating_count if elem != 'O']
-                            metals_comp = {elem: int(count) if count else 1 for elem, count in match_count.items() if elem !='O'}
-                            oxygen_count = coating_count['O']
-                            oxygen_charge = -2*oxygen_count
-                            stable_coating = []
-                            if len(metals) == 1:
-                                element = metals[0]
-                                possible_charges = []
-                                for charge_key in effective_ionic_radii.keys():
-                                    match = re.match(r'([A-Z][a-z]?)([+-]\d+)', charge_key)
-                                    if match:
-                                        charge_element, charge = match.groups()
-                                        if charge_element == element:
-                                            possible_charges.append(int(charge))
-
-
-                                charge_combinations = itertools.combinations_with_replacement(possible_charges, int(coating_count[element]))
-                
-                                valid_combinations = []
-                                approx_combinations = []
-                                exact_combinations = []
-                                for combo in charge_combinations:
-                                    total_charge = sum(combo)
-                                    if total_charge + oxygen_charge == 0:
-                                        exact_combinations.append(combo)
-                                    elif abs(total_charge + oxygen_charge) <= 2:
-                                        approx_combinations.append(combo)
-                                        
-                                if exact_combinations:
-                                    valid_combinations = exact_combinations
-                                elif approx_combinations:
-                                    valid_combinations = approx_combinations
-                                else:
-                                    ## WARNING MESSAGE ##
-                                    print(f"Coating material error: {coating} is incorrect. Give More Specific Molecular formula.")
-                                    sys.exit(1)
-                                    ## WARNING MESSAGE ##
-                                if valid_combinations:
-                                    most_stable = min(valid_combinations, 
-                                                        key=lambda x: calculate_stability(x, metals_comp, abs(oxygen_charge)))
-                                    for charge in most_stable:
-                                        stable_coating.append(f"{element}+{charge}")
-                                else:
-                                    ## WARNING MEESAGE
-                                    print(f"Coating material error: {coating} is incorrect. Give More Specific Molecular formula.")
-                                    sys.exit(1)
-                                    ## WARNING MESSAGE
-                                stable_coating.extend(['O-2'] * int(oxygen_count))
+                        # WARNING MESSAGE
+                        raise ComponentError('out_of_domain', 'Coating', f"Coating material error: {coating} is incorrect. Give More Specific Molecular formula.")
+                        # WARNING MESSAGE
+                return float(total_volume)
+            else:
+                # IF 'C' IN COATING - NEUTRAL RADII
+                if 'C' in coating_count:
+                    total_volume = 0
+                    for subs, count in coating_count.items():
+                        radius = neutral_radii.get(subs)
+                        if radius:
+                            subs_volume = sphere_volume(radius / 1000)
+                            total_volume += count * subs_volume
+                    return float(total_volume)
+                # IF 'C' NOT IN COATING - EFFECTIVE RADII
+                else:
+                    stable_coating = []
+                    metals = [elem for elem in coating_count]
+                    metals_comp = coating_count
+                    most_stable = solve_charge_balance(metals_comp)
+                    if most_stable is None:
+                        ## WARNING MESSAGE
+                        raise ComponentError('charge_balance', 'Coating', f"Coating material error: {coating} is incorrect. Give More Specific Molecular formula.")
+                        ## WARNING MESSAGE
+                    for subs, charges in zip(metals, most_stable):
+                        for charge in charges:
+                            if charge > 0:
+                                stable_coating.append(f"{subs}+{charge}")
                             else:
-                                possible_charges = {}
-                                for metal in metals:
-                                    possible_charges[metal] = []
-                                    for charge_key in effective_ionic_radii.keys():
-                                        match = re.match(r'([A-Z][a-z]?)([+-]\d+)', charge_key)
-                                        if match:
-                                            charge_element, charge = match.groups()
-                                            if charge_element == metal:
-                                                possible_charges[metal].append(int(charge))
-
-                                                
-                                charge_combinations = itertools.product(*(
-                                    itertools.combinations_with_replacement(possible_charges[metal], int(coating_count[metal])) for metal in metals))
+                                stable_coating.append(f"{subs}{charge}")
+                    coating_data = dict(Counter(stable_coating))
+                    if len(coating_data) >= 2:
+                        total_volume = 0
+                        for subs, count in coating_data.items():
+                            radius = effective_ionic_radii.get(subs)
+                            if radius:
+                                subs_volume = sphere_volume(radius / 1000)
+                                total_volume += count * subs_volume
+                            else:
+                                ## WARNING MESSAGE
+                                raise ComponentError('out_of_domain', 'Coating', f"Sorry, {subs} is out of domain")
+                                ## WARNING MESSAGE
+                        return float(total_volume)
                             
-                                valid_combinations = []
-                                approx_combinations = []
-                                exact_combinations = []
-                                for combo in charge_combinations:
-                                    total_charge = sum(sum(metal_combo) for metal_combo in combo)
-                                    if total_charge + oxygen_charge == 0:
-                                        exact_combinations.append(combo)
-                                    elif abs(total_charge + oxygen_charge) <= 2:
-                                        approx_combinations.append(combo)
-                                if exact_combinations:
-                                    valid_combinations = exact_combinations
-                                elif approx_combinations:
-                                    valid_combinations = approx_combinations
-                                else:
-                                    ## WARNING MESSAGE
-                                    print(f"Coating material error: {coating} is incorrect. Give More Specific Molecular formula.")
-                                    sys.exit(1)
-                                    ## WARNING MESSAGE
-                                if valid_combinations:
-                                    most_stable = min(valid_combinations, 
-                                                        key=lambda x: calculate_stability(x, metals_comp, abs(oxygen_charge)))
-                                    for subs, charges in zip(metals, most_stable):
-                                        for charge in charges:
-                                            if charge > 0:
-                                                stable_coating.append(f"{subs}+{charge}")
-                                            else:
-                                                stable_coating.append(f"{subs}{charge}")
-                                else:
-                                    ## WARNING MESSAGE
-                                    print(f"Coating material error: {coating} is incorrect. Give More Specific Molecular formula.")
-                                    sys.exit(1)
-                                    continue
-                                    ## WARNING MESSAGE
-                                stable_coating.extend(['O-2'] * int(oxygen_count))
-                            coating_data = dict(Counter(stable_coating))
-                            # VOLUME CALCULATOR
-                            if coating_data:
-                                total_volume = 0
-                                for subs, count in coating_data.items():
-                                    radius = effective_ionic_radii.get(subs)
-                                    if radius:
-                                        subs_volume = sphere_volume(radius / 1000)
-                                        total_volume += count * subs_volume
-                                    else:
-                                        ## WARNING MESSAGE
-                                        print(f"Sorry, {subs} is out of domain")
-                                        sys.exit(1)
-                                        ## WARNING MESSAGE
-                                data.loc[idx, 'Coating Volume (nm^3)'] = float(total_volume)
-                except FormulaError as e:
-                    print(f"Coating material error: {coating} is incorrect. {str(e)}")
-                    sys.exit(1)
-            
-        # IF COATING ITEMS ARE MULTIPLE
+        # COATING HAS OXYGEN
         else:
-            coating_list = coating.split('/')
-            coating_volume = []
-            for coating_sub in coating_list:
-                # IF COATING IN COATING VOLUME LIST
-                if coating_sub in coating_volume_data['Coating name'].values:
-                    subs_volume = coating_volume_data.loc[coating_volume_data['Coating name'] == coating_sub, 'Coating Volume (nm^3)'].values[0]
-                    coating_volume.append(float(subs_volume))
-                    
-                # IF COATING NOT IN COATING VOLUME LIST
+            # "C" IN COATING WITH OXYGEN
+            if 'C' in coating_count:
+                total_volume = 0
+                for subs, count in coating_count.items():
+                    radius = neutral_radii.get(subs)
+                    if radius:
+                        subs_volume = sphere_volume(radius / 1000)
+                        total_volume += count * subs_volume
+                    else:
+                        ## WARNING MESSAGE
+                        raise ComponentError('out_of_domain', 'Coating', f"Sorry, {subs} is out of domain")
+                        ## WARNING MESSAGE
+                return float(total_volume)
+            # "C" NOT IN COATING WITH OXYGEN -> METAL + OXYGEN
+            else:
+                metals = [elem for elem in coating_count if elem != 'O']
+                metals_comp = {elem: int(count) if count else 1 for elem, count in coating_count.items() if elem !='O'}
+                oxygen_count = coating_count['O']
+                oxygen_charge = -2*oxygen_count
+                stable_coating = []
+                if len(metals) == 1:
+                    element = metals[0]
+                    most_stable = solve_charge_balance(metals_comp, oxygen_charge, abs(oxygen_charge))
+                    if most_stable is None:
+                        ## WARNING MESSAGE
+                        raise ComponentError('charge_balance', 'Coating', f"Coating material error: {coating} is incorrect. Give More Specific Molecular formula.")
+                        ## WARNING MESSAGE
+                    for charge in most_stable[0]:
+                        stable_coating.append(f"{element}+{charge}")
+                    stable_coating.extend(['O-2'] * int(oxygen_count))
                 else:
-                    try:
-                        formula_check = formula_error_check(coating_sub)
-                        
-                        match = re.findall(r'([A-Z][a-z]*)(\d*\.?\d*)', str(coating_sub))
-                        match_count = defaultdict(float)
-                        for elem, count in match:
-                            count = float(count) if count else 1
-                            match_count[elem] += count
-                        coating_count = {elem: float(count) if count else 1.0 for elem, count in match_count.items()}
-                        # COATING HAS NO OXYGEN
-                        if 'O' not in coating_count:
-                            if len(coating_count) == 1:
-                                total_volume = 0
-                                for subs, count in coating_count.items():
-                                    radius = metallic_radii.get(subs)
-                                    if radius:
-                                        subs_volume = sphere_volume(radius / 1000)
-                                        total_volume += count * subs_volume
-                                    else:
-                                        # WARNING MESSAGE
-                                        print(f"Coating material error: {coating_sub} is incorrect. Give More Specific Molecular formula.")
-                                        sys.exit(1)
-                                        # WARNING MESSAGE
-                                coating_volume.append(total_volume)
+                    most_stable = solve_charge_balance(metals_comp, oxygen_charge, abs(oxygen_charge))
+                    if most_stable is None:
+                        ## WARNING MESSAGE
+                        raise ComponentError('charge_balance', 'Coating', f"Coating material error: {coating} is incorrect. Give More Specific Molecular formula.")
+                        ## WARNING MESSAGE
+                    for subs, charges in zip(metals, most_stable):
+                        for charge in charges:
+                            if charge > 0:
+                                stable_coating.append(f"{subs}+{charge}")
                             else:
-                                # IF 'C' IN COATING - NEUTRAL RADII
-                                if 'C' in coating_count:
-                                    total_volume = 0
-                                    for subs, count in coating_count.items():
-                                        radius = neutral_radii.get(subs)
-                                        if radius:
-                                            subs_volume = sphere_volume(radius / 1000)
-                                            total_volume += count * subs_volume
-                                    coating_volume.append(total_volume)
-                                # IF 'C' NOT IN COATING - EFFECTIVE RADII
-                                else:
-                                    stable_coating = []
-                                    metals = [elem for elem in coating_count]
-                                    metals_comp = coating_count
-                                    possible_charges = {}
-                                    for metal in metals:
-                                        possible_charges[metal] = []
-                                        for charge_key in effective_ionic_radii.keys():
-                                            match = re.match(r'([A-Z][a-z]?)([+-]\d+)', charge_key)
-                                            if match:
-                                                charge_element, charge = match.groups()
-                                                if charge_element == metal:
-                                                    possible_charges[metal].append(int(charge))
-
-                                    charge_combinations = itertools.product(*(
-                                        itertools.combinations_with_replacement(possible_charges[metal], int(coating_count[metal])) for metal in metals))
-                                    
-                                    valid_combinations = []
-                                    approx_combinations = []
-                                    exact_combinations = []
-                                    for combo in charge_combinations:
-                                        total_charge = sum(sum(metal_combo) for metal_combo in combo)
-                                        if total_charge == 0:
-                                            exact_combinations.append(combo)
-                                        elif abs(total_charge) <= 2:
-                                            approx_combinations.append(combo)
-                                    if exact_combinations:
-                                        valid_combinations = exact_combinations
-                                    elif approx_combinations:
-                                        valid_combinations = approx_combinations
-                                    else:
-                                        ## WARNING MESSAGE ##
-                                        print(f"Coating material error: {coating_sub} is incorrect. Give More Specific Molecular formula.")
-                                        sys.exit(1)
-                                        ## WARNING MESSAGE ##
-                                    if valid_combinations:
-                                        most_stable = min(valid_combinations, 
-                                                        key=lambda x: calculate_stability(x, metals_comp, abs(oxygen_charge)))
-                                        for subs, charges in zip(metals, most_stable):
-                                            for charge in charges:
-                                                if charge > 0:
-                                                    stable_coating.append(f"{subs}+{charge}")
-                                                else:
-                                                    stable_coating.append(f"{subs}{charge}")
-                                    else:
-                                        ## WARNING MESSAGE ##
-                                        print(f"Coating material error: {coating_sub} is incorrect. Give More Specific Molecular formula.")
-                                        sys.exit(1)
-                                        ## WARNING MESSAGE ##
-                                    coating_data = dict(Counter(stable_coating))
-                                    if len(coating_data) >= 2:
-                                        total_volume = 0
-                                        for subs, count in coating_data.items():
-                                            radius = effective_ionic_radii.get(subs)
-                                            if radius:
-                                                subs_volume = sphere_volume(radius / 1000)
-                                                total_volume += count * subs_volume
-                                            else:
-                                                ## WARNING MESSAGE
-                                                print(f"Sorry, {subs} is out of domain")
-                                                sys.exit(1)
-                                                ## WARNING MESSAGE
-                                        coating_volume.append(float(total_volume))
-                                        
-                        # COATING HAS OXYGEN
+                                stable_coating.append(f"{subs}{charge}")
+                    stable_coating.extend(['O-2'] * int(oxygen_count))
+                coating_data = dict(Counter(stable_coating))
+                # VOLUME CALCULATOR
+                if coating_data:
+                    total_volume = 0
+                    for subs, count in coating_data.items():
+                        radius = effective_ionic_radii.get(subs)
+                        if radius:
+                            subs_volume = sphere_volume(radius / 1000)
+                            total_volume += count * subs_volume
                         else:
-                            # "C" IN COATING WITH OXYGEN
-                            if 'C' in coating_count:
-                                total_volume = 0
-                                for subs, count in coating_count.items():
-                                    radius = neutral_radii.get(subs)
-                                    if radius:
-                                        subs_volume = sphere_volume(radius / 1000)
-                                        total_volume += count * subs_volume
-                                    else:
-                                        ## WARNING MESSAGE
-                                        print(f"Sorry, {subs} is out of domain")
-                                        sys.exit(1)
-                                        ## WARNING MESSAGE
-                                coating_volume.append(total_volume)
-                            # "C" NOT IN COATING WITH OXYGEN -> METAL + OXYGEN
-                            else:
-                                metals = [elem for elem in coating_count if elem != 'O']
-                                metals_comp = {elem: int(count) if count else 1 for elem, count in match_count.items() if elem !='O'}
-                                oxygen_count = coating_count['O']
-                                oxygen_charge = -2*oxygen_count
-                                stable_coating = []
-                                if len(metals) == 1:
-                                    element = metals[0]
-                                    possible_charges = []
-                                    for charge_key in effective_ionic_radii.keys():
-                                        match = re.match(r'([A-Z][a-z]?)([+-]\d+)', charge_key)
-                                        if match:
-                                            charge_element, charge = match.groups()
-                                            if charge_element == element:
-                                                possible_charges.append(int(charge))
+                            ## WARNING MESSAGE
+                            raise ComponentError('out_of_domain', 'Coating', f"Sorry, {subs} is out of domain")
+                            ## WARNING MESSAGE
+                    return float(total_volume)
+    except FormulaError as e:
+        raise ComponentError('invalid_formula', 'Coating', f"Coating material error: {coating} is incorrect. {str(e)}")
+    return None
+
+
+def coating_formula_volume(coating):
+    """Coating Volume (nm^3) of one coating entry, multiple coatings are summed"""
+    # IF COATING ITEMS ARE SINGLE
+    if '/' not in coating:
+        if ('coating', coating) in catalog:
+            return catalog.volume('coating', coating)
+
+        # IF COATING ITEMS ARE NOTHING
+        if coating == '':
+            return 0
+        return coating_molecule_volume(coating)
+
+    # IF COATING ITEMS ARE MULTIPLE
+    coating_list = coating.split('/')
+    coating_volume = []
+    for coating_sub in coating_list:
+        # IF COATING IN COATING VOLUME LIST
+        if ('coating', coating_sub) in catalog:
+            subs_volume = catalog.volume('coating', coating_sub)
+            coating_volume.append(float(subs_volume))
+
+        # IF COATING NOT IN COATING VOLUME LIST
+        else:
+            subs_volume = coating_molecule_volume(coating_sub)
+            if subs_volume is not None:
+                coating_volume.append(subs_volume)
+
+    return sum(coating_volume)
+
+
+def coating_volume_process(data, errors='exit', known=None):
+    return assign_volumes(data, 'Coating', 'Coating Volume (nm^3)', 'coating', coating_formula_volume, errors, known)
+
+
+# role -> (input column, volume of one formula)
+component_volumes = {
+    'core': ('Core', core_formula_volume),
+    'doping': ('Doping', doping_formula_volume),
+    'shell': ('Shell', shell_formula_volume),
+    'coating': ('Coating', coating_formula_volume),
+}
+
+
+def compute_formula_volumes(tasks):
+    """Worker of prefetch_volumes, (role, formula, volume, failed) of every (role, formula) task"""
+    results = []
+    for role, formula in tasks:
+        try:
+            results.append((role, formula, component_volumes[role][1](formula), False))
+        except Exception:
+            results.append((role, formula, None, True))
+    return results
+
+
+def resolve_n_jobs(n_jobs):
+    """n_jobs of 1 is serial, None or a negative value uses every CPU like joblib (-1 all, -2 all but one)"""
+    cpus = os.cpu_count() or 1
+    if n_jobs is None:
+        return cpus
+    if n_jobs < 0:
+        return max(1, cpus + 1 + n_jobs)
+    return max(1, n_jobs)
+
+
+def prefetch_volumes(data, n_jobs=-1, min_formulas_per_job=8):
+    """
+    Volumes of the distinct formulas of data that volume_cache does not know yet, computed on n_jobs processes.
+
+    The (role, formula) tasks are deduplicated and sorted, cut into shards and mapped over a process pool,
+    results come back in task order so the merge does not depend on scheduling.
+    Returns {role: {formula: volume}} and stores the volumes in volume_cache.
+    Formulas that fail are left out, the serial pass of calculate_volumes raises or collects their errors.
+    """
+    tasks = sorted({(role, formula) for role, (column, _) in component_volumes.items()
+                    for formula in pd.unique(data[column]) if not volume_cache.contains(role, formula)})
+    known = {role: {} for role in component_volumes}
+    n_jobs = min(resolve_n_jobs(n_jobs), len(tasks) // min_formulas_per_job)
+    if n_jobs <= 1:
+        return known
+
+    # a few shards per process keep the workers busy when some formulas are slow
+    n_shards = n_jobs * 4
+    shards = [tasks[i::n_shards] for i in range(n_shards)]
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        results = [result for shard in executor.map(compute_formula_volumes, shards) for result in shard]
+
+    for role, formula, volume, failed in sorted(results, key=lambda result: (result[0], result[1])):
+        if not failed:
+            known[role][formula] = volume
+            volume_cache.put(role, formula, volume)
+    return known
 
-            
-                                    charge_combinations = itertools.combinations_with_replacement(possible_charges, int(coating_count[element]))
-                    
-                                    valid_combinations = []
-                                    approx_combinations = []
-                                    exact_combinations = []
-                                    for combo in charge_combinations:
-                                        total_charge = sum(combo)
-                                        if total_charge + oxygen_charge == 0:
-                                            exact_combinations.append(combo)
-                                        elif abs(total_charge + oxygen_charge) <= 2:
-                                            approx_combinations.append(combo)
-                                            
-                                    if exact_combinations:
-                                        valid_combinations = exact_combinations
-                                    elif approx_combinations:
-                                        valid_combinations = approx_combinations
-                                    else:
-                                        ## WARNING MESSAGE ##
-                                        print(f"Coating material error: {coating_sub} is incorrect. Give More Specific Molecular formula.")
-                                        sys.exit(1)
-                                        ## WARNING MESSAGE ##
-                                    if valid_combinations:
-                                        most_stable = min(valid_combinations, 
-                                                        key=lambda x: calculate_stability(x, metals_comp, abs(oxygen_charge)))
-                                        for charge in most_stable:
-                                            stable_coating.append(f"{element}+{charge}")
-                                    else:
-                                        ## WARNING MEESAGE
-                                        print(f"Coating material error: {coating_sub} is incorrect. Give More Specific Molecular formula.")
-                                        sys.exit(1)
-                                        ## WARNING MESSAGE
-                                    stable_coating.extend(['O-2'] * int(oxygen_count))
-                                else:
-                                    possible_charges = {}
-                                    for metal in metals:
-                                        possible_charges[metal] = []
-                                        for charge_key in effective_ionic_radii.keys():
-                                            match = re.match(r'([A-Z][a-z]?)([+-]\d+)', charge_key)
-                                            if match:
-                                                charge_element, charge = match.groups()
-                                                if charge_element == metal:
-                                                    possible_charges[metal].append(int(charge))
-
-                                                    
-                                    charge_combinations = itertools.product(*(
-                                        itertools.combinations_with_replacement(possible_charges[metal], int(coating_count[metal])) for metal in metals))
-                                
-                                    valid_combinations = []
-                                    approx_combinations = []
-                                    exact_combinations = []
-                                    for combo in charge_combinations:
-                                        total_charge = sum(sum(metal_combo) for metal_combo in combo)
-                                        if total_charge + oxygen_charge == 0:
-                                            exact_combinations.append(combo)
-                                        elif abs(total_charge + oxygen_charge) <= 2:
-                                            approx_combinations.append(combo)
-                                    if exact_combinations:
-                                        valid_combinations = exact_combinations
-                                    elif approx_combinations:
-                                        valid_combinations = approx_combinations
-                                    else:
-                                        ## WARNING MESSAGE
-                                        print(f"Coating material error: {coating_sub} is incorrect. Give More Specific Molecular formula.")
-                                        sys.exit(1)
-                                        ## WARNING MESSAGE
-                                    if valid_combinations:
-                                        most_stable = min(valid_combinations, 
-                                                        key=lambda x: calculate_stability(x, metals_comp, abs(oxygen_charge)))
-                                        for subs, charges in zip(metals, most_stable):
-                                            for charge in charges:
-                                                if charge > 0:
-                                                    stable_coating.append(f"{subs}+{charge}")
-                                                else:
-                                                    stable_coating.append(f"{subs}{charge}")
-                                    else:
-                                        ## WARNING MESSAGE
-                                        print(f"Coating material error: {coating_sub} is incorrect. Give More Specific Molecular formula.")
-                                        sys.exit(1)
-                                        continue
-                                        ## WARNING MESSAGE
-                                    stable_coating.extend(['O-2'] * int(oxygen_count))
-                                coating_data = dict(Counter(stable_coating))
-                                # VOLUME CALCULATOR
-                                if coating_data:
-                                    total_volume = 0
-                                    for subs, count in coating_data.items():
-                                        radius = effective_ionic_radii.get(subs)
-                                        if radius:
-                                            subs_volume = sphere_volume(radius / 1000)
-                                            total_volume += count * subs_volume
-                                        else:
-                                            ## WARNING MESSAGE
-                                            print(f"Sorry, {subs} is out of domain")
-                                            sys.exit(1)
-                                            ## WARNING MESSAGE
-                                    coating_volume.append(total_volume)
-                    except FormulaError as e:
-                        print(f"Coating material error: {coating_sub} is incorrect. {str(e)}")
-                        sys.exit(1)
-
-            total_coating_volume = sum(coating_volume)
-            data.loc[idx, 'Coating Volume (nm^3)'] = total_coating_volume
-            
-    return data
 
+def calculate_volumes(data, errors='exit', n_jobs=1):
+    """
+    Volumes of the particle and of every component.
 
-def calculate_volumes(data):
+    With errors='collect' a component that cannot be handled does not stop the batch,
+    its row gets an error dict (code, component, message) in the 'Error' column and NaN volumes.
+    n_jobs other than 1 computes the new formulas on a process pool first, see prefetch_volumes.
+    """
+    if errors == 'collect' and 'Error' not in data:
+        data['Error'] = None
+    hits, misses = volume_cache.hits, volume_cache.misses
+    with instrumentation.stage('prefetch_volumes'):
+        known = prefetch_volumes(data, n_jobs) if n_jobs != 1 else {}
     data1 = mc_np_vol_surface(data)
-    data2 = core_volume_process(data1)
-    data3 = doping_volume_process(data2)
-    data4 = shell_volume_process(data3)
-    data5 = coating_volume_process(data4)
+    with instrumentation.stage('core_volume'):
+        data2 = core_volume_process(data1, errors, known.get('core'))
+    with instrumentation.stage('doping_volume'):
+        data3 = doping_volume_process(data2, errors, known.get('doping'))
+    with instrumentation.stage('shell_volume'):
+        data4 = shell_volume_process(data3, errors, known.get('shell'))
+    with instrumentation.stage('coating_volume'):
+        data5 = coating_volume_process(data4, errors, known.get('coating'))
+    if instrumentation.enabled:
+        instrumentation.count('cache_hits', volume_cache.hits - hits, cache='volume')
+        instrumentation.count('cache_misses', volume_cache.misses - misses, cache='volume')
+    if errors == 'collect':
+        # a batch where every row failed a component still has all the columns calculate_amounts reads
+        for column in ['Particle Volume (nm^3)', 'Particle Surface Area (nm^2)', 'Core Volume (nm^3)',
+                       'Doping Volume (nm^3)', 'Shell Volume (nm^3)', 'Coating Volume (nm^3)']:
+            if column not in data5:
+                data5[column] = np.nan
     return data5